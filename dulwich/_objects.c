@@ -259,10 +259,115 @@ error:
 	return NULL;
 }
 
+static PyObject *sha_from_hex(const char *hex, Py_ssize_t len)
+{
+	PyObject *hexbytes, *sha;
+
+	hexbytes = PyBytes_FromStringAndSize(hex, len);
+	if (hexbytes == NULL)
+		return NULL;
+	sha = PyObject_CallFunctionObjArgs(sha1sum_cls, hexbytes, NULL);
+	Py_DECREF(hexbytes);
+	return sha;
+}
+
+static PyObject *py_parse_commit_header(PyObject *self, PyObject *args)
+{
+	PyObject *py_text, *tree = NULL, *parents, *sha;
+	const char *text, *end, *eol, *time_start, *time_end;
+	long long commit_time;
+	int negative;
+
+	if (!PyArg_ParseTuple(args, "O", &py_text))
+		return NULL;
+
+	if (!PyBytes_Check(py_text)) {
+		PyErr_SetString(PyExc_TypeError, "Text is not a bytes object");
+		return NULL;
+	}
+
+	text = PyBytes_AS_STRING(py_text);
+	end = text + PyBytes_GET_SIZE(py_text);
+
+	parents = PyList_New(0);
+	if (parents == NULL)
+		return NULL;
+
+	while (text < end) {
+		eol = memchr(text, '\n', end - text);
+		if (eol == NULL)
+			eol = end;
+		if (eol == text)
+			break; /* End of the headers */
+
+		if (eol - text >= 5 && !memcmp(text, "tree ", 5)) {
+			Py_XDECREF(tree);
+			tree = sha_from_hex(text + 5, eol - text - 5);
+			if (tree == NULL)
+				goto error;
+		} else if (eol - text >= 7 && !memcmp(text, "parent ", 7)) {
+			sha = sha_from_hex(text + 7, eol - text - 7);
+			if (sha == NULL)
+				goto error;
+			if (PyList_Append(parents, sha) == -1) {
+				Py_DECREF(sha);
+				goto error;
+			}
+			Py_DECREF(sha);
+		} else if (eol - text >= 10 && !memcmp(text, "committer ", 10)) {
+			if (tree == NULL)
+				break;
+
+			/* The commit time is the second to last field. */
+			time_end = eol;
+			while (time_end > text && time_end[-1] != ' ')
+				time_end--;
+			if (time_end == text)
+				goto invalid_committer;
+			time_end--;
+			time_start = time_end;
+			while (time_start > text && time_start[-1] != ' ')
+				time_start--;
+			if (time_start == text)
+				goto invalid_committer;
+
+			negative = (time_start < time_end && *time_start == '-');
+			if (negative || (time_start < time_end && *time_start == '+'))
+				time_start++;
+			if (time_start == time_end || time_end - time_start > 18)
+				goto invalid_committer;
+			commit_time = 0;
+			for (; time_start < time_end; time_start++) {
+				if (*time_start < '0' || *time_start > '9')
+					goto invalid_committer;
+				commit_time = commit_time * 10 + (*time_start - '0');
+			}
+			if (negative)
+				commit_time = -commit_time;
+
+			return Py_BuildValue("(NNL)", tree, parents, commit_time);
+		}
+
+		text = eol + 1;
+	}
+
+	PyErr_SetString(object_format_exception_cls,
+	                tree == NULL ? "missing tree" : "missing committer");
+	goto error;
+
+invalid_committer:
+	PyErr_SetString(object_format_exception_cls, "invalid committer");
+error:
+	Py_XDECREF(tree);
+	Py_DECREF(parents);
+	return NULL;
+}
+
 static PyMethodDef py_objects_methods[] = {
 	{ "parse_tree", (PyCFunction)py_parse_tree, METH_VARARGS | METH_KEYWORDS,
 	  NULL },
 	{ "sorted_tree_items", py_sorted_tree_items, METH_VARARGS, NULL },
+	{ "parse_commit_header", py_parse_commit_header, METH_VARARGS, NULL },
 	{ NULL, NULL, 0, NULL }
 };
 
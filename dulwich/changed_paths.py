@@ -0,0 +1,230 @@
+# changed_paths.py -- Bloom filters of the paths changed by commits
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Bloom filters of the paths changed by commits.
+
+For every commit, a Bloom filter is kept of the paths that changed relative
+to its first parent (or the empty tree), including the directories leading
+to them. Checking whether a commit may have touched a path then takes
+constant time, instead of a diff of the trees. False positives are possible,
+false negatives are not.
+
+Like C git, a commit that changed more than MAX_CHANGED_PATHS paths gets a
+filter that matches everything.
+
+The filters can be kept in a file, which is rewritten by
+ChangedPathFilters.save():
+
+  header  "DCPF", version (4 bytes)
+  record  commit SHA1 (20 bytes), filter length (2 bytes), filter
+"""
+
+import errno
+import hashlib
+import struct
+import threading
+
+from dulwich.diff_tree import tree_changes
+from dulwich.errors import FileFormatException
+from dulwich.file import GitFile
+from dulwich.pathspec import as_pathspec
+
+CHANGED_PATHS_SIGNATURE = b'DCPF'
+CHANGED_PATHS_VERSION = 1
+
+BITS_PER_ENTRY = 10
+NUM_HASHES = 7
+MAX_CHANGED_PATHS = 512
+
+_HEADER = struct.Struct('>4sL')
+_RECORD = struct.Struct('>20sH')
+_HASHES = struct.Struct('>QQ')
+
+# A filter with all bits set, which matches every path.
+_MATCH_ALL = b'\xff'
+
+
+class BloomFilter(object):
+    """A Bloom filter of byte strings."""
+
+    __slots__ = ('_bits', '_num_bits')
+
+    def __init__(self, data):
+        """Create a Bloom filter.
+
+        :param data: The bits of the filter, as bytes or a bytearray
+        """
+        self._bits = data
+        self._num_bits = len(data) * 8
+
+    @classmethod
+    def from_keys(cls, keys):
+        """Create a Bloom filter containing a set of keys.
+
+        :param keys: Collection of byte strings
+        """
+        num_bytes = max(8, (len(keys) * BITS_PER_ENTRY + 7) // 8)
+        bloom = cls(bytearray(num_bytes))
+        for key in keys:
+            bloom.add(key)
+        bloom._bits = bytes(bloom._bits)
+        return bloom
+
+    def _positions(self, key):
+        h1, h2 = _HASHES.unpack(hashlib.md5(key).digest())
+        num_bits = self._num_bits
+        return [(h1 + i * h2) % num_bits for i in range(NUM_HASHES)]
+
+    def add(self, key):
+        """Add a key to the filter."""
+        for i in self._positions(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for i in self._positions(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def as_bytes(self):
+        """Return the bits of the filter, as bytes."""
+        return bytes(self._bits)
+
+
+def _changed_path_keys(changes):
+    keys = set()
+    for change in changes:
+        for path in (change.old.path, change.new.path):
+            while path and path not in keys:
+                keys.add(path)
+                i = path.rfind(b'/')
+                path = i >= 0 and path[:i] or None
+    return keys
+
+
+class ChangedPathFilters(object):
+    """Changed-path Bloom filters for the commits in an object store.
+
+    Filters are computed when first needed and kept in memory; if a path is
+    given, they are also loaded from and saved to that file.
+    """
+
+    def __init__(self, store, path=None):
+        """Create a set of changed-path filters.
+
+        :param store: ObjectStore to look up commits and trees in
+        :param path: Optional path of a file to keep the filters in
+        """
+        self.store = store
+        self.path = path
+        self._filters = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with f:
+            contents = f.read()
+        if (len(contents) < _HEADER.size or
+            _HEADER.unpack_from(contents, 0) !=
+                (CHANGED_PATHS_SIGNATURE, CHANGED_PATHS_VERSION)):
+            raise FileFormatException('%s is not a changed-path filter file'
+                                      % self.path)
+        offset = _HEADER.size
+        while offset < len(contents):
+            if offset + _RECORD.size > len(contents):
+                raise FileFormatException('%s is truncated' % self.path)
+            sha, length = _RECORD.unpack_from(contents, offset)
+            offset += _RECORD.size
+            data = contents[offset:offset + length]
+            if len(data) != length:
+                raise FileFormatException('%s is truncated' % self.path)
+            self._filters[sha] = BloomFilter(data)
+            offset += length
+
+    def _compute(self, commit):
+        if commit.parents:
+            parent_tree = self.store[commit.parents[0]].tree
+        else:
+            parent_tree = None
+        keys = _changed_path_keys(
+            tree_changes(self.store, parent_tree, commit.tree))
+        if len(keys) > MAX_CHANGED_PATHS:
+            return BloomFilter(_MATCH_ALL)
+        return BloomFilter.from_keys(keys)
+
+    def get_filter(self, commit):
+        """Get the changed-path filter of a commit.
+
+        :param commit: A Commit object
+        :return: A BloomFilter of the paths changed relative to the first
+            parent of the commit
+        """
+        sha = commit.id.bytes
+        bloom = self._filters.get(sha)
+        if bloom is None:
+            bloom = self._compute(commit)
+            with self._lock:
+                self._filters[sha] = bloom
+                self._dirty = True
+        return bloom
+
+    def may_have_changed(self, commit, paths):
+        """Check whether a commit may have changed any of a set of paths.
+
+        :param commit: A Commit object
+        :param paths: PathSpec or iterable of paths; see
+            pathspec.as_pathspec
+        :return: False if the commit did not change any of the paths
+            relative to its first parent, True if it may have
+        """
+        bloom = self.get_filter(commit)
+        paths = as_pathspec(paths)
+        for path in paths:
+            # Patterns with wildcards are looked up by their leading
+            # directories.
+            path = paths.literal_prefix(path)
+            if not path or path in bloom:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._filters)
+
+    def save(self):
+        """Write the filters to the file, if they changed since loading."""
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            with GitFile(self.path, 'wb') as f:
+                f.write(_HEADER.pack(CHANGED_PATHS_SIGNATURE,
+                                     CHANGED_PATHS_VERSION))
+                for sha, bloom in sorted(self._filters.items()):
+                    data = bloom.as_bytes()
+                    f.write(_RECORD.pack(sha, len(data)))
+                    f.write(data)
+            self._dirty = False
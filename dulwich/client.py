@@ -22,9 +22,12 @@
 __docformat__ = 'restructuredText'
 
 from io import BytesIO
+import http.client
 import select
 import socket
 import subprocess
+import threading
+import time
 import urllib.request, urllib.error, urllib.parse
 import urllib.parse
 
@@ -203,6 +206,24 @@ class GitClient(object):
         """
         raise NotImplementedError(self.fetch_pack)
 
+    def fetch_multiple(self, fetches, determine_wants=None, progress=None):
+        """Fetch several repositories through this client, one after another.
+
+        All fetches share the connection state of this client; for
+        HttpGitClient this means that connections in its pool are reused.
+
+        :param fetches: Iterable of (path, target) tuples
+        :param determine_wants: Optional function to determine what refs
+            to fetch
+        :param progress: Optional progress function
+        :return: Dictionary mapping paths to remote refs
+        """
+        ret = {}
+        for path, target in fetches:
+            ret[path] = self.fetch(path, target,
+                determine_wants=determine_wants, progress=progress)
+        return ret
+
     def _parse_status_report(self, proto):
         unpack = proto.read_pkt_line().strip()
         if unpack != 'unpack ok':
@@ -610,11 +631,187 @@ class SSHGitClient(TraditionalGitClient):
     def close(self):
         pass
 
+
+class _PooledResponse(object):
+    """HTTP response that hands its connection back to a pool on close.
+
+    This provides the subset of the urlopen() response interface used by
+    HttpGitClient.
+    """
+
+    # Maximum amount of unread data to drain before giving up on reusing
+    # the connection.
+    _DRAIN_LIMIT = 64 * 1024
+
+    def __init__(self, pool, key, conn, resp):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+    def getcode(self):
+        return self._resp.status
+
+    def info(self):
+        return self._resp.msg
+
+    def read(self, *args):
+        return self._resp.read(*args)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        resp = self._resp
+        if not resp.isclosed():
+            # Chunked responses only notice the end of the body on the
+            # next read.
+            try:
+                resp.read(self._DRAIN_LIMIT)
+            except (http.client.HTTPException, socket.error):
+                pass
+        if resp.isclosed() and not resp.will_close:
+            self._pool._release(self._key, conn)
+        else:
+            resp.close()
+            conn.close()
+
+
+class HTTPConnectionPool(object):
+    """Pool of persistent HTTP connections, keyed by host.
+
+    Idle connections are kept open for reuse by subsequent requests to the
+    same host, so that repeated requests do not each pay for a new TCP (and
+    TLS) handshake. Redirects and proxies are not handled; use plain urllib
+    if those are needed.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=60, timeout=None):
+        """Create a new HTTPConnectionPool.
+
+        :param max_per_host: Maximum number of idle connections to keep
+            per host
+        :param idle_timeout: Number of seconds after which an idle
+            connection is closed rather than reused
+        :param timeout: Optional socket timeout for new connections
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, **kwargs)
+        return http.client.HTTPConnection(host, port, **kwargs)
+
+    def _acquire(self, key):
+        """Get an idle connection for key, or None if there is none."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def idle_count(self, key=None):
+        """Return the number of idle connections.
+
+        :param key: Optional (scheme, host, port) tuple to restrict the
+            count to
+        """
+        with self._lock:
+            if key is not None:
+                return len(self._idle.get(key, []))
+            return sum(len(idle) for idle in self._idle.values())
+
+    def request(self, req, idempotent=None):
+        """Perform a HTTP request over a pooled connection.
+
+        If a reused connection fails, the request is sent again once on a
+        fresh connection, but only if it failed before the request was sent
+        or the request is idempotent.
+
+        :param req: urllib.request.Request instance
+        :param idempotent: Whether the request can safely be sent twice; by
+            default only GET and HEAD requests are
+        :return: Response object with getcode(), info(), read() and close()
+        """
+        parsed = urllib.parse.urlparse(req.full_url)
+        port = parsed.port
+        if port is None:
+            port = {'https': 443}.get(parsed.scheme, 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        headers = dict(req.header_items())
+        if idempotent is None:
+            idempotent = req.get_method() in ('GET', 'HEAD')
+        conn = self._acquire(key)
+        if conn is not None:
+            sent = False
+            try:
+                self._send(conn, req, headers)
+                sent = True
+                return _PooledResponse(self, key, conn, conn.getresponse())
+            except (http.client.HTTPException, socket.error):
+                # The server may have dropped the idle connection; retry
+                # once on a fresh one.
+                conn.close()
+                if sent and not idempotent:
+                    raise
+            except:
+                conn.close()
+                raise
+        conn = self._new_connection(key)
+        try:
+            self._send(conn, req, headers)
+            resp = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        return _PooledResponse(self, key, conn, resp)
+
+    def _send(self, conn, req, headers):
+        conn.request(req.get_method(), req.selector, body=req.data,
+                     headers=headers)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
 class HttpGitClient(GitClient):
 
-    def __init__(self, base_url, dumb=None, *args, **kwargs):
+    def __init__(self, base_url, dumb=None, *args, pool=None, **kwargs):
+        """Create a new HttpGitClient.
+
+        :param base_url: Base URL of the server
+        :param dumb: Whether to use the dumb protocol, or None to detect
+        :param pool: Optional HTTPConnectionPool to perform requests with;
+            by default a new connection is opened for every request. This
+            can only be passed as a keyword argument.
+        """
         self.base_url = base_url.rstrip("/") + "/"
         self.dumb = dumb
+        self.pool = pool
         GitClient.__init__(self, *args, **kwargs)
 
     def _get_url(self, path):
@@ -628,6 +825,12 @@ class HttpGitClient(GitClient):
         :param req: urllib2.Request instance
         :return: matching response
         """
+        if self.pool is not None:
+            # Fetches do not change the repository, so they can be sent
+            # again on a fresh connection; pushes cannot.
+            return self.pool.request(
+                req, idempotent=(req.get_method() == 'GET' or
+                                 req.selector.endswith('/git-upload-pack')))
         return urllib.request.urlopen(req)
 
     def _discover_references(self, service, url):
@@ -639,20 +842,22 @@ class HttpGitClient(GitClient):
             headers["Content-Type"] = "application/x-%s-request" % service
         req = urllib.request.Request(url, headers=headers)
         resp = self._perform(req)
-        if resp.getcode() == 404:
-            raise NotGitRepository()
-        if resp.getcode() != 200:
-            raise GitProtocolError("unexpected http response %d" %
-                resp.getcode())
-        self.dumb = (not resp.info().get_content_type().startswith("application/x-git-"))
-        proto = Protocol(resp.read, None, resp.close)
-        if not self.dumb:
-            # The first line should mention the service
-            pkts = list(proto.read_pkt_seq())
-            if pkts != [(('# service=%s\n' % service).encode('utf-8'))]:
-                raise GitProtocolError(
-                    "unexpected first line %r from smart server" % pkts)
-        return self._read_refs(proto)
+        # Closing the response hands a pooled connection back to the pool.
+        with Protocol(resp.read, None, resp.close) as proto:
+            if resp.getcode() == 404:
+                raise NotGitRepository()
+            if resp.getcode() != 200:
+                raise GitProtocolError("unexpected http response %d" %
+                    resp.getcode())
+            self.dumb = (not resp.info().get_content_type().startswith(
+                "application/x-git-"))
+            if not self.dumb:
+                # The first line should mention the service
+                pkts = list(proto.read_pkt_seq())
+                if pkts != [(('# service=%s\n' % service).encode('utf-8'))]:
+                    raise GitProtocolError(
+                        "unexpected first line %r from smart server" % pkts)
+            return self._read_refs(proto)
 
     def _smart_request(self, service, url, data):
         assert url[-1] == "/"
@@ -661,14 +866,19 @@ class HttpGitClient(GitClient):
             headers={"Content-Type": "application/x-%s-request" % service},
             data=data)
         resp = self._perform(req)
-        if resp.getcode() == 404:
-            raise NotGitRepository()
-        if resp.getcode() != 200:
-            raise GitProtocolError("Invalid HTTP response from server: %d"
-                % resp.getcode())
-        if resp.info().get_content_type() != ("application/x-%s-result" % service):
-            raise GitProtocolError("Invalid content-type from server: %s"
-                % resp.info().get_content_type())
+        try:
+            if resp.getcode() == 404:
+                raise NotGitRepository()
+            if resp.getcode() != 200:
+                raise GitProtocolError("Invalid HTTP response from server: %d"
+                    % resp.getcode())
+            if resp.info().get_content_type() != ("application/x-%s-result" % service):
+                raise GitProtocolError("Invalid content-type from server: %s"
+                    % resp.info().get_content_type())
+        except:
+            # Hands a pooled connection back to the pool.
+            resp.close()
+            raise
         return resp
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
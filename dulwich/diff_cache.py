@@ -0,0 +1,367 @@
+# diff_cache.py -- Persistent cache of tree diffs
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Persistent cache of the changes between pairs of trees.
+
+Walking the same history more than once, for example to show the log of
+several files, diffs the same pairs of trees over and over again. A
+TreeDiffCache keeps the resulting lists of TreeChange objects in a file, so
+they are only computed once.
+
+The cache file is a log of records that is only ever appended to, possibly
+by several processes at once. Records that can't be read, such as one that
+is still being written or one whose writer was interrupted, are skipped.
+When the file holds more than twice the maximum number of entries, it is
+rewritten with just the most recently used entries, while holding its lock
+file; this also drops the unreadable records.
+
+File layout (all integers are big endian):
+
+  header  "DTDC", version (4 bytes)
+  record  "DTDR", data length (4 bytes), CRC32 of the data (4 bytes), data
+  data    variant length (1 byte), variant, tree1 SHA1 (20 bytes, zeros for
+          None), tree2 SHA1 (20 bytes, zeros for None), number of changes
+          (4 bytes), changes
+  change  flags and type (1 byte), followed by the old entry unless it is
+          missing, followed by the new entry unless it is missing or the
+          same as the old entry. If only the paths are the same, the path
+          of the new entry is left out.
+  entry   path length (2 bytes), path, mode (4 bytes), SHA1 (20 bytes)
+
+The variant distinguishes diffs of the same trees made with different
+options, such as with and without rename detection.
+"""
+
+import binascii
+from collections import OrderedDict
+import errno
+import os
+import struct
+import threading
+
+from dulwich.diff_tree import (
+    CHANGE_ADD,
+    CHANGE_COPY,
+    CHANGE_DELETE,
+    CHANGE_MODIFY,
+    CHANGE_RENAME,
+    CHANGE_UNCHANGED,
+    TreeChange,
+    _NULL_ENTRY,
+    )
+from dulwich.errors import FileFormatException
+from dulwich.file import GitFile
+from dulwich.objects import (
+    Sha1Sum,
+    TreeEntry,
+    )
+
+DIFF_CACHE_SIGNATURE = b'DTDC'
+DIFF_CACHE_VERSION = 2
+DEFAULT_MAX_ENTRIES = 10000
+
+_CHANGE_TYPES = (CHANGE_ADD, CHANGE_MODIFY, CHANGE_DELETE, CHANGE_RENAME,
+                 CHANGE_COPY, CHANGE_UNCHANGED)
+_CHANGE_TYPE_NUMS = dict((t, i) for i, t in enumerate(_CHANGE_TYPES))
+
+_TYPE_MASK = 0x07
+_OLD_MISSING = 0x08
+_NEW_MISSING = 0x10
+_SAME_PATH = 0x20
+_SAME_ENTRY = 0x40
+
+_HEADER = struct.Struct('>4sL')
+_RECORD_SIGNATURE = b'DTDR'
+_RECORD_HEADER = struct.Struct('>4sLL')
+_LENGTH = struct.Struct('>L')
+_PATH_LENGTH = struct.Struct('>H')
+_MODE = struct.Struct('>L')
+
+_NULL_SHA = b'\0' * 20
+
+
+def _sha_bytes(sha):
+    if sha is None:
+        return _NULL_SHA
+    if not isinstance(sha, Sha1Sum):
+        sha = Sha1Sum(sha)
+    return sha.bytes
+
+
+def _pack_entry(entry, with_path=True):
+    path, mode, sha = entry
+    data = _MODE.pack(mode) + _sha_bytes(sha)
+    if with_path:
+        data = _PATH_LENGTH.pack(len(path)) + path + data
+    return data
+
+
+def _pack_changes(changes):
+    """Encode a list of TreeChange objects.
+
+    :param changes: List of TreeChange objects
+    :return: The encoded changes, as bytes
+    """
+    data = [_LENGTH.pack(len(changes))]
+    for change in changes:
+        flags = _CHANGE_TYPE_NUMS[change.type]
+        old, new = change.old, change.new
+        if old == _NULL_ENTRY:
+            flags |= _OLD_MISSING
+        if new == _NULL_ENTRY:
+            flags |= _NEW_MISSING
+        elif new == old:
+            flags |= _SAME_ENTRY
+        elif new[0] == old[0]:
+            flags |= _SAME_PATH
+        data.append(bytes([flags]))
+        if not flags & _OLD_MISSING:
+            data.append(_pack_entry(old))
+        if not flags & (_NEW_MISSING | _SAME_ENTRY):
+            data.append(_pack_entry(new, with_path=not flags & _SAME_PATH))
+    return b''.join(data)
+
+
+def _unpack_entry(data, offset, path=None):
+    if path is None:
+        (path_length,) = _PATH_LENGTH.unpack_from(data, offset)
+        offset += _PATH_LENGTH.size
+        path = data[offset:offset + path_length]
+        offset += path_length
+    (mode,) = _MODE.unpack_from(data, offset)
+    offset += _MODE.size
+    sha = Sha1Sum(data[offset:offset + 20])
+    return TreeEntry(path, mode, sha), offset + 20
+
+
+def _unpack_changes(data):
+    """Decode a list of TreeChange objects.
+
+    :param data: The encoded changes, as returned by _pack_changes
+    :return: List of TreeChange objects
+    """
+    (count,) = _LENGTH.unpack_from(data, 0)
+    offset = _LENGTH.size
+    changes = []
+    for i in range(count):
+        flags = data[offset]
+        offset += 1
+        old = new = _NULL_ENTRY
+        if not flags & _OLD_MISSING:
+            old, offset = _unpack_entry(data, offset)
+        if flags & _SAME_ENTRY:
+            new = old
+        elif not flags & _NEW_MISSING:
+            new, offset = _unpack_entry(
+                data, offset, path=(flags & _SAME_PATH) and old.path or None)
+        changes.append(TreeChange(_CHANGE_TYPES[flags & _TYPE_MASK], old, new))
+    return changes
+
+
+def _pack_record(key, changes_data):
+    variant, tree1, tree2 = key
+    data = bytes([len(variant)]) + variant + tree1 + tree2 + changes_data
+    return _RECORD_HEADER.pack(_RECORD_SIGNATURE, len(data),
+                               binascii.crc32(data) & 0xffffffff) + data
+
+
+def _unpack_record(data):
+    variant_length = data[0]
+    offset = 1 + variant_length
+    key = (data[1:offset], data[offset:offset + 20],
+           data[offset + 20:offset + 40])
+    return key, data[offset + 40:]
+
+
+class TreeDiffCache(object):
+    """Persistent cache of the changes between pairs of trees.
+
+    Entries are kept in memory in their encoded form, and are decoded again
+    every time they are looked up.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        """Open a tree diff cache, creating it if it does not exist.
+
+        :param path: Path of the cache file
+        :param max_entries: Maximum number of diffs to keep
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._num_records = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _read_records(self):
+        """Read the records in the cache file.
+
+        :return: List of (key, changes data) tuples, oldest first, or None if
+            the file does not exist
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        with f:
+            contents = f.read()
+        if not contents:
+            return []
+        if (len(contents) < _HEADER.size or
+            _HEADER.unpack_from(contents, 0) !=
+                (DIFF_CACHE_SIGNATURE, DIFF_CACHE_VERSION)):
+            raise FileFormatException('%s is not a tree diff cache' %
+                                      self.path)
+        records = []
+        offset = contents.find(_RECORD_SIGNATURE, _HEADER.size)
+        while offset != -1:
+            start = offset + _RECORD_HEADER.size
+            if start <= len(contents):
+                (signature, length, crc32) = _RECORD_HEADER.unpack_from(
+                    contents, offset)
+                data = contents[start:start + length]
+                if (len(data) == length and
+                        binascii.crc32(data) & 0xffffffff == crc32):
+                    records.append(_unpack_record(data))
+                    offset = contents.find(_RECORD_SIGNATURE, start + length)
+                    continue
+            # A record that is still being written, or whose writer was
+            # interrupted; carry on with the next one.
+            offset = contents.find(_RECORD_SIGNATURE, offset + 1)
+        return records
+
+    def _load(self):
+        records = self._read_records()
+        if records is None:
+            return
+        for key, changes_data in records:
+            self._entries[key] = changes_data
+            self._entries.move_to_end(key)
+            self._num_records += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _append(self, record):
+        if self._file is not None:
+            try:
+                replaced = (os.fstat(self._file.fileno()).st_ino !=
+                            os.stat(self.path).st_ino)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                replaced = True
+            if replaced:
+                # Another process compacted the file
+                self._file.close()
+                self._file = None
+        if self._file is None:
+            if os.path.exists(self.path):
+                self._file = open(self.path, 'ab')
+            else:
+                self._file = open(self.path, 'wb')
+                self._file.write(_HEADER.pack(DIFF_CACHE_SIGNATURE,
+                                              DIFF_CACHE_VERSION))
+        self._file.write(record)
+        self._file.flush()
+        self._num_records += 1
+
+    def _compact(self):
+        """Rewrite the cache file with only the most recently used entries.
+
+        The file is rewritten under its lock file. Entries that other
+        processes added to the file since it was loaded are kept, as the
+        least recently used ones.
+
+        :return: False if another process holds the lock file, True otherwise
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            f = GitFile(self.path, 'wb')
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        with f:
+            # Appends that happen while the lock is held go to the old
+            # file and are lost, which only costs a cache miss.
+            records = self._read_records()
+            if records is not None:
+                for key, changes_data in reversed(records):
+                    if key not in self._entries:
+                        self._entries[key] = changes_data
+                        self._entries.move_to_end(key, last=False)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            f.write(_HEADER.pack(DIFF_CACHE_SIGNATURE, DIFF_CACHE_VERSION))
+            for key, changes_data in self._entries.items():
+                f.write(_pack_record(key, changes_data))
+        self._num_records = len(self._entries)
+        return True
+
+    def get(self, tree1_id, tree2_id, variant=b''):
+        """Look up the changes between two trees.
+
+        :param tree1_id: The SHA of the source tree, or None
+        :param tree2_id: The SHA of the target tree, or None
+        :param variant: Bytes identifying the options used for the diff
+        :return: List of TreeChange objects, or None if not cached
+        """
+        key = (variant, _sha_bytes(tree1_id), _sha_bytes(tree2_id))
+        with self._lock:
+            changes_data = self._entries.get(key)
+            if changes_data is None:
+                return None
+            self._entries.move_to_end(key)
+        return _unpack_changes(changes_data)
+
+    def add(self, tree1_id, tree2_id, changes, variant=b''):
+        """Add the changes between two trees to the cache.
+
+        :param tree1_id: The SHA of the source tree, or None
+        :param tree2_id: The SHA of the target tree, or None
+        :param changes: List of TreeChange objects
+        :param variant: Bytes identifying the options used for the diff
+        """
+        key = (variant, _sha_bytes(tree1_id), _sha_bytes(tree2_id))
+        changes_data = _pack_changes(changes)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = changes_data
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if (self._num_records < 2 * self.max_entries or
+                    not self._compact()):
+                self._append(_pack_record(key, changes_data))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        """Close the cache file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
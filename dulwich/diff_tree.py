@@ -18,17 +18,30 @@
 
 """Utilities for diffing files and trees."""
 
-from collections import defaultdict
-
-from io import BytesIO
+from collections import (
+    Counter,
+    defaultdict,
+    deque,
+    )
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import itertools
+import pickle
+import random
+import re
 import stat
 
 from collections import namedtuple
+from dulwich.lru_cache import LRUCache
 from dulwich.objects import (
     S_ISGITLINK,
     TreeEntry,
     )
+from dulwich.pathspec import (
+    MATCH,
+    MATCH_LEADING,
+    as_pathspec,
+    )
 
 # TreeChange type constants.
 CHANGE_ADD = 'add'
@@ -46,6 +59,7 @@ _MAX_SCORE = 100
 RENAME_THRESHOLD = 60
 MAX_FILES = 200
 REWRITE_THRESHOLD = None
+BLOCK_CACHE_SIZE = 500
 
 
 class TreeChange(namedtuple('TreeChange', ['type', 'old', 'new'])):
@@ -113,7 +127,7 @@ def _is_tree(entry):
     return stat.S_ISDIR(mode)
 
 
-def walk_trees(store, tree1_id, tree2_id, prune_identical=False):
+def walk_trees(store, tree1_id, tree2_id, prune_identical=False, paths=None):
     """Recursively walk all the entries of two trees.
 
     Iteration is depth-first pre-order, as in e.g. os.walk.
@@ -122,6 +136,9 @@ def walk_trees(store, tree1_id, tree2_id, prune_identical=False):
     :param tree1_id: The SHA of the first Tree object to iterate, or None.
     :param tree2_id: The SHA of the second Tree object to iterate, or None.
     :param prune_identical: If True, identical subtrees will not be walked.
+    :param paths: Optional PathSpec or set of paths to limit the walk to;
+        see pathspec.as_pathspec. Only entries matching one of them are
+        returned, and only the trees leading to them are looked up.
     :return: Iterator over Pairs of TreeEntry objects for each pair of entries
         in the trees and their subtrees recursively. If an entry exists in one
         tree but not the other, the other entry will have all attributes set
@@ -131,9 +148,17 @@ def walk_trees(store, tree1_id, tree2_id, prune_identical=False):
     # This could be fairly easily generalized to >2 trees if we find a use case.
     mode1 = tree1_id and stat.S_IFDIR or None
     mode2 = tree2_id and stat.S_IFDIR or None
-    todo = [(TreeEntry(b'', mode1, tree1_id), TreeEntry(b'', mode2, tree2_id))]
+    if paths is None:
+        state = None
+    else:
+        paths = as_pathspec(paths)
+        state = paths.start()[1]
+    # state is None for entries at or below one of the paths, or otherwise
+    # the state of paths for matching their children.
+    todo = [(TreeEntry(b'', mode1, tree1_id), TreeEntry(b'', mode2, tree2_id),
+             state)]
     while todo:
-        entry1, entry2 = todo.pop()
+        entry1, entry2, state = todo.pop()
         is_tree1 = _is_tree(entry1)
         is_tree2 = _is_tree(entry2)
         if prune_identical and is_tree1 and is_tree2 and entry1 == entry2:
@@ -142,8 +167,22 @@ def walk_trees(store, tree1_id, tree2_id, prune_identical=False):
         tree1 = is_tree1 and store[entry1.sha] or None
         tree2 = is_tree2 and store[entry2.sha] or None
         path = entry1.path or entry2.path
-        todo.extend(reversed(_merge_entries(path, tree1, tree2)))
-        yield entry1, entry2
+        children = _merge_entries(path, tree1, tree2)
+        if state is None:
+            todo.extend((child1, child2, None)
+                        for child1, child2 in reversed(children))
+            yield entry1, entry2
+            continue
+        # Only walk into the children that match, or lead to, a wanted path.
+        name_start = path and len(path) + 1 or 0
+        for child1, child2 in reversed(children):
+            child_path = child1.path or child2.path
+            result, child_state = paths.step(state, child_path[name_start:])
+            if result == MATCH:
+                todo.append((child1, child2, None))
+            elif (result == MATCH_LEADING and
+                  (_is_tree(child1) or _is_tree(child2))):
+                todo.append((child1, child2, child_state))
 
 
 def _skip_tree(entry):
@@ -153,7 +192,7 @@ def _skip_tree(entry):
 
 
 def tree_changes(store, tree1_id, tree2_id, want_unchanged=False,
-                 rename_detector=None):
+                 rename_detector=None, diff_cache=None, paths=None):
     """Find the differences between the contents of two trees.
 
     :param store: An ObjectStore for looking up objects.
@@ -162,18 +201,44 @@ def tree_changes(store, tree1_id, tree2_id, want_unchanged=False,
     :param want_unchanged: If True, include TreeChanges for unmodified entries
         as well.
     :param rename_detector: RenameDetector object for detecting renames.
+    :param diff_cache: Optional diff_cache.TreeDiffCache to look up and store
+        the changes in. With a rename_detector, the changes with renames are
+        cached in it instead of in the detector's own diff_cache.
+    :param paths: Optional PathSpec or set of paths to limit the changes
+        to; see walk_trees. Rename detection is not limited to these
+        paths.
     :return: Iterator over TreeChange instances for each change between the
         source and target tree.
     """
+    if paths is not None:
+        paths = as_pathspec(paths)
+
     if (rename_detector is not None and tree1_id is not None and
         tree2_id is not None):
         for change in rename_detector.changes_with_renames(
-          tree1_id, tree2_id, want_unchanged=want_unchanged):
+          tree1_id, tree2_id, want_unchanged=want_unchanged,
+          diff_cache=diff_cache):
+            if paths is None or _change_in_paths(change, paths):
+                yield change
+        return
+
+    if diff_cache is not None:
+        variant = want_unchanged and b'u' or b''
+        if paths is not None:
+            variant += (paths.globs and b'g' or b'p') + hashlib.sha1(
+                b'\0'.join(sorted(paths))).digest()
+        changes = diff_cache.get(tree1_id, tree2_id, variant)
+        if changes is None:
+            changes = list(tree_changes(store, tree1_id, tree2_id,
+                                        want_unchanged=want_unchanged,
+                                        paths=paths))
+            diff_cache.add(tree1_id, tree2_id, changes, variant)
+        for change in changes:
             yield change
         return
 
     entries = walk_trees(store, tree1_id, tree2_id,
-                         prune_identical=(not want_unchanged))
+                         prune_identical=(not want_unchanged), paths=paths)
 
     for entry1, entry2 in entries:
         if entry1 == entry2 and not want_unchanged:
@@ -203,6 +268,73 @@ def tree_changes(store, tree1_id, tree2_id, want_unchanged=False,
         yield TreeChange(change_type, entry1, entry2)
 
 
+def _change_in_paths(change, paths):
+    return paths.matches(change.old.path) or paths.matches(change.new.path)
+
+
+# Object store used by the tree_changes_batch worker processes
+_worker_store = None
+
+
+def _init_tree_changes_worker(pickled_store):
+    global _worker_store
+    # Unpickle even when the process was forked, so that it does not share
+    # the files the parent's store has open.
+    _worker_store = pickle.loads(pickled_store)
+
+
+def _tree_changes_worker(tree_pairs, want_unchanged):
+    return [list(tree_changes(_worker_store, tree1_id, tree2_id,
+                              want_unchanged=want_unchanged))
+            for tree1_id, tree2_id in tree_pairs]
+
+
+def tree_changes_batch(store, tree_pairs, want_unchanged=False, workers=None,
+                       chunksize=16):
+    """Find the differences between many pairs of trees.
+
+    With more than one worker, the pairs are diffed on a pool of processes.
+    Each process works on its own copy of the store, made by pickling it, also
+    when it is forked; a DiskObjectStore pickles to a new read-only view of the
+    same directory.
+    Results are still returned in the order of tree_pairs, as soon as they
+    and all earlier results are available.
+
+    :param store: An ObjectStore for looking up objects.
+    :param tree_pairs: Iterable over (tree1_id, tree2_id) tuples.
+    :param want_unchanged: If True, include TreeChanges for unmodified entries
+        as well.
+    :param workers: Number of processes to use; None or 1 diffs the trees in
+        this process.
+    :param chunksize: Number of pairs to send to a process at a time.
+    :return: Iterator over a list of TreeChange instances for each pair.
+    """
+    if workers is None or workers <= 1:
+        for tree1_id, tree2_id in tree_pairs:
+            yield list(tree_changes(store, tree1_id, tree2_id,
+                                    want_unchanged=want_unchanged))
+        return
+
+    tree_pairs = iter(tree_pairs)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_tree_changes_worker,
+                             initargs=(pickle.dumps(store),)) as executor:
+        pending = deque()
+        while True:
+            # Keep every process busy, but do not read all of tree_pairs
+            # up front.
+            while len(pending) < workers * 2:
+                chunk = list(itertools.islice(tree_pairs, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(
+                    _tree_changes_worker, chunk, want_unchanged))
+            if not pending:
+                break
+            for changes in pending.popleft().result():
+                yield changes
+
+
 def _all_eq(seq, key, value):
     for e in seq:
         if key(e) != value:
@@ -215,13 +347,17 @@ def _all_same(seq, key):
 
 
 def tree_changes_for_merge(store, parent_tree_ids, tree_id,
-                           rename_detector=None):
+                           rename_detector=None, diff_cache=None, paths=None):
     """Get the tree changes for a merge tree relative to all its parents.
 
     :param store: An ObjectStore for looking up objects.
     :param parent_tree_ids: An iterable of the SHAs of the parent trees.
     :param tree_id: The SHA of the merge tree.
     :param rename_detector: RenameDetector object for detecting renames.
+    :param diff_cache: Optional diff_cache.TreeDiffCache for the changes
+        relative to each parent.
+    :param paths: Optional PathSpec or set of paths to limit the changes
+        to; see walk_trees.
 
     :yield: Lists of TreeChange objects, one per conflicted path in the merge.
 
@@ -233,8 +369,11 @@ def tree_changes_for_merge(store, parent_tree_ids, tree_id,
         in the merge tree is not found in any of the parents, or in the case of
         deletes, if not all of the old SHAs match.
     """
+    if paths is not None:
+        paths = as_pathspec(paths)
     all_parent_changes = [tree_changes(store, t, tree_id,
-                                       rename_detector=rename_detector)
+                                       rename_detector=rename_detector,
+                                       diff_cache=diff_cache, paths=paths)
                           for t in parent_tree_ids]
     num_parents = len(parent_tree_ids)
     changes_by_path = defaultdict(lambda: [None] * num_parents)
@@ -267,6 +406,10 @@ def tree_changes_for_merge(store, parent_tree_ids, tree_id,
 
 
 _BLOCK_SIZE = 64
+# A line of up to _BLOCK_SIZE bytes including its newline, or otherwise a
+# chunk of up to _BLOCK_SIZE bytes of a longer (or unterminated) line.
+_BLOCK_RE = re.compile(b'[^\n]{0,%d}\n|[^\n]{1,%d}' % (
+    _BLOCK_SIZE - 1, _BLOCK_SIZE))
 
 
 def _count_blocks(obj):
@@ -278,28 +421,11 @@ def _count_blocks(obj):
     :return: A dict of block hashcode -> total bytes occurring.
     """
     block_counts = defaultdict(int)
-    block = BytesIO()
-    n = 0
-
-    # Cache attrs as locals to avoid expensive lookups in the inner loop.
-    block_write = block.write
-    block_seek = block.seek
-    block_truncate = block.truncate
-    block_getvalue = block.getvalue
-
-    for c in itertools.chain(*obj.as_raw_chunks()):
-        c = bytes((c,)) # Convert int to bytes object
-        block_write(c)
-        n += 1
-        if c == b'\n' or n == _BLOCK_SIZE:
-            value = block_getvalue()
-            block_counts[hash(value)] += len(value)
-            block_seek(0)
-            block_truncate()
-            n = 0
-    if n > 0:
-        last_block = block_getvalue()
-        block_counts[hash(last_block)] += len(last_block)
+    # Let the regex engine do the splitting and Counter the counting, so
+    # there is only a Python-level step per distinct block.
+    blocks = Counter(_BLOCK_RE.findall(obj.as_raw_string()))
+    for block, count in blocks.items():
+        block_counts[hash(block)] += len(block) * count
     return block_counts
 
 
@@ -335,18 +461,68 @@ def _similarity_score(obj1, obj2, block_cache=None):
     """
     if block_cache is None:
         block_cache = {}
-    if obj1.id not in block_cache:
-        block_cache[obj1.id] = _count_blocks(obj1)
-    if obj2.id not in block_cache:
-        block_cache[obj2.id] = _count_blocks(obj2)
-
-    common_bytes = _common_bytes(block_cache[obj1.id], block_cache[obj2.id])
+    blocks1 = block_cache.get(obj1.id)
+    if blocks1 is None:
+        blocks1 = block_cache[obj1.id] = _count_blocks(obj1)
+    blocks2 = block_cache.get(obj2.id)
+    if blocks2 is None:
+        blocks2 = block_cache[obj2.id] = _count_blocks(obj2)
+
+    common_bytes = _common_bytes(blocks1, blocks2)
     max_size = max(obj1.raw_length(), obj2.raw_length())
     if not max_size:
         return _MAX_SCORE
     return int(float(common_bytes) * _MAX_SCORE / max_size)
 
 
+def _max_similarity_score(size1, size2):
+    """Compute the highest similarity score two objects of given sizes can get.
+
+    :param size1: Size of the first object
+    :param size2: Size of the second object
+    :return: Upper bound of _similarity_score for the objects
+    """
+    max_size = max(size1, size2)
+    if not max_size:
+        return _MAX_SCORE
+    return int(float(min(size1, size2)) * _MAX_SCORE / max_size)
+
+
+# MinHash parameters for approximate rename detection. Each of the
+# _MINHASH_BANDS bands of _MINHASH_ROWS signature values is used as a bucket
+# key, so two blobs whose sets of blocks have a Jaccard similarity of s end up
+# in a common bucket with probability 1 - (1 - s ** rows) ** bands. This is
+# above 95% at the Jaccard similarity of two blobs with a score of 60.
+_MINHASH_BANDS = 16
+_MINHASH_ROWS = 2
+# Buckets with more delete/add pairs than this are not compared at all.
+_MINHASH_MAX_BUCKET_PAIRS = 10000
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_MASK = (1 << 64) - 1
+_minhash_random = random.Random(0)
+_MINHASH_PARAMS = [
+    (_minhash_random.randrange(1, _MINHASH_PRIME),
+     _minhash_random.randrange(0, _MINHASH_PRIME))
+    for i in range(_MINHASH_BANDS * _MINHASH_ROWS)]
+del _minhash_random
+
+
+def _minhash_buckets(blocks):
+    """Compute the LSH bucket keys of a set of blocks.
+
+    :param blocks: A dict of block hashcode -> total bytes, as returned by
+        _count_blocks.
+    :return: A list of bucket keys
+    """
+    if not blocks:
+        return []
+    keys = [block & _MINHASH_MASK for block in blocks]
+    signature = tuple(min([(a * key + b) % _MINHASH_PRIME for key in keys])
+                      for a, b in _MINHASH_PARAMS)
+    return [(i, signature[i * _MINHASH_ROWS:(i + 1) * _MINHASH_ROWS])
+            for i in range(_MINHASH_BANDS)]
+
+
 def _tree_change_key(entry):
     # Sort by old path then new path. If only one exists, use it for both keys.
     path1 = entry.old.path
@@ -364,7 +540,8 @@ class RenameDetector(object):
     def __init__(self, store, rename_threshold=RENAME_THRESHOLD,
                  max_files=MAX_FILES,
                  rewrite_threshold=REWRITE_THRESHOLD,
-                 find_copies_harder=False):
+                 find_copies_harder=False, block_cache=None,
+                 approximate_renames=False, diff_cache=None):
         """Initialize the rename detector.
 
         :param store: An ObjectStore for looking up objects.
@@ -380,12 +557,28 @@ class RenameDetector(object):
             modifies; see _similarity_score.
         :param find_copies_harder: If True, consider unmodified files when
             detecting copies.
+        :param block_cache: Optional cache of blob SHA to block counts that is
+            kept between calls, such as an LRUCache or a dict. By default an
+            LRUCache of the last BLOCK_CACHE_SIZE blobs is used, so that
+            detecting renames for a series of commits counts the blocks of
+            each blob only once.
+        :param approximate_renames: If True, detect content renames even when
+            max_files is exceeded. Instead of comparing every add/delete pair,
+            only pairs whose MinHash signatures share an LSH bucket are
+            compared, so some renames may be missed.
+        :param diff_cache: Optional diff_cache.TreeDiffCache to look up and
+            store the results of changes_with_renames in.
         """
+        if block_cache is None:
+            block_cache = LRUCache(BLOCK_CACHE_SIZE)
+        self._block_cache = block_cache
         self._store = store
         self._rename_threshold = rename_threshold
         self._rewrite_threshold = rewrite_threshold
         self._max_files = max_files
         self._find_copies_harder = find_copies_harder
+        self._approximate_renames = approximate_renames
+        self._diff_cache = diff_cache
         self._want_unchanged = False
 
     def _reset(self):
@@ -399,7 +592,8 @@ class RenameDetector(object):
             return False
         old_obj = self._store[change.old.sha]
         new_obj = self._store[change.new.sha]
-        return _similarity_score(old_obj, new_obj) < self._rewrite_threshold
+        return (_similarity_score(old_obj, new_obj, self._block_cache) <
+                self._rewrite_threshold)
 
     def _add_change(self, change):
         if change.type == CHANGE_ADD:
@@ -464,6 +658,8 @@ class RenameDetector(object):
         self._prune(add_paths, delete_paths)
 
     def _should_find_content_renames(self):
+        if self._max_files is None:
+            return True
         return len(self._adds) * len(self._deletes) <= self._max_files ** 2
 
     def _rename_type(self, check_paths, delete, add):
@@ -477,34 +673,127 @@ class RenameDetector(object):
             return CHANGE_COPY
         return CHANGE_RENAME
 
+    def _may_be_similar(self, delete, old_size, add, new_size):
+        """Check whether a delete/add pair can reach the rename threshold."""
+        if stat.S_IFMT(delete.old.mode) != stat.S_IFMT(add.new.mode):
+            return False
+        # The size ratio bounds the score from above, so most pairs can be
+        # rejected without counting any blocks.
+        return (_max_similarity_score(old_size, new_size) >
+                self._rename_threshold)
+
+    def _similar_pairs(self, get_blocks):
+        """Find the delete/add pairs that are likely to be similar.
+
+        Only the size and LSH bucket keys of each blob are kept while the
+        buckets are filled; the blobs are loaded again for the pairs that
+        are returned. Buckets with more than _MINHASH_MAX_BUCKET_PAIRS pairs
+        are skipped.
+
+        :param get_blocks: Function returning the block counts of an object
+        :return: Iterator over ((delete, object, size), (add, object, size))
+            tuples for the pairs whose MinHash signatures share an LSH bucket
+        """
+        buckets = defaultdict(lambda: ([], []))
+        deletes = []
+        for delete in self._deletes:
+            if S_ISGITLINK(delete.old.mode):
+                continue  # Git links don't exist in this repo.
+            old_obj = self._store[delete.old.sha]
+            for key in _minhash_buckets(get_blocks(old_obj)):
+                buckets[key][0].append(len(deletes))
+            deletes.append((delete, old_obj.raw_length()))
+        adds = []
+        for add in self._adds:
+            if S_ISGITLINK(add.new.mode):
+                continue
+            new_obj = self._store[add.new.sha]
+            for key in _minhash_buckets(get_blocks(new_obj)):
+                buckets[key][1].append(len(adds))
+            adds.append((add, new_obj.raw_length()))
+        pairs = set()
+        for delete_indices, add_indices in buckets.values():
+            if (len(delete_indices) * len(add_indices) >
+                    _MINHASH_MAX_BUCKET_PAIRS):
+                # Typically many copies of the same boilerplate; comparing
+                # them all would make the search quadratic again.
+                continue
+            for i in delete_indices:
+                for j in add_indices:
+                    pairs.add((i, j))
+        del buckets
+        old_obj = None
+        for i, j in sorted(pairs):
+            delete, old_size = deletes[i]
+            add, new_size = adds[j]
+            if not self._may_be_similar(delete, old_size, add, new_size):
+                continue
+            if old_obj is None or old_obj.id != delete.old.sha:
+                old_obj = self._store[delete.old.sha]
+            new_obj = self._store[add.new.sha]
+            yield (delete, old_obj, old_size), (add, new_obj, new_size)
+
     def _find_content_rename_candidates(self):
         candidates = self._candidates = []
         # TODO: Optimizations:
-        #  - Compare object sizes before counting blocks.
         #  - Skip if delete's S_IFMT differs from all adds.
-        #  - Skip if adds or deletes is empty.
         # Match C git's behavior of not attempting to find content renames if
-        # the matrix size exceeds the threshold.
-        if not self._should_find_content_renames():
+        # the matrix size exceeds the threshold, unless approximate rename
+        # detection was asked for.
+        approximate = not self._should_find_content_renames()
+        if approximate and not self._approximate_renames:
+            return
+        if not self._adds or not self._deletes:
             return
 
-        check_paths = self._rename_threshold is not None
-        for delete in self._deletes:
-            if S_ISGITLINK(delete.old.mode):
-                continue  # Git links don't exist in this repo.
-            old_sha = delete.old.sha
-            old_obj = self._store[old_sha]
-            old_blocks = _count_blocks(old_obj)
+        if approximate:
+            # The number of blobs is not bounded by max_files, so only keep
+            # the block counts that fit in self._block_cache.
+            def get_blocks(obj):
+                blocks = self._block_cache.get(obj.id)
+                if blocks is None:
+                    blocks = _count_blocks(obj)
+                    self._block_cache[obj.id] = blocks
+                return blocks
+            pairs = self._similar_pairs(get_blocks)
+        else:
+            # Block counts for this call; they are computed at most once per
+            # blob, even if they do not fit in self._block_cache.
+            block_cache = {}
+            def get_blocks(obj):
+                blocks = block_cache.get(obj.id)
+                if blocks is None:
+                    blocks = self._block_cache.get(obj.id)
+                    if blocks is None:
+                        blocks = _count_blocks(obj)
+                        self._block_cache[obj.id] = blocks
+                    block_cache[obj.id] = blocks
+                return blocks
+
+            adds = []
             for add in self._adds:
-                if stat.S_IFMT(delete.old.mode) != stat.S_IFMT(add.new.mode):
+                if S_ISGITLINK(add.new.mode):
                     continue
                 new_obj = self._store[add.new.sha]
-                score = _similarity_score(old_obj, new_obj,
-                                          block_cache={old_sha: old_blocks})
-                if score > self._rename_threshold:
-                    new_type = self._rename_type(check_paths, delete, add)
-                    rename = TreeChange(new_type, delete.old, add.new)
-                    candidates.append((-score, rename))
+                adds.append((add, new_obj, new_obj.raw_length()))
+            deletes = []
+            for delete in self._deletes:
+                if S_ISGITLINK(delete.old.mode):
+                    continue  # Git links don't exist in this repo.
+                old_obj = self._store[delete.old.sha]
+                deletes.append((delete, old_obj, old_obj.raw_length()))
+            pairs = ((d, a) for d in deletes for a in adds
+                     if self._may_be_similar(d[0], d[2], a[0], a[2]))
+
+        check_paths = self._rename_threshold is not None
+        for (delete, old_obj, old_size), (add, new_obj, new_size) in pairs:
+            score = _similarity_score(old_obj, new_obj, block_cache={
+                old_obj.id: get_blocks(old_obj),
+                new_obj.id: get_blocks(new_obj)})
+            if score > self._rename_threshold:
+                new_type = self._rename_type(check_paths, delete, add)
+                rename = TreeChange(new_type, delete.old, add.new)
+                candidates.append((-score, rename))
 
     def _choose_content_renames(self):
         # Sort scores from highest to lowest, but keep names in ascending order.
@@ -559,8 +848,34 @@ class RenameDetector(object):
             return
         self._deletes = [d for d in self._deletes if d.type != CHANGE_UNCHANGED]
 
-    def changes_with_renames(self, tree1_id, tree2_id, want_unchanged=False):
-        """Iterate TreeChanges between two tree SHAs, with rename detection."""
+    def _cache_variant(self, want_unchanged):
+        # All options that affect the result of changes_with_renames.
+        return ('r%r,%r,%r,%d,%d,%d' % (
+            self._rename_threshold, self._max_files, self._rewrite_threshold,
+            self._find_copies_harder, self._approximate_renames,
+            want_unchanged)).encode('ascii')
+
+    def changes_with_renames(self, tree1_id, tree2_id, want_unchanged=False,
+                             diff_cache=None):
+        """Iterate TreeChanges between two tree SHAs, with rename detection.
+
+        :param diff_cache: Optional diff_cache.TreeDiffCache to use instead of
+            the one this detector was created with
+        """
+        if diff_cache is None:
+            diff_cache = self._diff_cache
+        if diff_cache is None:
+            return self._changes_with_renames(tree1_id, tree2_id,
+                                              want_unchanged)
+        variant = self._cache_variant(want_unchanged)
+        changes = diff_cache.get(tree1_id, tree2_id, variant)
+        if changes is None:
+            changes = self._changes_with_renames(tree1_id, tree2_id,
+                                                 want_unchanged)
+            diff_cache.add(tree1_id, tree2_id, changes, variant)
+        return changes
+
+    def _changes_with_renames(self, tree1_id, tree2_id, want_unchanged):
         self._reset()
         self._want_unchanged = want_unchanged
         self._collect_changes(tree1_id, tree2_id)
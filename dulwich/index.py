@@ -33,6 +33,7 @@ from dulwich.pack import (
     SHA1Reader,
     SHA1Writer,
     )
+from dulwich.pathspec import as_pathspec
 
 
 
@@ -260,16 +261,24 @@ class Index(object):
         for name, value in entries.items():
             self[name] = value
 
-    def changes_from_tree(self, object_store, tree, want_unchanged=False):
+    def changes_from_tree(self, object_store, tree, want_unchanged=False,
+                          paths=None):
         """Find the differences between the contents of this index and a tree.
 
         :param object_store: Object store to use for retrieving tree contents
         :param tree: SHA1 of the root tree
         :param want_unchanged: Whether unchanged files should be reported
+        :param paths: Optional PathSpec or iterable of paths to limit the
+            changes to; see pathspec.as_pathspec
         :return: Iterator over tuples with (oldpath, newpath), (oldmode, newmode), (oldsha, newsha)
         """
-        mine = set(self._byname.keys())
-        for (name, mode, sha) in object_store.iter_tree_contents(tree):
+        if paths is None:
+            mine = set(self._byname.keys())
+        else:
+            paths = as_pathspec(paths)
+            mine = set(name for name in self._byname if paths.matches(name))
+        for (name, mode, sha) in object_store.iter_tree_contents(
+                tree, paths=paths):
             if name in mine:
                 if (want_unchanged or self.get_sha1(name) != sha or 
                     self.get_mode(name) != mode):
@@ -0,0 +1,190 @@
+# mirror.py -- Fetch many repositories concurrently
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Driver for fetching many repositories concurrently.
+
+Fetches run on a pool of threads. The number of fetches running against a
+single host at any time can be limited, and HTTP fetches share a single
+HTTPConnectionPool so that connections to a host are reused.
+"""
+
+import collections
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+    )
+import time
+import urllib.parse
+
+from dulwich.client import (
+    HTTPConnectionPool,
+    HttpGitClient,
+    get_transport_and_path,
+    )
+
+
+class FetchResult(object):
+    """Outcome of fetching a single repository.
+
+    :ivar url: URL that was fetched from
+    :ivar target: Repository that was fetched into
+    :ivar refs: Remote refs, or None if the fetch failed
+    :ivar error: Exception raised by the fetch, or None
+    :ivar start_time: Time at which the fetch started
+    :ivar duration: Number of seconds the fetch took
+    """
+
+    def __init__(self, url, target, refs=None, error=None, start_time=None,
+                 duration=None):
+        self.url = url
+        self.target = target
+        self.refs = refs
+        self.error = error
+        self.start_time = start_time
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<%s %s ok in %.3fs>' % (type(self).__name__, self.url,
+                                            self.duration)
+        return '<%s %s failed: %r>' % (type(self).__name__, self.url,
+                                       self.error)
+
+
+def _host_key(url):
+    """Return the key used to limit concurrency for a URL.
+
+    Local paths all share a single key.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.netloc:
+        return parsed.hostname
+    if parsed.scheme:
+        # SSH with no user@
+        return parsed.scheme
+    if '@' in parsed.path and ':' in parsed.path:
+        return parsed.path.split(':')[0].rsplit('@')[-1]
+    return None
+
+
+class MirrorDriver(object):
+    """Fetch many repositories concurrently.
+
+    The driver is safe to reuse for several batches; connection state such
+    as the HTTP connection pool is kept between calls to fetch().
+    """
+
+    def __init__(self, max_workers=8, max_per_host=4, http_pool=None,
+                 get_client=get_transport_and_path):
+        """Create a new MirrorDriver.
+
+        :param max_workers: Number of fetches to run at the same time
+        :param max_per_host: Number of fetches to run against a single host
+            at the same time
+        :param http_pool: HTTPConnectionPool shared by HTTP fetches; a new
+            one is created if not specified
+        :param get_client: Function that returns a (client, path) tuple for
+            a URL
+        """
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        if http_pool is None:
+            http_pool = HTTPConnectionPool(max_per_host=max_per_host)
+        self.http_pool = http_pool
+        self._get_client = get_client
+
+    def _fetch_one(self, url, target, determine_wants, progress):
+        result = FetchResult(url, target)
+        result.start_time = time.time()
+        try:
+            client, path = self._get_client(url)
+            if isinstance(client, HttpGitClient) and client.pool is None:
+                client.pool = self.http_pool
+            result.refs = client.fetch(path, target,
+                determine_wants=determine_wants, progress=progress)
+        except Exception as e:
+            result.error = e
+        result.duration = time.time() - result.start_time
+        return result
+
+    def fetch(self, jobs, determine_wants=None, progress=None, report=None):
+        """Fetch a set of repositories.
+
+        Failures do not stop the other fetches; they are recorded in the
+        error attribute of the matching result.
+
+        :param jobs: Iterable of (url, target) tuples
+        :param determine_wants: Optional function to determine what refs
+            to fetch
+        :param progress: Optional progress function, passed on to the clients
+        :param report: Optional function called with each FetchResult as
+            soon as it is available; it runs in the calling thread, and
+            any exception it raises is propagated
+        :return: List of FetchResult objects, in the order of jobs
+        """
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        # Jobs are only handed to the pool once their host has a free slot,
+        # so jobs waiting on a busy host never hold a worker.
+        waiting = collections.defaultdict(collections.deque)
+        running = collections.defaultdict(int)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+
+            def submit(i):
+                url, target = jobs[i]
+                future = executor.submit(self._fetch_one, url, target,
+                                         determine_wants, progress)
+                pending[future] = i
+
+            for i, (url, target) in enumerate(jobs):
+                key = _host_key(url)
+                if running[key] < self.max_per_host:
+                    running[key] += 1
+                    submit(i)
+                else:
+                    waiting[key].append(i)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    key = _host_key(jobs[i][0])
+                    if waiting[key]:
+                        submit(waiting[key].popleft())
+                    else:
+                        running[key] -= 1
+                    results[i] = future.result()
+                    if report is not None:
+                        report(results[i])
+        return results
+
+    def close(self):
+        """Close any idle connections held by the driver."""
+        self.http_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
@@ -20,12 +20,17 @@
 """Git object store interfaces and implementation."""
 
 
+import binascii
 import errno
 import itertools
 import os
 import stat
 import tempfile
+import threading
+import time
+import zlib
 
+from dulwich import log_utils
 from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
@@ -43,6 +48,7 @@ from dulwich.objects import (
     ZERO_SHA,
     S_ISGITLINK,
     object_class,
+    parse_commit_header,
     sha_to_filename,
     )
 from dulwich.pack import (
@@ -56,11 +62,14 @@ from dulwich.pack import (
     compute_file_sha,
     PackIndexer,
     PackStreamCopier,
+    pack_object_header,
     )
 
 INFODIR = 'info'
 PACKDIR = 'pack'
 
+logger = log_utils.getLogger(__name__)
+
 
 class BaseObjectStore(object):
     """Object store interface."""
@@ -143,17 +152,19 @@ class BaseObjectStore(object):
                    (change.old.mode, change.new.mode),
                    (change.old.sha, change.new.sha))
 
-    def iter_tree_contents(self, tree_id, include_trees=False):
+    def iter_tree_contents(self, tree_id, include_trees=False, paths=None):
         """Iterate the contents of a tree and all subtrees.
 
         Iteration is depth-first pre-order, as in e.g. os.walk.
 
         :param tree_id: SHA1 of the tree.
         :param include_trees: If True, include tree objects in the iteration.
+        :param paths: Optional PathSpec or set of paths to limit the
+            iteration to; see diff_tree.walk_trees.
         :return: Iterator over TreeEntry namedtuples for all the objects in a
             tree.
         """
-        for entry, _ in walk_trees(self, tree_id, None):
+        for entry, _ in walk_trees(self, tree_id, None, paths=paths):
             if not stat.S_ISDIR(entry.mode) or include_trees:
                 yield entry
 
@@ -193,7 +204,8 @@ class BaseObjectStore(object):
         :param heads: Local heads to start search with
         :return: GraphWalker object
         """
-        return ObjectStoreGraphWalker(heads, lambda sha: self[sha].parents)
+        return ObjectStoreGraphWalker(
+            heads, lambda sha: parse_commit_header(self.get_raw(sha)[1])[1])
 
     def generate_pack_contents(self, have, want, progress=None):
         """Iterate over the contents of a pack file.
@@ -287,7 +299,9 @@ class PackBasedObjectStore(BaseObjectStore):
         objects = set()
         for sha in self._iter_loose_objects():
             objects.add((self._get_loose_object(sha), None))
-        self.add_objects(list(objects))
+        # The loose objects are removed below, so they have to end up in a
+        # complete pack rather than in a staging pack.
+        PackBasedObjectStore.add_objects(self, list(objects))
         for obj, path in objects:
             self._remove_loose_object(obj.id)
         return len(objects)
@@ -337,6 +351,131 @@ class PackBasedObjectStore(BaseObjectStore):
         return commit()
 
 
+DEFAULT_LOOSE_CACHE_TTL = 0
+DEFAULT_STAGING_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_STAGING_MAX_AGE = 60
+
+
+class StagingPack(object):
+    """Pack that objects are appended to before it is moved into a store.
+
+    The objects are written to a temporary pack file as they are added and
+    can be read back straight away through an in-memory index. finish()
+    completes the pack file.
+    """
+
+    def __init__(self, f, path):
+        """Create a new StagingPack.
+
+        :param f: Empty file object to write the pack to, opened for
+            reading and writing
+        :param path: Path of the pack file
+        """
+        self._file = f
+        self.path = path
+        self.start_time = time.time()
+        # sha -> (offset, crc32)
+        self._entries = {}
+        # sha -> (type_num, offset of the compressed data, compressed size)
+        self._objects = {}
+        write_pack_header(self._file, 0)
+        self._size = self._file.tell()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, sha):
+        return Sha1Sum(sha) in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    @property
+    def size(self):
+        """Number of bytes written to the pack file."""
+        return self._size
+
+    def add_object(self, obj):
+        """Append an object, unless it is already in the pack.
+
+        :param obj: Object to add
+        """
+        if obj.id in self._entries:
+            return
+        raw = obj.as_raw_string()
+        self._file.seek(self._size)
+        crc32 = write_pack_object(self._file, obj.type_num, raw)
+        end = self._file.tell()
+        data_offset = self._size + len(
+            pack_object_header(obj.type_num, None, len(raw)))
+        self._entries[obj.id] = (self._size, crc32)
+        self._objects[obj.id] = (obj.type_num, data_offset, end - data_offset)
+        self._size = end
+
+    def get_raw(self, sha):
+        """Obtain the raw text for an object in the pack.
+
+        :param sha: SHA of the object
+        :return: Tuple with numeric type and object contents
+        :raise KeyError: the object is not in the pack
+        """
+        type_num, offset, size = self._objects[Sha1Sum(sha)]
+        self._file.flush()
+        self._file.seek(offset)
+        return type_num, zlib.decompress(self._file.read(size))
+
+    def finish(self):
+        """Write the header and trailer and close the pack file.
+
+        :return: Tuple with sorted list of (sha, offset, crc32) entries and
+            the pack checksum
+        """
+        self._file.seek(0)
+        write_pack_header(self._file, len(self._entries))
+        self._file.flush()
+        pack_sha = compute_file_sha(self._file).digest()
+        self._file.seek(self._size)
+        self._file.write(pack_sha)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        entries = sorted((sha, offset, crc32)
+                         for sha, (offset, crc32) in self._entries.items())
+        return entries, pack_sha
+
+    def abort(self):
+        """Close and remove the pack file."""
+        self._file.close()
+        os.remove(self.path)
+
+
+def _stat_key(st):
+    """Return the values of a stat result that change when a file changes."""
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _create_loose_temp(dir):
+    """Create a temporary file for a loose object.
+
+    Unlike tempfile.mkstemp, the file is created with the same mode GitFile
+    uses, so the permissions follow the umask like other loose objects.
+
+    :param dir: Directory to create the file in
+    :return: Tuple with file descriptor and path of the new file
+    """
+    while True:
+        path = os.path.join(dir, 'tmp_obj_' + binascii.hexlify(
+            os.urandom(8)).decode('ascii'))
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL |
+                         getattr(os, "O_BINARY", 0))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        return fd, path
+
+
 class DiskObjectStore(PackBasedObjectStore):
     """Git-style object store that exists on disk."""
 
@@ -350,8 +489,138 @@ class DiskObjectStore(PackBasedObjectStore):
         self.path = path
         self.pack_dir = os.path.join(self.path, PACKDIR)
         self._pack_cache_time = 0
+        # pack path without extension -> (stat key of the .pack file, Pack)
+        self._pack_files = {}
+        # Number of seconds the last rescan of the pack directory took
+        self.pack_rescan_time = None
+        # fan-out directory name -> [stat key, set of file names, check time]
+        self._loose_cache = {}
+        # Number of seconds a fan-out directory listing is trusted without
+        # checking whether the directory changed
+        self.loose_cache_ttl = DEFAULT_LOOSE_CACHE_TTL
+        self._staging = None
+        self._staging_lock = threading.RLock()
+        self.staging_max_bytes = None
+        self.staging_max_age = None
         self._alternates = None
 
+    def __reduce__(self):
+        # Unpickling opens a new view of the same store, e.g. in a worker
+        # process; open files, caches and staged objects are not copied.
+        return (type(self), (self.path,))
+
+    def close(self):
+        self.stop_staging()
+        super(DiskObjectStore, self).close()
+        self._pack_files = {}
+
+    @property
+    def staging(self):
+        """Whether new objects are written to a staging pack."""
+        return self.staging_max_bytes is not None
+
+    def start_staging(self, max_bytes=DEFAULT_STAGING_MAX_BYTES,
+                      max_age=DEFAULT_STAGING_MAX_AGE):
+        """Write new objects to a staging pack instead of loose objects.
+
+        add_object and add_objects append objects to a pack file that is
+        kept open, and which is moved into the pack directory once it is
+        larger than max_bytes or its first object is older than max_age
+        seconds, or when flush_staging is called. Staged objects can be
+        looked up immediately, but only by this object store.
+
+        Staging is only safe when this object store is the single writer
+        to the repository, e.g. during a bulk import. Staged objects are
+        neither durable nor visible to other object stores, including other
+        instances for the same path such as those in a RepositoryPool, so
+        flush_staging must be called before any ref is made to point at a
+        staged object. The staging pack of a process that dies before
+        flushing is left behind as a tmp_staging_* file in the pack
+        directory; it is not cleaned up automatically, since it can't be
+        told apart from the staging pack of a running writer.
+
+        :param max_bytes: Size of the staging pack at which it is completed
+        :param max_age: Number of seconds after which the staging pack is
+            completed
+        """
+        self.staging_max_bytes = max_bytes
+        self.staging_max_age = max_age
+
+    def stop_staging(self):
+        """Complete the staging pack and write new objects directly again."""
+        self.flush_staging()
+        self.staging_max_bytes = None
+        self.staging_max_age = None
+
+    def flush_staging(self):
+        """Move the staging pack, if any, into the pack directory.
+
+        :return: The Pack with the staged objects, or None if no objects
+            were staged
+        """
+        with self._staging_lock:
+            staging = self._staging
+            if staging is None:
+                return None
+            self._staging = None
+            if len(staging) == 0:
+                staging.abort()
+                return None
+            entries, pack_sha = staging.finish()
+        pack_base_name = os.path.join(
+          self.pack_dir, 'pack-' + iter_sha1(e[0].bytes for e in entries).string)
+        index_file = GitFile(pack_base_name + '.idx', 'wb')
+        try:
+            write_pack_index_v2(index_file, entries, pack_sha)
+            index_file.close()
+        finally:
+            index_file.abort()
+        os.rename(staging.path, pack_base_name + '.pack')
+        final_pack = Pack(pack_base_name)
+        self._add_known_pack(final_pack)
+        return final_pack
+
+    def _stage_objects(self, objects):
+        with self._staging_lock:
+            if self._staging is None:
+                fd, path = tempfile.mkstemp(dir=self.pack_dir,
+                                            prefix='tmp_staging_')
+                self._staging = StagingPack(os.fdopen(fd, 'w+b'), path)
+            for obj in objects:
+                if not self.contains_packed(obj.id):
+                    self._staging.add_object(obj)
+            full = (self._staging.size >= self.staging_max_bytes or
+                    time.time() - self._staging.start_time >=
+                    self.staging_max_age)
+        if full:
+            self.flush_staging()
+
+    def contains_packed(self, sha):
+        """Check if a particular object is present by SHA1 and is packed."""
+        staging = self._staging
+        if staging is not None and sha in staging:
+            return True
+        return super(DiskObjectStore, self).contains_packed(sha)
+
+    def get_raw(self, sha):
+        """Obtain the raw text for an object.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and object contents.
+        """
+        with self._staging_lock:
+            if self._staging is not None and sha in self._staging:
+                return self._staging.get_raw(sha)
+        return super(DiskObjectStore, self).get_raw(sha)
+
+    def __iter__(self):
+        """Iterate over the SHAs that are present in this store."""
+        iterables = [super(DiskObjectStore, self).__iter__()]
+        staging = self._staging
+        if staging is not None:
+            iterables.append(iter(staging))
+        return itertools.chain(*iterables)
+
     @property
     def alternates(self):
         if self._alternates is not None:
@@ -400,26 +669,84 @@ class DiskObjectStore(PackBasedObjectStore):
         self.alternates.append(DiskObjectStore(path))
 
     def _load_packs(self):
+        """Rescan the pack directory.
+
+        Packs whose files have not changed since the last scan are kept, so
+        their loaded indexes and caches can be reused; only new packs are
+        opened and packs that disappeared are closed.
+        """
+        start = time.time()
         pack_files = []
         try:
-            self._pack_cache_time = os.stat(self.pack_dir).st_mtime
+            self._pack_cache_time = os.stat(self.pack_dir).st_mtime_ns
             pack_dir_contents = os.listdir(self.pack_dir)
             for name in pack_dir_contents:
                 # TODO: verify that idx exists first
                 if name.startswith("pack-") and name.endswith(".pack"):
                     filename = os.path.join(self.pack_dir, name)
-                    pack_files.append((os.stat(filename).st_mtime, filename))
+                    try:
+                        st = os.stat(filename)
+                    except OSError as e:
+                        if e.errno == errno.ENOENT:
+                            # Removed since listing the directory
+                            continue
+                        raise
+                    pack_files.append((st.st_mtime_ns, filename,
+                                       _stat_key(st)))
         except OSError as e:
-            if e.errno == errno.ENOENT:
-                return []
-            raise
+            if e.errno != errno.ENOENT:
+                raise
         pack_files.sort(reverse=True)
         suffix_len = len(".pack")
-        return [Pack(f[:-suffix_len]) for _, f in pack_files]
+        old_pack_files = self._pack_files
+        self._pack_files = {}
+        packs = []
+        for _, filename, key in pack_files:
+            basename = filename[:-suffix_len]
+            entry = old_pack_files.pop(basename, None)
+            if entry is not None and entry[0] != key:
+                # Replaced under the same name
+                entry[1].close()
+                entry = None
+            if entry is None:
+                entry = (key, Pack(basename))
+            self._pack_files[basename] = entry
+            packs.append(entry[1])
+        for key, pack in old_pack_files.values():
+            pack.close()
+        self.pack_rescan_time = time.time() - start
+        logger.debug('Rescanned %s in %.3fs: %d packs, %d removed',
+                     self.pack_dir, self.pack_rescan_time, len(packs),
+                     len(old_pack_files))
+        return packs
+
+    def _add_known_pack(self, pack):
+        """Add a newly appeared pack to the cache by path.
+
+        :param pack: Pack that was added to the pack directory
+        """
+        basename = pack._basename
+        try:
+            key = _stat_key(os.stat(basename + ".pack"))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        entry = self._pack_files.get(basename)
+        self._pack_files[basename] = (key, pack)
+        if entry is not None and entry[1] is not pack:
+            # The same pack was added again; replace the earlier copy
+            entry[1].close()
+            if self._pack_cache is not None:
+                for i, p in enumerate(self._pack_cache):
+                    if p is entry[1]:
+                        self._pack_cache[i] = pack
+                        return
+        super(DiskObjectStore, self)._add_known_pack(pack)
 
     def _pack_cache_stale(self):
         try:
-            return os.stat(self.pack_dir).st_mtime > self._pack_cache_time
+            return os.stat(self.pack_dir).st_mtime_ns > self._pack_cache_time
         except OSError as e:
             if e.errno == errno.ENOENT:
                 return True
@@ -429,24 +756,83 @@ class DiskObjectStore(PackBasedObjectStore):
         # Check from object dir
         return sha_to_filename(self.path, sha)
 
+    def _loose_dir(self, fanout, refresh=False):
+        """Return the cached listing of a loose object fan-out directory.
+
+        The listing is read again when the directory changed since it was
+        last read. Within loose_cache_ttl seconds of the last check it is
+        trusted without looking at the directory at all.
+
+        :param fanout: First two hex digits of the object SHAs
+        :param refresh: Always check whether the directory changed
+        :return: Set with the remaining hex digits of the objects in the
+            directory
+        """
+        now = time.time()
+        entry = self._loose_cache.get(fanout)
+        if (entry is not None and not refresh and
+                now - entry[2] < self.loose_cache_ttl):
+            return entry[1]
+        path = os.path.join(self.path, fanout)
+        try:
+            key = _stat_key(os.stat(path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            key = None
+        if entry is not None and entry[0] == key:
+            entry[2] = now
+            return entry[1]
+        names = set()
+        if key is not None:
+            for name in os.listdir(path):
+                # Skip lock and temporary files
+                if len(name) == 38:
+                    names.add(name)
+        self._loose_cache[fanout] = [key, names, now]
+        return names
+
+    def _loose_dir_changed(self, fanout):
+        """Record that this store changed a fan-out directory.
+
+        The cached listing is dropped rather than updated, since other
+        processes may have changed the directory at the same time; it is
+        read again on the next lookup.
+
+        :param fanout: First two hex digits of the object SHAs
+        """
+        self._loose_cache.pop(fanout, None)
+
     def _iter_loose_objects(self):
         for base in os.listdir(self.path):
             if len(base) != 2:
                 continue
-            for rest in os.listdir(os.path.join(self.path, base)):
+            for rest in list(self._loose_dir(base, refresh=True)):
                 yield Sha1Sum(base + rest)
 
+    def contains_loose(self, sha):
+        """Check if a particular object is present by SHA1 and is loose."""
+        hexsha = str(sha)
+        return hexsha[2:] in self._loose_dir(hexsha[:2])
+
     def _get_loose_object(self, sha):
+        hexsha = str(sha)
+        names = self._loose_dir(hexsha[:2])
+        if hexsha[2:] not in names:
+            return None
         path = self._get_shafile_path(sha)
         try:
             return ShaFile.from_path(path)
         except (OSError, IOError) as e:
             if e.errno == errno.ENOENT:
+                self._loose_dir_changed(hexsha[:2])
                 return None
             raise
 
     def _remove_loose_object(self, sha):
+        hexsha = str(sha)
         os.remove(self._get_shafile_path(sha))
+        self._loose_dir_changed(hexsha[:2])
 
     def _complete_thin_pack(self, f, path, copier, indexer):
         """Move a specific file containing a pack into the pack directory.
@@ -566,19 +952,93 @@ class DiskObjectStore(PackBasedObjectStore):
 
         :param obj: Object to add
         """
-        id = obj.id.string[:2]
-        dir = os.path.join(self.path, id)
+        if self.staging:
+            self._stage_objects([obj])
+            return
+        fanout = obj.id.string[:2]
+        rest = obj.id.string[2:]
+        names = self._loose_dir(fanout)
+        if rest in names:
+            return # Already there, no need to write again
+        dir = os.path.join(self.path, fanout)
         try:
             os.mkdir(dir)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
-        id = obj.id.string[2:]
-        path = os.path.join(dir, id)
-        if os.path.exists(path):
-            return # Already there, no need to write again
-        with GitFile(path, 'wb') as f:
+        with GitFile(os.path.join(dir, rest), 'wb') as f:
             f.write(obj.as_legacy_object())
+        self._loose_dir_changed(fanout)
+
+    def add_objects(self, objects):
+        """Add a set of objects to this object store.
+
+        :param objects: Iterable over (object, path) tuples, should support
+            __len__.
+        :return: Pack object of the objects written, or None if the objects
+            were staged
+        """
+        if self.staging:
+            self._stage_objects(obj for obj, path in objects)
+            return None
+        return super(DiskObjectStore, self).add_objects(objects)
+
+    def add_objects_loose(self, objects, fsync=False):
+        """Add a set of objects to this object store as loose objects.
+
+        All objects are written to temporary files first and then renamed
+        into place, so each fan-out directory is only changed and synced
+        once. Objects that are already present are skipped.
+
+        :param objects: Iterable over (object, path) tuples
+        :param fsync: Whether to sync the objects and directories to disk
+            before returning
+        :return: Number of objects written
+        """
+        # fan-out directory -> list of (temporary path, final name)
+        pending = {}
+        seen = set()
+        try:
+            for obj, path in objects:
+                fanout = obj.id.string[:2]
+                rest = obj.id.string[2:]
+                if obj.id.string in seen or rest in self._loose_dir(fanout):
+                    continue
+                seen.add(obj.id.string)
+                dir = os.path.join(self.path, fanout)
+                if fanout not in pending:
+                    try:
+                        os.mkdir(dir)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                    pending[fanout] = []
+                fd, tmp_path = _create_loose_temp(dir)
+                with os.fdopen(fd, 'wb') as f:
+                    pending[fanout].append((tmp_path, rest))
+                    f.write(obj.as_legacy_object())
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+        except:
+            for entries in pending.values():
+                for tmp_path, name in entries:
+                    os.remove(tmp_path)
+            raise
+        count = 0
+        for fanout, entries in pending.items():
+            dir = os.path.join(self.path, fanout)
+            for tmp_path, name in entries:
+                os.rename(tmp_path, os.path.join(dir, name))
+                count += 1
+            if fsync:
+                dir_fd = os.open(dir, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            self._loose_dir_changed(fanout)
+        return count
 
     @classmethod
     def init(cls, path):
@@ -649,6 +1109,20 @@ class MemoryObjectStore(BaseObjectStore):
         for obj, path in objects:
             self._add_obj(obj.id, obj)
 
+    def __reduce__(self):
+        # Objects keep hash state that cannot be pickled, so they are
+        # pickled as their raw text instead.
+        return (_unpickle_memory_object_store,
+                ([(obj.type_num, obj.as_raw_string())
+                  for obj in self._data.values()],))
+
+
+def _unpickle_memory_object_store(raw_objects):
+    store = MemoryObjectStore()
+    for type_num, text in raw_objects:
+        store.add_object(ShaFile.from_raw_string(type_num, text))
+    return store
+
 
 class ObjectImporter(object):
     """Interface for importing objects."""
@@ -785,9 +1259,22 @@ class MissingObjectFinder(object):
                        for name, mode, sha in tree.items()
                        if not S_ISGITLINK(mode)])
 
+    def _add_commit_todo(self, tree, parents):
+        self.add_todo([(tree, "", False)])
+        self.add_todo([(p, None, False) for p in parents])
+
     def parse_commit(self, commit):
-        self.add_todo([(commit.tree, "", False)])
-        self.add_todo([(p, None, False) for p in commit.parents])
+        self._add_commit_todo(commit.tree, commit.parents)
+
+    def parse_commit_text(self, text):
+        """Like parse_commit, but for the raw text of a commit.
+
+        Only the headers of the commit are parsed.
+
+        :param text: Raw text of the commit
+        """
+        tree, parents, _ = parse_commit_header(text)
+        self._add_commit_todo(tree, parents)
 
     def parse_tag(self, tag):
         self.add_todo([(tag.object[1], None, False)])
@@ -800,13 +1287,16 @@ class MissingObjectFinder(object):
             if sha not in self.sha_done:
                 break
         if not leaf:
-            o = self.object_store[sha]
-            if isinstance(o, Commit):
-                self.parse_commit(o)
-            elif isinstance(o, Tree):
-                self.parse_tree(o)
-            elif isinstance(o, Tag):
-                self.parse_tag(o)
+            type_num, text = self.object_store.get_raw(sha)
+            if type_num == Commit.type_num:
+                # Only the headers of commits are needed.
+                self.parse_commit_text(text)
+            else:
+                o = ShaFile.from_raw_string(type_num, text)
+                if isinstance(o, Tree):
+                    self.parse_tree(o)
+                elif isinstance(o, Tag):
+                    self.parse_tag(o)
         tagged = self._tagged()
         if sha in tagged:
             self.add_todo([(tagged[sha], None, True)])
@@ -465,6 +465,9 @@ class Sha1Sum(object):
         """
         return self.bytes >= _as_sha(other).bytes
 
+    def __reduce__(self):
+        return (Sha1Sum, (self.bytes,))
+
     def __hash__(self):
         """Get a hashed representation of this object. Since a Sha1Sum object
             is representing something which already *is* a hash, we'll just go
@@ -1354,6 +1357,44 @@ def parse_commit(text):
     return _parse_tag_or_commit(text)
 
 
+def parse_commit_header(text):
+    """Read the tree, parents and commit time of a commit.
+
+    Only the headers up to the committer are read, which is much cheaper
+    than parsing the whole commit.
+
+    :param text: The raw text of a commit object
+    :return: Tuple with the tree SHA, a list of parent SHAs and the commit
+        time
+    :raise ObjectFormatException: if the tree or committer is missing
+    """
+    tree = None
+    parents = []
+    start = 0
+    while True:
+        end = text.find(b'\n', start)
+        if end < 0:
+            end = len(text)
+        if end == start:
+            break
+        if text.startswith(b'tree ', start):
+            tree = Sha1Sum(text[start + 5:end])
+        elif text.startswith(b'parent ', start):
+            parents.append(Sha1Sum(text[start + 7:end]))
+        elif text.startswith(b'committer ', start):
+            if tree is None:
+                break
+            try:
+                commit_time = int(text[start:end].rsplit(b' ', 2)[1])
+            except (IndexError, ValueError):
+                raise ObjectFormatException('invalid committer')
+            return tree, parents, commit_time
+        start = end + 1
+    if tree is None:
+        raise ObjectFormatException('missing tree')
+    raise ObjectFormatException('missing committer')
+
+
 class Commit(ShaFile):
     """A git commit object"""
 
@@ -1539,8 +1580,13 @@ for cls in OBJECT_CLASSES:
 # Hold on to the pure-python implementations for testing
 _parse_tree_py = parse_tree
 _sorted_tree_items_py = sorted_tree_items
+_parse_commit_header_py = parse_commit_header
 try:
     # Try to import C versions
     from dulwich._objects import parse_tree, sorted_tree_items
 except ImportError:
     pass
+try:
+    from dulwich._objects import parse_commit_header
+except ImportError:
+    pass
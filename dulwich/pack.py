@@ -33,10 +33,16 @@ a pointer in to the corresponding packfile.
 from collections import defaultdict
 
 import binascii
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+    )
 from io import (
     BytesIO,
+    UnsupportedOperation,
     )
 from collections import (
+    OrderedDict,
     deque,
     )
 import difflib
@@ -52,9 +58,11 @@ else:
 import os
 import struct
 from struct import unpack_from
-from os import SEEK_CUR, SEEK_END
+from os import SEEK_END
 import sys
+import threading
 import warnings
+import weakref
 import zlib
 import hashlib
 
@@ -454,6 +462,10 @@ class FilePackIndex(PackIndex):
             self._file = file
         if contents is None:
             self._contents, self._size = _load_file_contents(self._file, size)
+            if file is None:
+                # The contents are mapped or read into memory, so the file
+                # is no longer needed.
+                self._file.close()
         else:
             self._contents, self._size = (contents, size)
 
@@ -965,10 +977,12 @@ class PackData(object):
         self._filename = filename
         self._size = size
         self._header_size = 12
+        # Whether the file can be closed by release_file() and opened again.
+        self._reopenable = file is None
         if file is None:
-            self._file = GitFile(self._filename, 'rb')
+            self._file_obj = GitFile(self._filename, 'rb')
         else:
-            self._file = file
+            self._file_obj = file
         (version, self._num_objects) = read_pack_header(self._file.read)
         self._offset_cache = LRUSizeCache(1024*1024*20,
             compute_size=_compute_object_size)
@@ -988,9 +1002,25 @@ class PackData(object):
     def from_path(cls, path):
         return cls(filename=path)
 
+    @property
+    def _file(self):
+        f = self._file_obj
+        if f is None:
+            f = self._file_obj = GitFile(self._filename, 'rb')
+        return f
+
     def close(self):
         self._file.close()
 
+    def release_file(self):
+        """Close the pack file until it is needed again.
+
+        Pack data created from a file object keeps its file open.
+        """
+        if self._reopenable and self._file_obj is not None:
+            f, self._file_obj = self._file_obj, None
+            f.close()
+
     def _get_size(self):
         if self._size is not None:
             return self._size
@@ -1057,28 +1087,33 @@ class PackData(object):
         return type, chunks
 
     def iterobjects(self, progress=None, compute_crc32=True):
-        self._file.seek(self._header_size)
+        # The offset is tracked here rather than by the file, which may be
+        # released and opened again while the caller holds the iterator.
+        offset = self._header_size
         for i in range(1, self._num_objects + 1):
-            offset = self._file.tell()
+            f = self._file
+            f.seek(offset)
             unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=compute_crc32)
+              f.read, compute_crc32=compute_crc32)
             if progress is not None:
                 progress(i, self._num_objects)
+            next_offset = f.tell() - len(unused)
             yield (offset, unpacked.pack_type_num, unpacked._obj(),
                    unpacked.crc32)
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            offset = next_offset
 
     def _iter_unpacked(self):
         # TODO(dborowitz): Merge this with iterobjects, if we can change its
         # return type.
-        self._file.seek(self._header_size)
+        offset = self._header_size
         for _ in range(self._num_objects):
-            offset = self._file.tell()
-            unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=False)
+            f = self._file
+            f.seek(offset)
+            unpacked, unused = unpack_object(f.read, compute_crc32=False)
             unpacked.offset = offset
+            next_offset = f.tell() - len(unused)
             yield unpacked
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            offset = next_offset
 
     def iterentries(self, progress=None):
         """Yield entries summarizing the contents of this pack.
@@ -1201,6 +1236,7 @@ class DeltaChainIterator(object):
 
     def __init__(self, file_obj, resolve_ext_ref=None):
         self._file = file_obj
+        self._pack_data = None
         self._resolve_ext_ref = resolve_ext_ref
         self._pending_ofs = defaultdict(list)
         self._pending_ref = defaultdict(list)
@@ -1229,7 +1265,8 @@ class DeltaChainIterator(object):
             self._full_ofs.append((offset, type_num))
 
     def set_pack_data(self, pack_data):
-        self._file = pack_data._file
+        # The file is looked up when needed, as the pack data may release it.
+        self._pack_data = pack_data
 
     def _walk_all_chains(self):
         for offset, type_num in self._full_ofs:
@@ -1268,9 +1305,13 @@ class DeltaChainIterator(object):
         return unpacked
 
     def _resolve_object(self, offset, obj_type_num, base_chunks):
-        self._file.seek(offset)
+        if self._pack_data is not None:
+            f = self._pack_data._file
+        else:
+            f = self._file
+        f.seek(offset)
         unpacked, _ = unpack_object(
-          self._file.read, include_comp=self._include_comp,
+          f.read, include_comp=self._include_comp,
           compute_crc32=self._compute_crc32)
         unpacked.offset = offset
         if base_chunks is None:
@@ -1414,23 +1455,38 @@ def pack_object_header(type_num, delta_base, size):
         header += delta_base
     return header
 
-def write_pack_object(f, type, object, sha=None):
+def write_pack_object(f, type, object, sha=None, compression_level=-1):
     """Write pack object to a file.
 
     :param f: File to write to
     :param type: Numeric type of the object
     :param object: Object to write
+    :param compression_level: zlib compression level, from 0 to 9 or -1 for
+        the zlib default
     :return: Tuple with offset at which the object was written, and crc32
     """
 
     if type in DELTA_TYPES:
         delta_base, object = object
-        if not isinstance(delta_base, int):
-            delta_base = bytes(delta_base)
     else:
         delta_base = None
-    header = pack_object_header(type, delta_base, len(object))
-    comp_data = zlib.compress(object)
+    return _write_compressed_object(f, type, delta_base, len(object),
+        zlib.compress(object, compression_level), sha=sha)
+
+
+def _write_compressed_object(f, type, delta_base, size, comp_data, sha=None):
+    """Write an object that has already been compressed to a pack file.
+
+    :param f: File to write to
+    :param type: Numeric type of the object
+    :param delta_base: Delta base offset or ref, or None for whole objects
+    :param size: Uncompressed size of the object
+    :param comp_data: Compressed object data
+    :return: crc32 of the data written
+    """
+    if delta_base is not None and not isinstance(delta_base, int):
+        delta_base = bytes(delta_base)
+    header = pack_object_header(type, delta_base, size)
     crc32 = 0
     for data in (header, comp_data):
         f.write(data)
@@ -1507,7 +1563,8 @@ def deltify_pack_objects(objects, window=10):
             possible_bases.pop()
 
 
-def write_pack_objects(f, objects, window=10, num_objects=None):
+def write_pack_objects(f, objects, window=10, num_objects=None,
+                       compression_level=-1, workers=None):
     """Write a new pack data file.
 
     :param f: File to write to
@@ -1516,6 +1573,8 @@ def write_pack_objects(f, objects, window=10, num_objects=None):
     :param window: Sliding window size for searching for deltas; currently
                    unimplemented
     :param num_objects: Number of objects (do not use, deprecated)
+    :param compression_level: zlib compression level
+    :param workers: Number of threads to compress objects on
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     if num_objects is None:
@@ -1524,15 +1583,30 @@ def write_pack_objects(f, objects, window=10, num_objects=None):
     pack_contents = (
         (o.type_num, o.sha().digest(), None, o.as_raw_string())
         for (o, path) in objects)
-    return write_pack_data(f, num_objects, pack_contents)
+    return write_pack_data(f, num_objects, pack_contents,
+        compression_level=compression_level, workers=workers)
+
 
+# Number of objects per worker that are compressed ahead of the writer
+_COMPRESS_AHEAD = 16
 
-def write_pack_data(f, num_records, records):
+
+def write_pack_data(f, num_records, records, compression_level=-1,
+                    workers=None):
     """Write a new pack data file.
 
+    With more than one worker, objects are compressed on a thread pool
+    while earlier objects are being written; zlib releases the GIL while it
+    compresses. The pack written is identical to the one written by a
+    single thread.
+
     :param f: File to write to
     :param num_records: Number of records
     :param records: Iterator over type_num, object_id, delta_base, raw
+    :param compression_level: zlib compression level, from 0 to 9 or -1 for
+        the zlib default
+    :param workers: Number of threads to compress objects on; None or 1
+        compresses them on the calling thread
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
 
@@ -1540,19 +1614,38 @@ def write_pack_data(f, num_records, records):
     entries = {}
     f = SHA1Writer(f)
     write_pack_header(f, num_records)
-    for type_num, object_id, delta_base, raw in records:
+
+    def write_record(type_num, object_id, delta_base, raw, comp_data):
         if delta_base is not None:
             try:
                 base_offset, base_crc32 = entries[delta_base]
             except KeyError:
                 type_num = REF_DELTA
-                raw = (delta_base, raw)
             else:
                 type_num = OFS_DELTA
-                raw = (base_offset, raw)
+                delta_base = base_offset
         offset = f.offset()
-        crc32 = write_pack_object(f, type_num, raw)
+        crc32 = _write_compressed_object(f, type_num, delta_base, len(raw),
+                                         comp_data)
         entries[object_id] = (offset, crc32)
+
+    if workers is None or workers <= 1:
+        for type_num, object_id, delta_base, raw in records:
+            write_record(type_num, object_id, delta_base, raw,
+                         zlib.compress(raw, compression_level))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for type_num, object_id, delta_base, raw in records:
+                record = (type_num, object_id, delta_base, raw)
+                pending.append((record, executor.submit(
+                    zlib.compress, raw, compression_level)))
+                if len(pending) >= workers * _COMPRESS_AHEAD:
+                    record, comp = pending.popleft()
+                    write_record(*(record + (comp.result(),)))
+            while pending:
+                record, comp = pending.popleft()
+                write_record(*(record + (comp.result(),)))
     return entries, f.write_sha()
 
 
@@ -1738,15 +1831,333 @@ def write_pack_index_v2(f, entries, pack_checksum):
     return f.write_sha()
 
 
+DEFAULT_MAX_OPEN_PACKS = 64
+DEFAULT_MAX_MAPPED_BYTES = 256 * 1024 * 1024
+
+
+class PackFileManager(object):
+    """Limit the files and memory held open by packs.
+
+    Packs report to the manager when they open their files. When more than
+    max_open_packs packs have their data file open, or the indexes of all
+    packs take up more than max_mapped_bytes, the files of the packs that
+    were opened least recently are closed. A closed pack opens its files
+    again the next time it is used.
+
+    The manager only holds weak references to packs, so it does not keep
+    packs that are no longer used alive.
+    """
+
+    def __init__(self, max_open_packs=DEFAULT_MAX_OPEN_PACKS,
+                 max_mapped_bytes=DEFAULT_MAX_MAPPED_BYTES):
+        """Create a new PackFileManager.
+
+        :param max_open_packs: Number of pack data files to keep open
+        :param max_mapped_bytes: Number of bytes of pack indexes to keep
+            mapped into memory
+        """
+        self.max_open_packs = max_open_packs
+        self.max_mapped_bytes = max_mapped_bytes
+        self._lock = threading.Lock()
+        # Weak references to the packs with open files, least recently
+        # opened first
+        self._packs = OrderedDict()
+
+    def _live_packs(self):
+        """Return the packs with open files, dropping collected ones."""
+        packs = []
+        for key, ref in list(self._packs.items()):
+            pack = ref()
+            if pack is None:
+                del self._packs[key]
+            else:
+                packs.append((key, pack))
+        return packs
+
+    def __len__(self):
+        with self._lock:
+            return len(self._live_packs())
+
+    def open_packs(self):
+        """Return the number of packs with an open data file."""
+        with self._lock:
+            return sum(1 for key, pack in self._live_packs()
+                       if pack._data is not None)
+
+    def mapped_bytes(self):
+        """Return the number of bytes taken up by open pack indexes."""
+        with self._lock:
+            return sum(pack._index_size() for key, pack in self._live_packs())
+
+    def touch(self, pack):
+        """Mark a pack as the most recently used one.
+
+        :param pack: A Pack
+        """
+        with self._lock:
+            try:
+                self._packs.move_to_end(id(pack))
+            except KeyError:
+                pass
+
+    def opened(self, pack):
+        """Record that a pack opened one of its files.
+
+        The packs opened least recently are closed if this takes the open
+        packs over one of the limits.
+
+        :param pack: A Pack
+        """
+        with self._lock:
+            self._packs[id(pack)] = weakref.ref(pack)
+            self._packs.move_to_end(id(pack))
+            packs = self._live_packs()
+            open_packs = 0
+            mapped_bytes = 0
+            for key, p in packs:
+                if p._data is not None:
+                    open_packs += 1
+                mapped_bytes += p._index_size()
+            evicted = []
+            for key, p in packs:
+                if (open_packs <= self.max_open_packs and
+                        mapped_bytes <= self.max_mapped_bytes):
+                    break
+                if p is pack:
+                    continue
+                if p._data is not None:
+                    open_packs -= 1
+                mapped_bytes -= p._index_size()
+                del self._packs[key]
+                evicted.append(p)
+        for p in evicted:
+            p._drop_files()
+
+    def closed(self, pack):
+        """Record that a pack closed its files.
+
+        :param pack: A Pack
+        """
+        with self._lock:
+            self._packs.pop(id(pack), None)
+
+
+default_pack_file_manager = PackFileManager()
+
+
+# Minimum number of objects checked by a single task in check_pack_objects
+_CHECK_BATCH_SIZE = 256
+
+
+def _object_header_at(contents, offset):
+    """Parse the header of the object at an offset in pack contents.
+
+    :return: Tuple with type number, uncompressed size, delta base (offset
+        relative to the object, 20-byte ref, or None) and offset of the
+        compressed data
+    """
+    c = contents[offset]
+    offset += 1
+    type_num = (c >> 4) & 0x07
+    size = c & 0x0f
+    shift = 4
+    while c & 0x80:
+        c = contents[offset]
+        offset += 1
+        size += (c & 0x7f) << shift
+        shift += 7
+    if type_num == OFS_DELTA:
+        c = contents[offset]
+        offset += 1
+        delta_base = c & 0x7f
+        while c & 0x80:
+            c = contents[offset]
+            offset += 1
+            delta_base += 1
+            delta_base <<= 7
+            delta_base += (c & 0x7f)
+    elif type_num == REF_DELTA:
+        delta_base = bytes(contents[offset:offset+20])
+        offset += 20
+    else:
+        delta_base = None
+    return type_num, size, delta_base, offset
+
+
+def _check_delta_chains(contents, shas, ends, children, ref_children, roots):
+    """Inflate and check the objects in a set of delta chains.
+
+    :param contents: Contents of the pack file
+    :param shas: Dictionary mapping object offsets to the SHAs the index
+        lists for them
+    :param ends: Dictionary mapping object offsets to the offset at which
+        the object ends
+    :param children: Dictionary mapping offsets to the offsets of the
+        objects that are deltas against them
+    :param ref_children: Dictionary mapping SHAs to the offsets of the
+        objects that are deltas against them
+    :param roots: Offsets of the full objects the chains start at
+    :return: Number of objects checked
+    :raise ChecksumMismatch: if an object does not match its SHA in the index
+    """
+    count = 0
+    stack = [(offset, None, None) for offset in reversed(roots)]
+    while stack:
+        offset, obj_type_num, base_chunks = stack.pop()
+        type_num, size, delta_base, data_offset = _object_header_at(
+            contents, offset)
+        decomp = zlib.decompress(contents[data_offset:ends[offset]])
+        if len(decomp) != size:
+            raise zlib.error('decompressed data does not match expected size')
+        if base_chunks is None:
+            obj_type_num = type_num
+            chunks = [decomp]
+        else:
+            chunks = apply_delta(base_chunks, [decomp])
+        obj = ShaFile.from_raw_chunks(obj_type_num, chunks)
+        obj.check()
+        if obj.id != shas[offset]:
+            raise ChecksumMismatch(str(shas[offset]), str(obj.id),
+                                   'object at offset %d' % offset)
+        count += 1
+        for child in chain(children.get(offset, ()),
+                           ref_children.get(obj.id, ())):
+            stack.append((child, obj_type_num, chunks))
+    return count
+
+
+def check_pack_objects(index, data, workers, progress=None):
+    """Check the objects in a pack on a pool of threads.
+
+    The pack is split by delta chain, so that every object is inflated
+    once, and the chains are checked in parallel. The checksum of the pack
+    data is verified at the same time. The first error found is raised
+    and the remaining work is cancelled.
+
+    :param index: PackIndex of the pack
+    :param data: PackData of the pack
+    :param workers: Number of threads to use
+    :param progress: Optional function called with the number of objects
+        checked so far and the total number of objects
+    :raise ChecksumMismatch: if the checksum of the data or an object is
+        wrong
+    :raise ObjectFormatException: if an object is malformed
+    :raise KeyError: if a delta base is missing from the pack
+    :raise ApplyDeltaError: if the base of a delta is not an object in the
+        pack, or delta chains form a cycle
+    """
+    f = data._file
+    try:
+        contents, size = _load_file_contents(f)
+    except UnsupportedOperation:
+        f.seek(0)
+        contents = f.read()
+        size = len(contents)
+    try:
+        entries = sorted((offset, sha) for sha, offset, crc32
+                         in index.iterentries())
+        num_objects = len(entries)
+        shas = {}
+        ends = {}
+        for i, (offset, sha) in enumerate(entries):
+            shas[offset] = Sha1Sum(sha)
+            if i + 1 < num_objects:
+                ends[offset] = entries[i + 1][0]
+            else:
+                ends[offset] = size - 20
+        ref_bases = set(shas.values())
+        roots = []
+        children = defaultdict(list)
+        ref_children = defaultdict(list)
+        missing = []
+        for offset, sha in entries:
+            type_num, _, delta_base, _ = _object_header_at(contents, offset)
+            if type_num == OFS_DELTA:
+                base_offset = offset - delta_base
+                if base_offset not in shas:
+                    raise ApplyDeltaError(
+                        'delta %s at offset %d is based on offset %d, which '
+                        'is not an object in the pack' %
+                        (shas[offset], offset, base_offset))
+                children[base_offset].append(offset)
+            elif type_num == REF_DELTA:
+                base_sha = Sha1Sum(delta_base)
+                if base_sha not in ref_bases:
+                    missing.append(delta_base)
+                ref_children[base_sha].append(offset)
+            else:
+                roots.append(offset)
+        if missing:
+            raise KeyError(missing)
+
+        # Group the chains into tasks of at least _CHECK_BATCH_SIZE objects
+        tasks = []
+        task = []
+        task_size = 0
+        reached = set()
+        for root in roots:
+            task.append(root)
+            stack = [root]
+            while stack:
+                offset = stack.pop()
+                task_size += 1
+                reached.add(offset)
+                stack.extend(children.get(offset, ()))
+                stack.extend(ref_children.get(shas[offset], ()))
+            if task_size >= _CHECK_BATCH_SIZE:
+                tasks.append(task)
+                task = []
+                task_size = 0
+        if task:
+            tasks.append(task)
+        if len(reached) != num_objects:
+            # The remaining deltas are based on each other in a cycle
+            offset = min(offset for offset in shas if offset not in reached)
+            raise ApplyDeltaError(
+                'delta chain of object %s at offset %d does not lead to a '
+                'full object' % (shas[offset], offset))
+
+        checked = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(data.check)]
+            futures.extend(
+                executor.submit(_check_delta_chains, contents, shas, ends,
+                                children, ref_children, task)
+                for task in tasks)
+            try:
+                for future in as_completed(futures):
+                    count = future.result()
+                    if count is not None:
+                        checked += count
+                        if progress is not None:
+                            progress(checked, num_objects)
+            except:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        if has_mmap and isinstance(contents, mmap.mmap):
+            contents.close()
+
+
 class Pack(object):
     """A Git pack object."""
 
-    def __init__(self, basename):
+    def __init__(self, basename, file_manager=None):
+        """Create a new Pack.
+
+        :param basename: Path of the pack files, without extension
+        :param file_manager: PackFileManager that limits the files held open
+            by this pack; defaults to default_pack_file_manager
+        """
         self._basename = basename
         self._data = None
         self._idx = None
         self._idx_path = self._basename + '.idx'
         self._data_path = self._basename + '.pack'
+        if file_manager is None:
+            file_manager = default_pack_file_manager
+        self._file_manager = file_manager
 
         self._data_load = lambda: PackData(self._data_path)
         self._idx_load = lambda: load_pack_index(self._idx_path)
@@ -1781,11 +2192,14 @@ class Pack(object):
     @property
     def data(self):
         """The pack data object being used."""
-        if self._data is None:
-            self._data = self._data_load()
-            self._data.pack = self
+        data = self._data
+        if data is None:
+            data = self._data_load()
+            data.pack = self
+            self._data = data
             self.check_length_and_checksum()
-        return self._data
+            self._file_manager.opened(self)
+        return data
 
     @property
     def index(self):
@@ -1793,15 +2207,40 @@ class Pack(object):
 
         :note: This may be an in-memory index
         """
-        if self._idx is None:
-            self._idx = self._idx_load()
-        return self._idx
+        idx = self._idx
+        if idx is None:
+            idx = self._idx = self._idx_load()
+            self._file_manager.opened(self)
+        return idx
+
+    def _index_size(self):
+        """Return the number of bytes taken up by the index, if it is open."""
+        idx = self._idx
+        if idx is None:
+            return 0
+        return getattr(idx, '_size', 0)
+
+    def _drop_files(self):
+        """Close the data and index; they are loaded again when needed.
+
+        Iterators over the data that are still in use open the pack file
+        again. The index is not closed, as iterators and other threads may
+        still be reading it; its mapping is released once they are done
+        with it.
+        """
+        data, self._data = self._data, None
+        self._idx = None
+        if data is not None:
+            data.release_file()
 
     def close(self):
+        self._file_manager.closed(self)
         if self._data is not None:
             self._data.close()
             self._data = None
-        self.index.close()
+        if self._idx is not None:
+            self._idx.close()
+            self._idx = None
 
     def __eq__(self, other):
         return type(self) == type(other) and self.index == other.index
@@ -1827,15 +2266,26 @@ class Pack(object):
             raise ChecksumMismatch(str(Sha1Sum(idx_stored_checksum)),
                                    str(Sha1Sum(data_stored_checksum)))
 
-    def check(self):
+    def check(self, workers=None, progress=None):
         """Check the integrity of this pack.
 
+        :param workers: Number of threads to check the objects on; None or 1
+            checks them on the calling thread
+        :param progress: Optional function called with the number of objects
+            checked so far and the total number of objects
         :raise ChecksumMismatch: if a checksum for the index or data is wrong
         """
         self.index.check()
+        if workers is not None and workers > 1:
+            check_pack_objects(self.index, self.data, workers,
+                               progress=progress)
+            return
         self.data.check()
-        for obj in self.iterobjects():
+        num_objects = len(self.data)
+        for i, obj in enumerate(self.iterobjects()):
             obj.check()
+            if progress is not None:
+                progress(i + 1, num_objects)
         # TODO: object connectivity checks
 
     def get_stored_checksum(self):
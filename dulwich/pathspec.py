@@ -0,0 +1,261 @@
+# pathspec.py -- Matching paths against sets of path patterns
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Matching paths against sets of path patterns.
+
+A pattern is a /-separated path. It matches that path and everything below
+it. Components of a pattern may contain the shell wildcards ``*``, ``?`` and
+``[...]``, which match within a single component only.
+
+Functions that take a set of paths only apply wildcards when they are given
+a PathSpec; any other iterable of paths is matched literally, see
+as_pathspec.
+
+The patterns are kept in a trie over path components, so matching a path
+takes time proportional to its depth rather than to the number of patterns.
+"""
+
+import fnmatch
+import re
+
+MATCH_NONE = 0
+MATCH_LEADING = 1
+MATCH = 2
+
+_GLOB_CHARS = re.compile(b'[*?[]')
+
+
+def _split(pattern):
+    pattern = pattern.strip(b'/')
+    if not pattern:
+        return []
+    return pattern.split(b'/')
+
+
+def _is_glob(component):
+    return _GLOB_CHARS.search(component) is not None
+
+
+def literal_prefix(pattern):
+    """Find the part of a pattern before its first wildcard component.
+
+    :param pattern: A path pattern
+    :return: The leading components of the pattern that contain no
+        wildcards, joined by /
+    """
+    prefix = []
+    for component in _split(pattern):
+        if _is_glob(component):
+            break
+        prefix.append(component)
+    return b'/'.join(prefix)
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'globs', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        # List of (component, compiled regex, child node) tuples
+        self.globs = []
+        self.terminal = False
+
+    def is_empty(self):
+        return not (self.children or self.globs or self.terminal)
+
+
+def as_pathspec(paths):
+    """Convert a set of paths to a PathSpec.
+
+    :param paths: A PathSpec, which is returned as is, or an iterable of
+        paths, which are matched literally
+    :return: A PathSpec
+    """
+    if isinstance(paths, PathSpec):
+        return paths
+    return PathSpec(paths, globs=False)
+
+
+class PathSpec(object):
+    """A set of path patterns that paths can be matched against."""
+
+    def __init__(self, patterns=(), globs=True):
+        """Create a new PathSpec.
+
+        :param patterns: Iterable of path patterns
+        :param globs: If False, wildcards in the patterns are matched
+            literally
+        """
+        self.globs = globs
+        self._root = _Node()
+        self._patterns = set()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def _is_glob(self, component):
+        return self.globs and _is_glob(component)
+
+    def literal_prefix(self, pattern):
+        """Find the part of a pattern before its first wildcard component.
+
+        :param pattern: A path pattern
+        :return: The leading components of the pattern that contain no
+            wildcards, joined by /
+        """
+        if not self.globs:
+            return b'/'.join(_split(pattern))
+        return literal_prefix(pattern)
+
+    def copy(self):
+        """Return a copy of this PathSpec."""
+        return PathSpec(self._patterns, globs=self.globs)
+
+    def add(self, pattern):
+        """Add a pattern.
+
+        :param pattern: A path pattern
+        """
+        if pattern in self._patterns:
+            return
+        self._patterns.add(pattern)
+        node = self._root
+        for component in _split(pattern):
+            if self._is_glob(component):
+                for glob, regex, child in node.globs:
+                    if glob == component:
+                        break
+                else:
+                    regex = re.compile(fnmatch.translate(
+                        component.decode('latin-1')).encode('latin-1'),
+                        re.DOTALL)
+                    child = _Node()
+                    node.globs.append((component, regex, child))
+            else:
+                child = node.children.get(component)
+                if child is None:
+                    child = node.children[component] = _Node()
+            node = child
+        node.terminal = True
+
+    def remove(self, pattern):
+        """Remove a pattern.
+
+        :param pattern: A path pattern that was added before
+        :raise KeyError: If the pattern was not added
+        """
+        self._patterns.remove(pattern)
+        path = []
+        node = self._root
+        for component in _split(pattern):
+            if self._is_glob(component):
+                for i, (glob, regex, child) in enumerate(node.globs):
+                    if glob == component:
+                        break
+            else:
+                i = None
+                child = node.children[component]
+            path.append((node, component, i))
+            node = child
+        node.terminal = False
+        # Prune the nodes that no longer lead to any pattern.
+        while path and node.is_empty():
+            node, component, i = path.pop()
+            if i is None:
+                del node.children[component]
+            else:
+                del node.globs[i]
+
+    def __iter__(self):
+        return iter(self._patterns)
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __contains__(self, pattern):
+        return pattern in self._patterns
+
+    def __repr__(self):
+        if not self.globs:
+            return '%s(%r, globs=False)' % (type(self).__name__,
+                                            sorted(self._patterns))
+        return '%s(%r)' % (type(self).__name__, sorted(self._patterns))
+
+    def start(self):
+        """Start matching a path one component at a time.
+
+        :return: A tuple of the MATCH_* constant for the empty path and the
+            state to pass to step()
+        """
+        if self._root.terminal:
+            return MATCH, None
+        return MATCH_LEADING, [self._root]
+
+    def step(self, state, component):
+        """Match the next component of a path.
+
+        :param state: State returned by start() or an earlier step() for
+            the parent path; must not be None
+        :param component: The next component of the path
+        :return: A tuple of the MATCH_* constant for the path so far and the
+            state for matching its children, which is None unless the
+            result is MATCH_LEADING
+        """
+        next_state = []
+        for node in state:
+            child = node.children.get(component)
+            if child is not None:
+                if child.terminal:
+                    return MATCH, None
+                next_state.append(child)
+            for glob, regex, child in node.globs:
+                if regex.match(component):
+                    if child.terminal:
+                        return MATCH, None
+                    next_state.append(child)
+        if not next_state:
+            return MATCH_NONE, None
+        return MATCH_LEADING, next_state
+
+    def match(self, path):
+        """Match a path.
+
+        :param path: A /-separated path
+        :return: MATCH if the path matches one of the patterns,
+            MATCH_LEADING if it is a directory that may contain matching
+            paths, and MATCH_NONE otherwise
+        """
+        result, state = self.start()
+        if result != MATCH_LEADING:
+            return result
+        for component in _split(path):
+            result, state = self.step(state, component)
+            if result != MATCH_LEADING:
+                return result
+        return result
+
+    def matches(self, path):
+        """Check whether a path matches one of the patterns.
+
+        :param path: A /-separated path, or None
+        :return: True if the path or one of its parent directories matches
+        """
+        if path is None:
+            return False
+        return self.match(path) == MATCH
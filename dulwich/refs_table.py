@@ -0,0 +1,492 @@
+# refs_table.py -- Sorted binary storage for large numbers of refs
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Sorted, block-indexed binary storage for refs.
+
+A refs table keeps all refs of a repository, including HEAD, in a single
+file sorted by ref name. Records are grouped in blocks of roughly equal size
+and an index of the first name in each block is kept at the end of the file,
+so looking up a single ref only has to read the index and one block, and
+listing the refs under a prefix takes O(log n + k). Updates rewrite the
+table to a lock file that is renamed into place, so a batch of updates is
+applied atomically.
+
+File layout (all integers are big endian):
+
+  header  "DRTB", version (4 bytes), block size (4 bytes)
+  blocks  records sorted by name
+  record  name length (2 bytes), name, type (1 byte) and a value:
+          REF_VALUE: 20 byte SHA1
+          REF_VALUE_PEELED: 20 byte SHA1, 20 byte peeled SHA1
+          REF_SYMBOLIC: target length (2 bytes), target
+  index   for each block: offset (8 bytes), first name length (2 bytes),
+          first name
+  footer  index offset (8 bytes), number of blocks (4 bytes), number of
+          records (4 bytes), SHA1 of everything before it
+
+Repositories that use a refs table can not be read by C git.
+"""
+
+from bisect import bisect_right
+import errno
+import hashlib
+import os
+import struct
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    FileFormatException,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import Sha1Sum
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    )
+from dulwich.protocol import ZERO_SHA
+from dulwich.repo import (
+    RefsContainer,
+    SYMREF,
+    _ref_matches,
+    )
+
+REFS_TABLE_FILENAME = 'refs.table'
+REFS_TABLE_SIGNATURE = b'DRTB'
+REFS_TABLE_VERSION = 1
+DEFAULT_BLOCK_SIZE = 4096
+
+REF_VALUE = 1
+REF_VALUE_PEELED = 2
+REF_SYMBOLIC = 3
+
+_HEADER = struct.Struct('>4sLL')
+_FOOTER = struct.Struct('>QLL')
+_NAME_LENGTH = struct.Struct('>H')
+_INDEX_ENTRY = struct.Struct('>QH')
+
+
+def _pack_record(name, value, peeled):
+    data = _NAME_LENGTH.pack(len(name)) + name
+    if isinstance(value, Sha1Sum):
+        if peeled is None:
+            return data + bytes([REF_VALUE]) + value.bytes
+        return data + bytes([REF_VALUE_PEELED]) + value.bytes + peeled.bytes
+    target = value[len(SYMREF):]
+    return (data + bytes([REF_SYMBOLIC]) + _NAME_LENGTH.pack(len(target)) +
+            target)
+
+
+def write_refs_table(f, entries, block_size=DEFAULT_BLOCK_SIZE):
+    """Write a refs table.
+
+    :param f: File-like object to write to
+    :param entries: Iterable over (name, value, peeled) tuples, sorted by
+        name. value is a Sha1Sum, or SYMREF followed by the target name for
+        symbolic refs. peeled is a Sha1Sum or None if not known.
+    :param block_size: Target size of the blocks
+    :return: Binary SHA1 of the table
+    """
+    f = SHA1Writer(f)
+    f.write(_HEADER.pack(REFS_TABLE_SIGNATURE, REFS_TABLE_VERSION,
+                         block_size))
+    index = []
+    block_length = 0
+    num_records = 0
+    last_name = None
+    for name, value, peeled in entries:
+        if last_name is not None and name <= last_name:
+            raise ValueError('refs not sorted: %r after %r' % (name, last_name))
+        last_name = name
+        record = _pack_record(name, value, peeled)
+        if not index or block_length + len(record) > block_size:
+            index.append((f.offset(), name))
+            block_length = 0
+        f.write(record)
+        block_length += len(record)
+        num_records += 1
+    index_offset = f.offset()
+    for offset, name in index:
+        f.write(_INDEX_ENTRY.pack(offset, len(name)) + name)
+    f.write(_FOOTER.pack(index_offset, len(index), num_records))
+    return f.write_sha()
+
+
+class RefsTable(object):
+    """A refs table file."""
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        """Open a refs table.
+
+        :param filename: Path of the table
+        :param file: Optional file-like object to read from
+        :param contents: Optional contents of the table
+        :param size: Size of contents
+        """
+        self._filename = filename
+        if contents is None:
+            if file is None:
+                file = GitFile(filename, 'rb')
+            try:
+                contents, size = _load_file_contents(file, size)
+            finally:
+                file.close()
+        self._contents = contents
+        self._size = size
+        if size < _HEADER.size + _FOOTER.size + 20:
+            raise FileFormatException('%s: table too short' % filename)
+        signature, version, self.block_size = _HEADER.unpack_from(contents)
+        if signature != REFS_TABLE_SIGNATURE:
+            raise FileFormatException('%s: invalid signature %r' % (
+                filename, signature))
+        if version != REFS_TABLE_VERSION:
+            raise FileFormatException('%s: unsupported version %d' % (
+                filename, version))
+        (self._index_offset, num_blocks,
+         self._num_records) = _FOOTER.unpack_from(contents,
+                                                  size - 20 - _FOOTER.size)
+        self._block_offsets = []
+        self._block_names = []
+        offset = self._index_offset
+        for i in range(num_blocks):
+            block_offset, name_length = _INDEX_ENTRY.unpack_from(contents,
+                                                                 offset)
+            offset += _INDEX_ENTRY.size
+            self._block_offsets.append(block_offset)
+            self._block_names.append(bytes(contents[offset:offset+name_length]))
+            offset += name_length
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._filename)
+
+    def __len__(self):
+        """Return the number of refs in the table."""
+        return self._num_records
+
+    def close(self):
+        if getattr(self._contents, 'close', None) is not None:
+            self._contents.close()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 stored at the end of the table."""
+        return bytes(self._contents[-20:])
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 of the table contents."""
+        return hashlib.sha1(self._contents[:-20]).digest()
+
+    def check(self):
+        """Check the integrity of the table.
+
+        :raise ChecksumMismatch: if the table is corrupt
+        """
+        stored = self.get_stored_checksum()
+        actual = self.calculate_checksum()
+        if stored != actual:
+            raise ChecksumMismatch(stored, actual)
+
+    def _iter_block(self, i):
+        """Iterate over the records in a block.
+
+        :param i: Index of the block
+        :return: Iterator over (name, value, peeled) tuples
+        """
+        contents = self._contents
+        offset = self._block_offsets[i]
+        if i + 1 < len(self._block_offsets):
+            end = self._block_offsets[i + 1]
+        else:
+            end = self._index_offset
+        while offset < end:
+            (name_length,) = _NAME_LENGTH.unpack_from(contents, offset)
+            offset += _NAME_LENGTH.size
+            name = bytes(contents[offset:offset+name_length])
+            offset += name_length
+            kind = contents[offset]
+            offset += 1
+            peeled = None
+            if kind == REF_VALUE:
+                value = Sha1Sum(bytes(contents[offset:offset+20]))
+                offset += 20
+            elif kind == REF_VALUE_PEELED:
+                value = Sha1Sum(bytes(contents[offset:offset+20]))
+                peeled = Sha1Sum(bytes(contents[offset+20:offset+40]))
+                offset += 40
+            elif kind == REF_SYMBOLIC:
+                (target_length,) = _NAME_LENGTH.unpack_from(contents, offset)
+                offset += _NAME_LENGTH.size
+                value = SYMREF + bytes(contents[offset:offset+target_length])
+                offset += target_length
+            else:
+                raise FileFormatException('%s: unknown record type %d' % (
+                    self._filename, kind))
+            yield name, value, peeled
+
+    def _find_block(self, name):
+        """Return the index of the block that would contain a name."""
+        return max(bisect_right(self._block_names, name) - 1, 0)
+
+    def get(self, name):
+        """Look up a ref.
+
+        :param name: Name of the ref
+        :return: Tuple with (name, value, peeled), or None if the ref does not
+            exist
+        """
+        if not self._block_offsets:
+            return None
+        for entry in self._iter_block(self._find_block(name)):
+            if entry[0] == name:
+                return entry
+            if entry[0] > name:
+                break
+        return None
+
+    def iter_prefix(self, prefix):
+        """Iterate over the refs whose name starts with a prefix, in order.
+
+        :param prefix: Prefix of the ref names
+        :return: Iterator over (name, value, peeled) tuples
+        """
+        if not self._block_offsets:
+            return
+        for i in range(self._find_block(prefix), len(self._block_offsets)):
+            for entry in self._iter_block(i):
+                if entry[0].startswith(prefix):
+                    yield entry
+                elif entry[0] > prefix:
+                    return
+
+    def __iter__(self):
+        """Iterate over all refs, in order."""
+        return self.iter_prefix(b'')
+
+
+def _merge_entries(entries, changes):
+    """Apply a set of changes to a sorted iterable of table entries.
+
+    :param entries: Iterable over sorted (name, value, peeled) tuples
+    :param changes: Dictionary mapping names to (value, peeled) tuples; a
+        value of None removes the ref
+    :return: Iterator over the resulting sorted (name, value, peeled) tuples
+    """
+    pending = sorted(changes.items(), reverse=True)
+    for entry in entries:
+        while pending and pending[-1][0] <= entry[0]:
+            name, (value, peeled) = pending.pop()
+            if value is not None:
+                yield name, value, peeled
+            if name == entry[0]:
+                break
+        else:
+            yield entry
+    while pending:
+        name, (value, peeled) = pending.pop()
+        if value is not None:
+            yield name, value, peeled
+
+
+class RefsTableContainer(RefsContainer):
+    """Refs container that keeps all refs in a single refs table.
+
+    The table is reopened whenever it is replaced, so changes made by other
+    processes are picked up.
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        """Create a new RefsTableContainer.
+
+        :param path: Control directory of the repository
+        :param block_size: Target size of the blocks when writing the table
+        """
+        self.path = path
+        self.block_size = block_size
+        self._filename = os.path.join(path, REFS_TABLE_FILENAME)
+        self._table = None
+        self._table_stat = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    @classmethod
+    def create(cls, path, refs, peeled=None, block_size=DEFAULT_BLOCK_SIZE):
+        """Create a refs table from a set of refs.
+
+        An existing table is replaced.
+
+        :param path: Control directory of the repository
+        :param refs: Dictionary mapping ref names to SHA1s or, for symbolic
+            refs, SYMREF followed by the target name
+        :param peeled: Optional dictionary mapping ref names to peeled SHA1s
+        :param block_size: Target size of the blocks
+        :return: A RefsTableContainer for the new table
+        """
+        ret = cls(path, block_size=block_size)
+        if peeled is None:
+            peeled = {}
+        with GitFile(ret._filename, 'wb') as f:
+            write_refs_table(
+                f, ((name, refs[name], peeled.get(name))
+                    for name in sorted(refs)),
+                block_size)
+        return ret
+
+    def _get_table(self):
+        """Return the current table, reopening it if it was replaced.
+
+        :return: A RefsTable, or None if there is no table yet
+        """
+        try:
+            st = os.stat(self._filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            stat = None
+        else:
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stat != self._table_stat:
+            # Iterators over the old table may still be in use, so leave
+            # closing it to the garbage collector.
+            if stat is None:
+                self._table = None
+            else:
+                self._table = RefsTable(self._filename)
+            self._table_stat = stat
+        return self._table
+
+    def get_state(self):
+        self._get_table()
+        return (self._generation, self._table_stat)
+
+    def _iter_prefix(self, prefix):
+        table = self._get_table()
+        if table is None:
+            return iter([])
+        return table.iter_prefix(prefix)
+
+    def allkeys(self):
+        return set(name for name, _, _ in self._iter_prefix(b''))
+
+    def subkeys(self, base):
+        prefix = base.rstrip(b'/') + b'/'
+        return set(name[len(prefix):] for name, _, _ in
+                   self._iter_prefix(prefix))
+
+    def as_dict(self, base=None):
+        if base is None:
+            prefix = b''
+        else:
+            prefix = base.rstrip(b'/') + b'/'
+        ret = {}
+        for name, value, _ in self._iter_prefix(prefix):
+            if not isinstance(value, Sha1Sum):
+                try:
+                    value = self[name]
+                except KeyError:
+                    continue # Unable to resolve
+            ret[name[len(prefix):]] = value
+        return ret
+
+    def get_packed_refs(self):
+        return {}
+
+    def read_loose_ref(self, name):
+        table = self._get_table()
+        if table is None:
+            return None
+        entry = table.get(name)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def get_peeled(self, name):
+        table = self._get_table()
+        if table is None:
+            return None
+        entry = table.get(name)
+        if entry is None:
+            return None
+        return entry[2]
+
+    def update_refs(self, updates, peeled=None):
+        """Apply a set of updates as a unit.
+
+        The whole table is rewritten to a lock file that is renamed into
+        place, so either all updates are applied or none of them are.
+
+        :param updates: Dictionary mapping ref names to (old_ref, new_ref)
+            tuples; see RefsContainer.update_refs.
+        :param peeled: Optional dictionary mapping ref names to the peeled
+            values of their new SHA1s
+        :return: True if the updates were applied, False if the old value of
+            any ref did not match
+        """
+        if peeled is None:
+            peeled = {}
+        changes = {}
+        for name, (old_ref, new_ref) in updates.items():
+            self._check_refname(name)
+            if new_ref == ZERO_SHA:
+                changes[name] = (None, None)
+            elif isinstance(new_ref, Sha1Sum):
+                changes[name] = (new_ref, peeled.get(name))
+            else:
+                if not new_ref.startswith(SYMREF):
+                    raise ValueError('invalid ref value %r' % new_ref)
+                self._check_refname(new_ref[len(SYMREF):])
+                changes[name] = (new_ref, None)
+        f = GitFile(self._filename, 'wb')
+        try:
+            # read the table again while holding the lock
+            table = self._get_table()
+            for name, (old_ref, new_ref) in updates.items():
+                if old_ref is None:
+                    continue
+                entry = None if table is None else table.get(name)
+                if not _ref_matches(entry and entry[1], old_ref):
+                    return False
+            write_refs_table(f, _merge_entries(table or [], changes),
+                             self.block_size)
+            f.close()
+        finally:
+            f.abort()
+        self._changed()
+        return True
+
+    def set_symbolic_ref(self, name, other):
+        self.update_refs({name: (None, SYMREF + other)})
+
+    def set_if_equals(self, name, old_ref, new_ref):
+        self._check_refname(name)
+        try:
+            realname, _ = self._follow(name)
+        except KeyError:
+            realname = name
+        return self.update_refs({realname: (old_ref, new_ref)})
+
+    def add_if_new(self, name, ref):
+        try:
+            realname, contents = self._follow(name)
+            if contents is not None:
+                return False
+        except KeyError:
+            realname = name
+        return self.update_refs({realname: (ZERO_SHA, ref)})
+
+    def remove_if_equals(self, name, old_ref):
+        return self.update_refs({name: (old_ref, ZERO_SHA)})
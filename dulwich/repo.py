@@ -45,6 +45,9 @@ from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
     )
+from dulwich.pack import (
+    _load_file_contents,
+    )
 from dulwich.objects import (
     Blob,
     Commit,
@@ -53,6 +56,7 @@ from dulwich.objects import (
     Tree,
     Sha1Sum,
     )
+from dulwich.protocol import ZERO_SHA
 import warnings
 
 OBJECTDIR = 'objects'
@@ -61,6 +65,7 @@ REFSDIR = 'refs'
 REFSDIR_TAGS = 'tags'
 REFSDIR_HEADS = 'heads'
 INDEX_FILENAME = "index"
+PACKED_REFS_HEADER = b'# pack-refs with:'
 
 BASE_DIRECTORIES = [
     ["branches"],
@@ -111,9 +116,95 @@ def check_ref_format(refname):
     return True
 
 
+def _ref_matches(ref, old_ref):
+    """Check whether a ref has the value expected by an update.
+
+    :param ref: Current value of the ref, or None if it does not exist
+    :param old_ref: Expected value; ZERO_SHA if the ref must not exist or
+        None if any value is acceptable
+    """
+    if old_ref is None:
+        return True
+    if old_ref == ZERO_SHA:
+        return ref is None
+    return ref is not None and ref == old_ref
+
+
+def _ref_contents(ref):
+    """Return the contents of a ref file for a SHA1 or symbolic ref."""
+    if isinstance(ref, Sha1Sum):
+        return ref.hex_bytes + b'\n'
+    if not ref.startswith(SYMREF):
+        raise ValueError('invalid ref value %r' % ref)
+    return ref + b'\n'
+
+
+class RefsTransaction(object):
+    """A set of ref updates that is applied as a unit.
+
+    Updates are collected with set() and remove(), and applied by commit():
+    either all of them are applied, or none are.
+    """
+
+    def __init__(self, refs):
+        self.refs = refs
+        self.updates = {}
+
+    def set(self, name, new_ref, old_ref=None):
+        """Set a ref.
+
+        This follows symbolic references.
+
+        :param name: The refname to set
+        :param new_ref: The new sha the refname will refer to
+        :param old_ref: The old sha the refname must refer to, ZERO_SHA if
+            it must not exist, or None to set it unconditionally
+        """
+        try:
+            realname, _ = self.refs._follow(name)
+        except KeyError:
+            realname = name
+        self.updates[realname] = (old_ref, new_ref)
+
+    def remove(self, name, old_ref=None):
+        """Remove a ref.
+
+        This does not follow symbolic references.
+
+        :param name: The refname to remove
+        :param old_ref: The old sha the refname must refer to, or None to
+            remove it unconditionally
+        """
+        self.updates[name] = (old_ref, ZERO_SHA)
+
+    def commit(self):
+        """Apply the updates.
+
+        :return: True if the updates were applied, False if any ref did not
+            have its expected old value, in which case nothing was changed
+        """
+        return self.refs.update_refs(self.updates)
+
+
 class RefsContainer(object):
     """A container for refs."""
 
+    # Number of changes made through this container.
+    _generation = 0
+
+    def _changed(self):
+        """Record that the refs in this container have changed."""
+        self._generation += 1
+
+    def get_state(self):
+        """Return a value that changes whenever the refs change.
+
+        This can be used to check whether data derived from the refs is still
+        current. Changes made through this container are always reflected;
+        subclasses may also detect changes made by other processes.
+        """
+        return self._generation
+
     def set_ref(self, name, other):
         warnings.warn("RefsContainer.set_ref() is deprecated."
             "Use set_symblic_ref instead.",
@@ -149,8 +240,47 @@ class RefsContainer(object):
         return None
 
     def import_refs(self, base, other):
+        transaction = self.transaction()
         for name, value in other.items():
-            self[base + b'/' + name] = value
+            transaction.set(base + b'/' + name, value)
+        transaction.commit()
+
+    def transaction(self):
+        """Start a set of ref updates that is applied as a unit.
+
+        :return: A RefsTransaction
+        """
+        return RefsTransaction(self)
+
+    def update_refs(self, updates):
+        """Apply a set of updates as a unit.
+
+        Symbolic references are not followed.
+
+        :param updates: Dictionary mapping ref names to (old_ref, new_ref)
+            tuples. old_ref is the value the ref must currently have,
+            ZERO_SHA if the ref must not exist or None to update the ref
+            unconditionally. new_ref is the new SHA1, SYMREF followed by a
+            ref name to make the ref symbolic, or ZERO_SHA to remove the ref.
+        :return: True if the updates were applied, False if the old value of
+            any ref did not match
+        :note: This implementation checks all old values before making any
+            changes, but does not keep other writers out while it applies
+            them. Subclasses should override it.
+        """
+        for name in updates:
+            self._check_refname(name)
+        for name, (old_ref, new_ref) in updates.items():
+            if not _ref_matches(self.read_ref(name), old_ref):
+                return False
+        for name, (old_ref, new_ref) in updates.items():
+            if new_ref == ZERO_SHA:
+                self.remove_if_equals(name, None)
+            elif isinstance(new_ref, Sha1Sum):
+                self.set_if_equals(name, None, new_ref)
+            else:
+                self.set_symbolic_ref(name, new_ref[len(SYMREF):])
+        return True
 
     def allkeys(self):
         """All refs present in this container."""
@@ -358,6 +488,7 @@ class DictRefsContainer(RefsContainer):
 
     def set_symbolic_ref(self, name, other):
         self._refs[name] = SYMREF + other
+        self._changed()
 
     def set_if_equals(self, name, old_ref, new_ref):
         if old_ref is not None and self._refs.get(name, None) != old_ref:
@@ -365,32 +496,52 @@ class DictRefsContainer(RefsContainer):
         realname, _ = self._follow(name)
         self._check_refname(realname)
         self._refs[realname] = new_ref
+        self._changed()
         return True
 
     def add_if_new(self, name, ref):
         if name in self._refs:
             return False
         self._refs[name] = ref
+        self._changed()
         return True
 
     def remove_if_equals(self, name, old_ref):
         if old_ref is not None and self._refs.get(name, None) != old_ref:
             return False
         del self._refs[name]
+        self._changed()
         return True
 
     def get_peeled(self, name):
         return self._peeled.get(name)
 
+    def update_refs(self, updates):
+        for name in updates:
+            self._check_refname(name)
+        for name, (old_ref, new_ref) in updates.items():
+            if not _ref_matches(self._refs.get(name, None), old_ref):
+                return False
+        for name, (old_ref, new_ref) in updates.items():
+            if new_ref == ZERO_SHA:
+                self._refs.pop(name, None)
+                self._peeled.pop(name, None)
+            else:
+                self._refs[name] = new_ref
+        self._changed()
+        return True
+
     def _update(self, refs):
         """Update multiple refs; intended only for testing."""
         # TODO(dborowitz): replace this with a public function that uses
         # set_if_equal.
         self._refs.update(refs)
+        self._changed()
 
     def _update_peeled(self, peeled):
         """Update cached peeled refs; intended only for testing."""
         self._peeled.update(peeled)
+        self._changed()
 
 
 class DiskRefsContainer(RefsContainer):
@@ -400,10 +551,45 @@ class DiskRefsContainer(RefsContainer):
         self.path = path
         self._packed_refs = None
         self._peeled_refs = None
+        self._packed_refs_file = None
+        self._packed_refs_stat = None
+        self._ref_dirs = None
+        self._ref_stats = None
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
 
+    def _stat_ref_paths(self):
+        if self._ref_dirs is None:
+            self._ref_dirs = [root for root, dirs, files in
+                              os.walk(self.refpath(b"refs"))]
+        stats = []
+        for path in ([os.path.join(self.path, 'packed-refs'),
+                      self.refpath(b"HEAD")] + self._ref_dirs):
+            try:
+                st = os.stat(path)
+            except OSError:
+                stats.append(None)
+            else:
+                stats.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        return tuple(stats)
+
+    def get_state(self):
+        """Return a value that changes whenever the refs change.
+
+        Besides changes made through this container, this notices changes
+        made by other processes by checking the modification times of
+        packed-refs, HEAD and the directories under refs/. Git replaces ref
+        files by renaming a lock file over them, which updates the
+        modification time of the directory containing the ref.
+        """
+        stats = self._stat_ref_paths()
+        if stats != self._ref_stats:
+            # Directories may have been added or removed.
+            self._ref_dirs = None
+            stats = self._ref_stats = self._stat_ref_paths()
+        return (self._generation, stats)
+
     def subkeys(self, base):
         keys = set()
         path = self.refpath(base)
@@ -443,15 +629,43 @@ class DiskRefsContainer(RefsContainer):
             name = name.replace("/", os.path.sep)
         return os.path.join(self.path, name)
 
+    def _invalidate_packed_refs(self):
+        """Forget everything cached about packed-refs."""
+        self._packed_refs = None
+        self._peeled_refs = None
+        self._packed_refs_file = None
+        self._packed_refs_stat = None
+
+    def _check_packed_refs(self):
+        """Drop the cached packed-refs contents if the file was replaced.
+
+        :return: Whether packed-refs exists
+        """
+        try:
+            st = os.stat(os.path.join(self.path, 'packed-refs'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            stat = None
+        else:
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stat != self._packed_refs_stat:
+            self._invalidate_packed_refs()
+            self._packed_refs_stat = stat
+        return stat is not None
+
     def get_packed_refs(self):
         """Get contents of the packed-refs file.
 
+        The contents are cached until the file is replaced, as detected by
+        its modification time, size and inode number.
+
         :return: Dictionary mapping ref names to SHA1s
 
         :note: Will return an empty dictionary when no packed-refs file is
             present.
         """
-        # TODO: invalidate the cache on repacking
+        self._check_packed_refs()
         if self._packed_refs is None:
             # set both to empty because we want _peeled_refs to be
             # None if and only if _packed_refs is also None.
@@ -475,9 +689,55 @@ class DiskRefsContainer(RefsContainer):
                 if e.errno == errno.ENOENT:
                     return {}
                 raise
+            except StopIteration:
+                # empty file
+                pass
 
         return self._packed_refs
 
+    def _find_packed_ref(self, name):
+        """Look up a single packed ref.
+
+        If the packed refs have not been parsed yet and packed-refs is
+        sorted, the ref is found with a binary search over the file rather
+        than by parsing all of it.
+
+        :param name: Name of the ref
+        :return: Tuple with SHA1 and peeled SHA1 (or None), or None if the
+            ref is not packed
+        """
+        if not self._check_packed_refs():
+            return None
+        if self._packed_refs is None and self._packed_refs_file is None:
+            path = os.path.join(self.path, 'packed-refs')
+            try:
+                with GitFile(path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size:
+                        contents, size = _load_file_contents(f)
+                    else:
+                        contents, size = b'', 0
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None
+            packed_refs_file = PackedRefsFile(contents, size)
+            if packed_refs_file.sorted:
+                self._packed_refs_file = packed_refs_file
+        if self._packed_refs is None and self._packed_refs_file is not None:
+            return self._packed_refs_file.lookup(name)
+        packed_refs = self.get_packed_refs()
+        if name not in packed_refs:
+            return None
+        return packed_refs[name], self._peeled_refs.get(name)
+
+    def read_ref(self, refname):
+        contents = self.read_loose_ref(refname)
+        if not contents:
+            entry = self._find_packed_ref(refname)
+            if entry is not None:
+                contents = Sha1Sum(entry[0])
+        return contents
+
     def get_peeled(self, name):
         """Return the cached peeled value of a ref, if available.
 
@@ -486,12 +746,12 @@ class DiskRefsContainer(RefsContainer):
             tag, this will be the SHA the ref refers to. If the ref may point to
             a tag, but no cached information is available, None is returned.
         """
-        self.get_packed_refs()
-        if self._peeled_refs is None or name not in self._packed_refs:
+        entry = self._find_packed_ref(name)
+        if entry is None:
             # No cache: no peeled refs were read, or this ref is loose
             return None
-        if name in self._peeled_refs:
-            return self._peeled_refs[name]
+        if entry[1] is not None:
+            return entry[1]
         else:
             # Known not peelable
             return self[name]
@@ -523,12 +783,11 @@ class DiskRefsContainer(RefsContainer):
             raise
 
     def _remove_packed_ref(self, name):
-        if self._packed_refs is None:
-            return
         filename = os.path.join(self.path, 'packed-refs')
         # reread cached refs from disk, while holding the lock
-        with GitFile(filename, 'wb') as f:
-            self._packed_refs = None
+        f = GitFile(filename, 'wb')
+        try:
+            self._invalidate_packed_refs()
             self.get_packed_refs()
 
             if name not in self._packed_refs:
@@ -538,6 +797,8 @@ class DiskRefsContainer(RefsContainer):
             if name in self._peeled_refs:
                 del self._peeled_refs[name]
             write_packed_refs(f, self._packed_refs, self._peeled_refs)
+            f.close()
+        finally:
             f.abort()
 
     def set_symbolic_ref(self, name, other):
@@ -555,6 +816,7 @@ class DiskRefsContainer(RefsContainer):
             except (IOError, OSError):
                 f.abort()
                 raise
+        self._changed()
 
     def set_if_equals(self, name, old_ref, new_ref):
         """Set a refname to new_ref only if it currently equals old_ref.
@@ -579,9 +841,7 @@ class DiskRefsContainer(RefsContainer):
             if old_ref is not None:
                 try:
                     # read again while holding the lock
-                    orig_ref = self.read_loose_ref(realname)
-                    if orig_ref is None:
-                        orig_ref = self.get_packed_refs().get(realname, None)
+                    orig_ref = self.read_ref(realname)
                     if orig_ref != old_ref:
                         f.abort()
                         return False
@@ -593,6 +853,7 @@ class DiskRefsContainer(RefsContainer):
             except (OSError, IOError):
                 f.abort()
                 raise
+        self._changed()
         return True
 
     def add_if_new(self, name, ref):
@@ -616,7 +877,8 @@ class DiskRefsContainer(RefsContainer):
         filename = self.refpath(realname)
         ensure_dir_exists(os.path.dirname(filename))
         with GitFile(filename, 'wb') as f:
-            if os.path.exists(filename) or name in self.get_packed_refs():
+            if (os.path.exists(filename) or
+                    self._find_packed_ref(name) is not None):
                 f.abort()
                 return False
             try:
@@ -624,6 +886,7 @@ class DiskRefsContainer(RefsContainer):
             except (OSError, IOError):
                 f.abort()
                 raise
+        self._changed()
         return True
 
     def remove_if_equals(self, name, old_ref):
@@ -643,9 +906,7 @@ class DiskRefsContainer(RefsContainer):
         f = GitFile(filename, 'wb')
         try:
             if old_ref is not None:
-                orig_ref = self.read_loose_ref(name)
-                if orig_ref is None:
-                    orig_ref = self.get_packed_refs().get(name, None)
+                orig_ref = self.read_ref(name)
                 if orig_ref != old_ref:
                     return False
             # may only be packed
@@ -658,6 +919,106 @@ class DiskRefsContainer(RefsContainer):
         finally:
             # never write, we just wanted the lock
             f.abort()
+        self._changed()
+        return True
+
+    def update_refs(self, updates):
+        """Apply a set of updates as a unit.
+
+        The locks of all affected refs, and of packed-refs if a packed ref is
+        removed, are held while the old values are checked and the new values
+        are installed. If installing one of the new values fails, the refs
+        that were already changed are restored.
+
+        See RefsContainer.update_refs for the format of updates.
+        """
+        names = sorted(updates)
+        for name in names:
+            self._check_refname(name)
+        packed_filename = os.path.join(self.path, 'packed-refs')
+        locks = []
+        packed_lock = None
+        try:
+            # Take the locks in a fixed order to avoid deadlocks between
+            # concurrent transactions.
+            for name in names:
+                filename = self.refpath(name)
+                dirname = os.path.dirname(filename)
+                if updates[name][1] == ZERO_SHA and not os.path.isdir(dirname):
+                    # There can be no loose ref to delete, and creating the
+                    # directory just for the lock would leave it behind.
+                    locks.append(None)
+                    continue
+                ensure_dir_exists(dirname)
+                locks.append(GitFile(filename, 'wb'))
+            removed = [name for name in names if updates[name][1] == ZERO_SHA]
+            if removed:
+                packed_lock = GitFile(packed_filename, 'wb')
+            # read the refs again while holding the locks
+            self._invalidate_packed_refs()
+            packed_refs = dict(self.get_packed_refs())
+            peeled_refs = dict(self._peeled_refs)
+            old_loose = {}
+            for name in names:
+                old_loose[name] = self.read_loose_ref(name)
+                if old_loose[name] is None:
+                    orig_ref = packed_refs.get(name, None)
+                else:
+                    orig_ref = old_loose[name]
+                if not _ref_matches(orig_ref, updates[name][0]):
+                    return False
+            for f, name in zip(locks, names):
+                if updates[name][1] != ZERO_SHA:
+                    f.write(_ref_contents(updates[name][1]))
+            packed_removed = [name for name in removed if name in packed_refs]
+            done = []
+            packed_written = False
+            try:
+                if packed_removed:
+                    new_packed_refs = dict(packed_refs)
+                    new_peeled_refs = dict(peeled_refs)
+                    for name in packed_removed:
+                        del new_packed_refs[name]
+                        new_peeled_refs.pop(name, None)
+                    write_packed_refs(packed_lock, new_packed_refs,
+                                      new_peeled_refs)
+                    packed_lock.close()
+                    packed_written = True
+                for f, name in zip(locks, names):
+                    if updates[name][1] != ZERO_SHA:
+                        f.close()
+                    elif old_loose[name] is not None:
+                        os.remove(self.refpath(name))
+                    done.append(name)
+            except:
+                lock_by_name = dict(zip(names, locks))
+                for name in done:
+                    filename = self.refpath(name)
+                    if old_loose[name] is None:
+                        if updates[name][1] != ZERO_SHA:
+                            # Remove the loose ref this transaction created.
+                            os.remove(filename)
+                    elif updates[name][1] == ZERO_SHA:
+                        # The lock of a removed ref is still held, so restore
+                        # the ref through it.
+                        f = lock_by_name[name]
+                        f.write(_ref_contents(old_loose[name]))
+                        f.close()
+                    else:
+                        with GitFile(filename, 'wb') as f:
+                            f.write(_ref_contents(old_loose[name]))
+                if packed_written:
+                    with GitFile(packed_filename, 'wb') as f:
+                        write_packed_refs(f, packed_refs, peeled_refs)
+                raise
+        finally:
+            for f in locks:
+                if f is not None:
+                    f.abort()
+            if packed_lock is not None:
+                packed_lock.abort()
+            self._invalidate_packed_refs()
+        self._changed()
         return True
 
 
@@ -725,6 +1086,83 @@ def read_packed_refs_with_peeled(f):
         yield (sha, name, None)
 
 
+class PackedRefsFile(object):
+    """Look up single refs in a sorted packed-refs file.
+
+    Refs are found with a binary search over the contents of the file, which
+    are usually mapped into memory, so the file does not have to be parsed.
+    """
+
+    def __init__(self, contents, size):
+        """Create a new PackedRefsFile.
+
+        :param contents: Contents of the packed-refs file
+        :param size: Size of the contents
+        """
+        self._contents = contents
+        self._size = size
+        self.peeled = False
+        self.sorted = False
+        self._start = 0
+        if contents[:len(PACKED_REFS_HEADER)] == PACKED_REFS_HEADER:
+            end = self._line_end(0)
+            traits = contents[len(PACKED_REFS_HEADER):end].split()
+            self.peeled = b'peeled' in traits
+            self.sorted = b'sorted' in traits
+            self._start = min(end + 1, size)
+
+    def _line_end(self, start):
+        end = self._contents.find(b'\n', start, self._size)
+        if end == -1:
+            return self._size
+        return end
+
+    def _record_start(self, pos, lo):
+        """Find the start of the ref line that pos is part of.
+
+        :param pos: Offset in the file
+        :param lo: Offset of a ref line at or before pos
+        """
+        start = self._contents.rfind(b'\n', lo, pos) + 1
+        if start == 0:
+            start = lo
+        if self._contents[start] == b'^'[0]:
+            # pos is in the peeled line of a ref
+            start = self._contents.rfind(b'\n', lo, start - 1) + 1
+            if start == 0:
+                start = lo
+        return start
+
+    def lookup(self, name):
+        """Look up a ref.
+
+        :param name: Name of the ref
+        :return: Tuple with SHA1 and peeled SHA1 (or None), or None if the ref
+            is not in the file
+        """
+        contents = self._contents
+        lo = self._start
+        hi = self._size
+        while lo < hi:
+            start = self._record_start((lo + hi) // 2, lo)
+            end = self._line_end(start)
+            sha, refname = _split_ref_line(contents[start:end].rstrip(b'\r'))
+            if refname == name:
+                peeled = None
+                if end + 1 < self._size and contents[end + 1] == b'^'[0]:
+                    peeled = contents[end + 2:self._line_end(end + 1)].rstrip(
+                        b'\r')
+                    peeled = bytes(peeled)
+                return bytes(sha), peeled
+            if refname < name:
+                lo = end + 1
+                if lo < hi and contents[lo] == b'^'[0]:
+                    lo = self._line_end(lo) + 1
+            else:
+                hi = start
+        return None
+
+
 def write_packed_refs(f, packed_refs, peeled_refs=None):
     """Write a packed refs file.
 
@@ -734,8 +1172,9 @@ def write_packed_refs(f, packed_refs, peeled_refs=None):
     """
     if peeled_refs is None:
         peeled_refs = {}
+        f.write(b'# pack-refs with: sorted \n')
     else:
-        f.write(b'# pack-refs with: peeled\n')
+        f.write(b'# pack-refs with: peeled sorted \n')
     for refname in sorted(packed_refs.keys()):
         f.write(packed_refs[refname] + b' ' + refname + b'\n')
         if refname in peeled_refs:
@@ -753,6 +1192,9 @@ class BaseRepo(object):
     def __init__(self, object_store, refs):
         self.object_store = object_store
         self.refs = refs
+        self._refs_cache = None
+        self._refs_cache_key = None
+        self._peeled_cache = {}
 
     def __enter__(self):
         return self
@@ -851,9 +1293,34 @@ class BaseRepo(object):
         """Return the SHA1 a ref is pointing to."""
         return self.refs[name]
 
+    def _get_refs_snapshot(self, check_state=True):
+        """Return the cached refs, reading them again if they have changed.
+
+        :param check_state: Whether to fully check whether the refs have
+            changed. If False, only changes made through self.refs are
+            noticed, which is cheap.
+        """
+        refs = self.refs
+        key = self._refs_cache_key
+        if (key is not None and key[0] is refs and
+                (not check_state and key[1] == refs._generation)):
+            return self._refs_cache
+        state = refs.get_state()
+        if key is None or key[0] is not refs or key[2] != state:
+            self._refs_cache = refs.as_dict()
+            values = set(self._refs_cache.values())
+            self._peeled_cache = dict(
+                (sha, peeled) for (sha, peeled) in self._peeled_cache.items()
+                if sha in values)
+        self._refs_cache_key = (refs, refs._generation, state)
+        return self._refs_cache
+
     def get_refs(self):
-        """Get dictionary with all refs."""
-        return self.refs.as_dict()
+        """Get dictionary with all refs.
+
+        The refs are cached until they change, see RefsContainer.get_state().
+        """
+        return dict(self._get_refs_snapshot())
 
     def head(self):
         """Return the SHA1 pointed at by HEAD."""
@@ -943,11 +1410,30 @@ class BaseRepo(object):
         :return: The fully-peeled SHA1 of a tag object, after peeling all
             intermediate tags; if the original ref does not point to a tag, this
             will equal the original SHA1.
+        :note: Refs are looked up in the snapshot taken by the last call to
+            get_refs(), unless they have been changed through self.refs since;
+            peeled values are cached by SHA1.
         """
-        cached = self.refs.get_peeled(ref)
-        if cached is not None:
-            return cached
-        return self.object_store.peel_sha(self.refs[ref]).id
+        sha = None
+        key = self._refs_cache_key
+        if key is not None and key[0] is self.refs:
+            sha = self._get_refs_snapshot(check_state=False).get(ref)
+        current = sha is None
+        if current:
+            sha = self.refs[ref]
+        try:
+            return self._peeled_cache[sha]
+        except KeyError:
+            pass
+        peeled = None
+        # The ref may have moved on since the snapshot was taken, in which
+        # case its cached peeled value belongs to another SHA1.
+        if current or self.refs[ref] == sha:
+            peeled = self.refs.get_peeled(ref)
+        if peeled is None:
+            peeled = self.object_store.peel_sha(sha).id
+        self._peeled_cache[sha] = peeled
+        return peeled
 
     def get_walker(self, include=None, *args, **kwargs):
         """Obtain a walker for this repository.
@@ -956,10 +1442,10 @@ class BaseRepo(object):
             ancestors. Defaults to [HEAD]
         :param exclude: Iterable of SHAs of commits to exclude along with their
             ancestors, overriding includes.
-        :param order: ORDER_* constant specifying the order of results. Anything
-            other than ORDER_DATE may result in O(n) memory usage.
-        :param reverse: If True, reverse the order of output, requiring O(n)
-            memory.
+        :param order: ORDER_* constant specifying the order of results.
+            ORDER_TOPO keeps a generation number for every commit walked.
+        :param reverse: If True, reverse the order of output. Long walks are
+            buffered in a temporary file.
         :param max_entries: The maximum number of entries to yield, or None for
             no limit.
         :param paths: Iterable of file or subtree paths to show entries for.
@@ -972,6 +1458,10 @@ class BaseRepo(object):
         :param queue_cls: A class to use for a queue of commits, supporting the
             iterator protocol. The constructor takes a single argument, the
             Walker.
+        :param diff_cache: Optional diff_cache.TreeDiffCache for the changes
+            of each commit.
+        :param changed_paths: Optional changed_paths.ChangedPathFilters, used
+            to skip commits that did not change any of paths.
         """
         from dulwich.walk import Walker
         if include is None:
@@ -1105,7 +1595,14 @@ class BaseRepo(object):
 class Repo(BaseRepo):
     """A git repository backed by local disk."""
 
-    def __init__(self, root):
+    def __init__(self, root, refs_table=None):
+        """Open a repository.
+
+        :param root: Path of the repository
+        :param refs_table: Whether to keep refs in a refs table rather than
+            in loose files and packed-refs; see dulwich.refs_table. By
+            default a refs table is used if the repository has one.
+        """
         if os.path.isdir(os.path.join(root, ".git", OBJECTDIR)):
             self.bare = False
             self._controldir = os.path.join(root, ".git")
@@ -1118,7 +1615,15 @@ class Repo(BaseRepo):
         self.path = root
         object_store = DiskObjectStore(os.path.join(self.controldir(),
                                                     OBJECTDIR))
-        refs = DiskRefsContainer(self.controldir())
+        if refs_table is None:
+            from dulwich.refs_table import REFS_TABLE_FILENAME
+            refs_table = os.path.exists(
+                os.path.join(self.controldir(), REFS_TABLE_FILENAME))
+        if refs_table:
+            from dulwich.refs_table import RefsTableContainer
+            refs = RefsTableContainer(self.controldir())
+        else:
+            refs = DiskRefsContainer(self.controldir())
         BaseRepo.__init__(self, object_store, refs)
 
     def controldir(self):
@@ -1229,27 +1734,27 @@ class Repo(BaseRepo):
         return "<Repo at %r>" % self.path
 
     @classmethod
-    def _init_maybe_bare(cls, path, bare):
+    def _init_maybe_bare(cls, path, bare, refs_table=False):
         for d in BASE_DIRECTORIES:
             os.mkdir(os.path.join(path, *d))
         DiskObjectStore.init(os.path.join(path, OBJECTDIR))
-        ret = cls(path)
+        ret = cls(path, refs_table=refs_table)
         ret.refs.set_symbolic_ref(b"HEAD", b"refs/heads/master")
         ret._init_files(bare)
         return ret
 
     @classmethod
-    def init(cls, path, mkdir=False):
+    def init(cls, path, mkdir=False, refs_table=False):
         if mkdir:
             os.mkdir(path)
         controldir = os.path.join(path, ".git")
         os.mkdir(controldir)
-        cls._init_maybe_bare(controldir, False)
+        cls._init_maybe_bare(controldir, False, refs_table=refs_table)
         return cls(path)
 
     @classmethod
-    def init_bare(cls, path):
-        return cls._init_maybe_bare(path, True)
+    def init_bare(cls, path, refs_table=False):
+        return cls._init_maybe_bare(path, True, refs_table=refs_table)
 
     create = init_bare
 
@@ -30,6 +30,7 @@ import collections
 import socket
 import socketserver
 import sys
+import threading
 import zlib
 
 from dulwich.errors import (
@@ -39,6 +40,7 @@ from dulwich.errors import (
     NotGitRepository,
     UnexpectedCommandError,
     ObjectFormatException,
+    RefFormatError,
     )
 from dulwich import log_utils
 from dulwich.pack import (
@@ -62,7 +64,9 @@ from dulwich.repo import (
     Repo,
     )
 from dulwich.objects import (
-    Sha1Sum
+    Commit,
+    Sha1Sum,
+    parse_commit_header,
 )
 
 logger = log_utils.getLogger(__name__)
@@ -90,6 +94,16 @@ class Backend(object):
         """
         raise NotImplementedError(self.open_repository)
 
+    def release_repository(self, repo):
+        """Hand back a repository returned by open_repository.
+
+        The default implementation closes the repository.
+
+        :param repo: The repository
+        """
+        if hasattr(repo, 'close'):
+            repo.close()
+
 
 class BackendRepo(object):
     """Repository abstraction used by the Git server.
@@ -151,6 +165,10 @@ class DictBackend(Backend):
     def __enter__(self):
         return self
 
+    def release_repository(self, repo):
+        # The repositories stay open until the backend is closed.
+        pass
+
     def __exit__(self, type, value, tb):
         self.close()
 
@@ -159,19 +177,123 @@ class DictBackend(Backend):
             repo.close()
 
 
+DEFAULT_REPOSITORY_POOL_SIZE = 32
+
+
+class RepositoryPool(object):
+    """Pool of open repositories that is shared between requests.
+
+    Keeping repositories open means their pack indexes and caches can be
+    reused by later requests. At most max_size repositories are kept open,
+    closing the least recently used idle ones first.
+
+    Repository objects are not thread-safe, so each one is only handed to
+    one request at a time: concurrent requests for the same path each get
+    their own repository object.
+    """
+
+    def __init__(self, open_repository=Repo,
+                 max_size=DEFAULT_REPOSITORY_POOL_SIZE):
+        """Create a new RepositoryPool.
+
+        :param open_repository: Function that opens the repository at a path
+        :param max_size: Number of repositories to keep open
+        """
+        self._open_repository = open_repository
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # id(repo) -> (path, repo) of idle repositories, least recently used
+        # first
+        self._idle = collections.OrderedDict()
+        # path -> list of idle repositories
+        self._free = {}
+        # id(repo) -> path of the repositories that are in use
+        self._in_use = {}
+
+    def __len__(self):
+        return len(self._idle) + len(self._in_use)
+
+    def _take_idle(self, key):
+        path, repo = self._idle.pop(key)
+        free = self._free[path]
+        free.remove(repo)
+        if not free:
+            del self._free[path]
+        return repo
+
+    def _evict(self):
+        while len(self) > self.max_size and self._idle:
+            self._take_idle(next(iter(self._idle))).close()
+
+    def acquire(self, path):
+        """Get a repository at a path that is not in use, opening it if
+        necessary.
+
+        :param path: Path to the repository
+        :raise NotGitRepository: no git repository was found at path
+        :return: The repository; hand it back with release()
+        """
+        with self._lock:
+            free = self._free.get(path)
+            if free:
+                repo = self._take_idle(id(free[-1]))
+                self._in_use[id(repo)] = path
+                return repo
+        repo = self._open_repository(path)
+        with self._lock:
+            self._in_use[id(repo)] = path
+            self._evict()
+        return repo
+
+    def release(self, repo):
+        """Hand back a repository returned by acquire().
+
+        :param repo: The repository
+        """
+        with self._lock:
+            path = self._in_use.pop(id(repo), None)
+            if path is None:
+                # Not pooled (anymore)
+                repo.close()
+                return
+            self._idle[id(repo)] = (path, repo)
+            self._free.setdefault(path, []).append(repo)
+            self._evict()
+
+    def close(self):
+        """Close the idle repositories in the pool.
+
+        Repositories that are in use are closed when they are released.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, collections.OrderedDict()
+            self._free = {}
+            self._in_use = {}
+        for path, repo in idle.values():
+            repo.close()
+
+
 class FileSystemBackend(Backend):
     """Simple backend that looks up Git repositories in the local file system."""
 
-    def __init__(self):
-        self._known_repos = []
+    def __init__(self, pool=None):
+        """Create a new FileSystemBackend.
+
+        :param pool: RepositoryPool to keep the repositories in; a new one is
+            created if not specified
+        """
+        if pool is None:
+            pool = RepositoryPool()
+        self.pool = pool
 
     def open_repository(self, path):
         if isinstance(path, bytes):
             path = path.decode('utf-8')
         logger.debug('opening repository at %s', path)
-        repo = Repo(path)
-        self._known_repos.append(repo)
-        return repo
+        return self.pool.acquire(path)
+
+    def release_repository(self, repo):
+        self.pool.release(repo)
 
     def __enter__(self):
         return self
@@ -180,8 +302,7 @@ class FileSystemBackend(Backend):
         self.close()
 
     def close(self):
-        for repo in self._known_repos:
-            repo.close()
+        self.pool.close()
 
 
 class Handler(object):
@@ -251,8 +372,7 @@ class UploadPackHandler(Handler):
         self.advertise_refs = advertise_refs
 
     def close(self):
-        if hasattr(self.repo, 'close'):
-            self.repo.close()
+        self.backend.release_repository(self.repo)
 
     @classmethod
     def capabilities(cls):
@@ -483,6 +603,18 @@ class ProtocolGraphWalker(object):
     def set_wants(self, wants):
         self._wants = wants
 
+    def _commit_header(self, sha):
+        """Read the tree, parents and commit time of a commit.
+
+        :param sha: The SHA of the object
+        :return: Tuple as returned by parse_commit_header, or None if the
+            object is not a commit
+        """
+        type_num, text = self.store.get_raw(sha)
+        if type_num != Commit.type_num:
+            return None
+        return parse_commit_header(text)
+
     def _is_satisfied(self, haves, want, earliest):
         """Check whether a want is satisfied by a set of haves.
 
@@ -496,20 +628,19 @@ class ProtocolGraphWalker(object):
             wrong branch.
         """
 
-        o = self.store[want]
-        pending = collections.deque([o])
+        pending = collections.deque([(want, self._commit_header(want))])
         while pending:
-            commit = pending.popleft()
-            if commit.id in haves:
+            sha, header = pending.popleft()
+            if sha in haves:
                 return True
-            if commit.type_name != 'commit':
+            if header is None:
                 # non-commit wants are assumed to be satisfied
                 continue
-            for parent in commit.parents:
-                parent_obj = self.store[parent]
+            for parent in header[1]:
+                parent_header = self._commit_header(parent)
                 # TODO: handle parents with later commit times than children
-                if parent_obj.commit_time >= earliest:
-                    pending.append(parent_obj)
+                if parent_header[2] >= earliest:
+                    pending.append((parent, parent_header))
         return False
 
     def all_wants_satisfied(self, haves):
@@ -520,7 +651,7 @@ class ProtocolGraphWalker(object):
             in the current interface they are determined outside this class.
         """
         haves = set(haves)
-        earliest = min([self.store[h].commit_time for h in haves])
+        earliest = min([self._commit_header(h)[2] for h in haves])
 
         for want in self._wants:
             if not self._is_satisfied(haves, want, earliest):
@@ -651,12 +782,11 @@ class ReceivePackHandler(Handler):
         self.advertise_refs = advertise_refs
 
     def close(self):
-        if hasattr(self.repo, 'close'):
-            self.repo.close()
+        self.backend.release_repository(self.repo)
 
     @classmethod
     def capabilities(cls):
-        return (b"report-status", b"delete-refs", b"side-band-64k")
+        return (b"report-status", b"delete-refs", b"side-band-64k", b"atomic")
 
     def _apply_pack(self, refs):
         all_exceptions = (IOError, OSError, ChecksumMismatch, ApplyDeltaError,
@@ -673,29 +803,68 @@ class ReceivePackHandler(Handler):
             # The pack may still have been moved in, but it may contain broken
             # objects. We trust a later GC to clean it up.
 
+        ref_status = {}
+        transaction = self.repo.refs.transaction()
         for oldsha, sha, ref in refs:
-            ref_status = b'ok'
+            if sha == ZERO_SHA:
+                if not b'delete-refs' in self.capabilities():
+                    raise GitProtocolError(
+                      'Attempted to delete refs without delete-refs '
+                      'capability.')
+                transaction.remove(ref, oldsha)
+            else:
+                try:
+                    transaction.set(ref, sha, oldsha)
+                except KeyError:
+                    ref_status[ref] = b'bad ref'
+        atomic = self.has_capability(b'atomic')
+        if atomic and ref_status:
+            # An atomic push applies all of the updates or none of them.
+            applied = False
+        else:
             try:
-                if sha == ZERO_SHA:
-                    if not b'delete-refs' in self.capabilities():
-                        raise GitProtocolError(
-                          'Attempted to delete refs without delete-refs '
-                          'capability.')
-                    try:
-                        del self.repo.refs[ref]
-                    except all_exceptions:
-                        ref_status = 'failed to delete'
-                else:
-                    try:
-                        self.repo.refs[ref] = sha
-                    except all_exceptions:
-                        ref_status = 'failed to write'
-            except KeyError as e:
-                ref_status = 'bad ref'
-            status.append((ref, ref_status))
-
+                applied = transaction.commit()
+            except all_exceptions + (KeyError, RefFormatError):
+                applied = False
+        if not applied:
+            if atomic:
+                for oldsha, sha, ref in refs:
+                    ref_status[ref] = b'atomic transaction failed'
+            else:
+                # Apply the updates one at a time to find out which of them
+                # failed.
+                for oldsha, sha, ref in refs:
+                    if ref not in ref_status:
+                        ref_status[ref] = self._update_ref(oldsha, sha, ref,
+                                                           all_exceptions)
+        for oldsha, sha, ref in refs:
+            status.append((ref, ref_status.get(ref, b'ok')))
         return status
 
+    def _update_ref(self, oldsha, sha, ref, all_exceptions):
+        try:
+            if sha == ZERO_SHA:
+                try:
+                    if not self.repo.refs.remove_if_equals(ref, oldsha):
+                        return b'failed to lock'
+                except all_exceptions:
+                    return b'failed to delete'
+            else:
+                if oldsha == ZERO_SHA:
+                    update = self.repo.refs.add_if_new
+                    args = (ref, sha)
+                else:
+                    update = self.repo.refs.set_if_equals
+                    args = (ref, oldsha, sha)
+                try:
+                    if not update(*args):
+                        return b'failed to lock'
+                except all_exceptions:
+                    return b'failed to write'
+        except (KeyError, RefFormatError):
+            return b'bad ref'
+        return b'ok'
+
     def _report_status(self, status):
         if self.has_capability(b'side-band-64k'):
             writer = BufferedPktLineWriter(
@@ -67,17 +67,22 @@ class BlackboxTestCase(TestCase):
 def self_test_suite():
     names = [
         'blackbox',
+        'changed_paths',
         'client',
+        'diff_cache',
         'diff_tree',
         'fastexport',
         'file',
         'index',
         'lru_cache',
+        'mirror',
         'objects',
         'object_store',
         'pack',
+        'pathspec',
         'patch',
         'protocol',
+        'refs_table',
         'repository',
         'server',
         'walk',
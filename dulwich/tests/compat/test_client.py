@@ -36,6 +36,7 @@ from dulwich import (
     errors,
     file,
     index,
+    mirror,
     protocol,
     objects,
     repo,
@@ -285,6 +286,34 @@ class DulwichSubprocessClientTest(CompatTestCase, DulwichClientTestBase):
         return self.gitroot + path
 
 
+class MirrorDriverSubprocessTest(CompatTestCase):
+
+    def setUp(self):
+        CompatTestCase.setUp(self)
+        self.gitroot = os.path.dirname(
+            import_repo_to_dir('server_new.export'))
+        self.addCleanup(shutil.rmtree, self.gitroot)
+        self.src = os.path.join(self.gitroot, 'server_new.export')
+
+    def test_fetch_many(self):
+        targets = []
+        for i in range(4):
+            path = os.path.join(self.gitroot, 'dest%d' % i)
+            file.ensure_dir_exists(path)
+            run_git_or_fail(['init', '--quiet', '--bare'], cwd=path)
+            targets.append(repo.Repo(path))
+        driver = mirror.MirrorDriver(max_workers=4, max_per_host=2)
+        results = driver.fetch([(self.src, t) for t in targets])
+        with repo.Repo(self.src) as src:
+            src_refs = src.get_refs()
+            for result, target in zip(results, targets):
+                self.assertTrue(result.ok, result.error)
+                self.assertEqual(src_refs, result.refs)
+                for sha in src_refs.values():
+                    self.assertTrue(sha in target.object_store)
+                target.close()
+
+
 class GitHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """HTTP Request handler that calls out to 'git http-backend'."""
 
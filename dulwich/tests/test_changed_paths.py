@@ -0,0 +1,119 @@
+# test_changed_paths.py -- Tests for changed-path Bloom filters
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for changed-path Bloom filters."""
+
+import os
+import shutil
+import tempfile
+
+from dulwich import changed_paths
+from dulwich.changed_paths import (
+    BloomFilter,
+    ChangedPathFilters,
+    )
+from dulwich.errors import FileFormatException
+from dulwich.object_store import MemoryObjectStore
+from dulwich.objects import Blob
+from dulwich.tests import TestCase
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+
+
+class BloomFilterTests(TestCase):
+
+    def test_from_keys(self):
+        keys = [('path%d' % i).encode('ascii') for i in range(100)]
+        bloom = BloomFilter.from_keys(keys)
+        self.assertEqual(125, len(bloom.as_bytes()))
+        for key in keys:
+            self.assertTrue(key in bloom)
+        false_positives = sum(1 for i in range(1000)
+                              if ('other%d' % i).encode('ascii') in bloom)
+        self.assertTrue(false_positives < 50)
+
+    def test_empty(self):
+        bloom = BloomFilter.from_keys([])
+        self.assertEqual(8, len(bloom.as_bytes()))
+        self.assertFalse(b'a' in bloom)
+
+
+class ChangedPathFiltersTests(TestCase):
+
+    def setUp(self):
+        super(ChangedPathFiltersTests, self).setUp()
+        self.store = MemoryObjectStore()
+        blob_a = make_object(Blob, data=b'a')
+        blob_b = make_object(Blob, data=b'b')
+        self.c1, self.c2, self.c3 = build_commit_graph(
+          self.store, [[1], [2, 1], [3, 2]],
+          trees={1: [('a', blob_a), ('x/y/z', blob_a)],
+                 2: [('a', blob_a), ('x/y/z', blob_b)],
+                 3: [('b', blob_a), ('x/y/z', blob_b)]})
+
+    def test_may_have_changed(self):
+        filters = ChangedPathFilters(self.store)
+        self.assertTrue(filters.may_have_changed(self.c1, [b'a']))
+        self.assertTrue(filters.may_have_changed(self.c1, [b'x/y']))
+        self.assertTrue(filters.may_have_changed(self.c2, [b'x']))
+        self.assertTrue(filters.may_have_changed(self.c2, [b'x/y/']))
+        self.assertTrue(filters.may_have_changed(self.c2, [b'x/y/z']))
+        self.assertFalse(filters.may_have_changed(self.c2, [b'a']))
+        self.assertTrue(filters.may_have_changed(self.c3, [b'a', b'x']))
+        self.assertTrue(filters.may_have_changed(self.c3, [b'b']))
+        self.assertFalse(filters.may_have_changed(self.c3, [b'x']))
+        self.assertTrue(filters.may_have_changed(self.c3, [b'']))
+        self.assertEqual(3, len(filters))
+
+    def test_too_many_changes(self):
+        self.addCleanup(setattr, changed_paths, 'MAX_CHANGED_PATHS',
+                        changed_paths.MAX_CHANGED_PATHS)
+        changed_paths.MAX_CHANGED_PATHS = 2
+        filters = ChangedPathFilters(self.store)
+        # c1 adds a, x, x/y and x/y/z.
+        self.assertTrue(filters.may_have_changed(self.c1, [b'b']))
+        self.assertFalse(filters.may_have_changed(self.c3, [b'x']))
+
+    def test_save(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'filters')
+        filters = ChangedPathFilters(self.store, path)
+        filters.save()
+        self.assertFalse(os.path.exists(path))
+        filters.get_filter(self.c2)
+        filters.get_filter(self.c3)
+        filters.save()
+
+        # The saved filters do not need the trees.
+        filters = ChangedPathFilters(MemoryObjectStore(), path)
+        self.assertEqual(2, len(filters))
+        self.assertTrue(filters.may_have_changed(self.c2, [b'x/y/z']))
+        self.assertFalse(filters.may_have_changed(self.c3, [b'x']))
+
+    def test_bad_file(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'filters')
+        with open(path, 'wb') as f:
+            f.write(b'DCPF\x00\x00\x00\x01' + b'\x00' * 25)
+        self.assertRaises(FileFormatException, ChangedPathFilters,
+                          self.store, path)
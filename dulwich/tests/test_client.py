@@ -17,8 +17,13 @@
 # MA  02110-1301, USA.
 
 from io import BytesIO
+import http.client
+import http.server
+import threading
+import urllib.request
 
 from dulwich.client import (
+    HTTPConnectionPool,
     TraditionalGitClient,
     TCPGitClient,
     SubprocessGitClient,
@@ -29,6 +34,9 @@ from dulwich.client import (
     UpdateRefsError,
     get_transport_and_path,
     )
+from dulwich.errors import (
+    NotGitRepository,
+    )
 from dulwich.tests import (
     TestCase,
     )
@@ -190,3 +198,211 @@ class ReportStatusParserTests(TestCase):
         parser.handle_packet(b"ok refs/foo/bar")
         parser.handle_packet(None)
         parser.check()
+
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        body = self.path.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _SmartHandler(_KeepAliveHandler):
+
+    def _send(self, content_type, body):
+        self.server.client_ports.add(self.client_address[1])
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send('application/x-git-upload-pack-advertisement',
+                   b'001e# service=git-upload-pack\n0000'
+                   b'003f' + b'1' * 40 + b' refs/heads/master\n0000')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._send('application/x-git-upload-pack-result', b'0008NAK\n')
+
+
+class _NotFoundHandler(_KeepAliveHandler):
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.do_GET()
+
+
+class _DroppingConnection(object):
+    """Connection that sends requests but never gets a response."""
+
+    def __init__(self):
+        self.methods = []
+
+    def request(self, method, url, body=None, headers=None):
+        self.methods.append(method)
+
+    def getresponse(self):
+        raise http.client.RemoteDisconnected('connection dropped')
+
+    def close(self):
+        pass
+
+
+class HTTPConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        super(HTTPConnectionPoolTests, self).setUp()
+        self.server = http.server.HTTPServer(('localhost', 0),
+                                             _KeepAliveHandler)
+        self.server.client_ports = set()
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.pool = HTTPConnectionPool(max_per_host=1)
+        self.addCleanup(self.pool.close)
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+        self.key = ('http', 'localhost', self.server.server_address[1])
+
+    def _get(self, path):
+        resp = self.pool.request(urllib.request.Request(self.url + path))
+        try:
+            return resp.getcode(), resp.read()
+        finally:
+            resp.close()
+
+    def test_reuses_connection(self):
+        self.assertEqual((200, b'/a'), self._get('/a'))
+        self.assertEqual(1, self.pool.idle_count(self.key))
+        self.assertEqual((200, b'/b'), self._get('/b'))
+        self.assertEqual(1, len(self.server.client_ports))
+
+    def test_unread_response_not_reused(self):
+        resp = self.pool.request(urllib.request.Request(self.url + '/a'))
+        self.assertEqual(b'/', resp.read(1))
+        resp.close()
+        self.assertEqual(1, self.pool.idle_count(self.key))
+        resp = self.pool.request(urllib.request.Request(
+            self.url + '/' + 'x' * 100000))
+        resp.read(1)
+        resp.close()
+        self.assertEqual(0, self.pool.idle_count(self.key))
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        self._get('/a')
+        self._get('/b')
+        self.assertEqual(2, len(self.server.client_ports))
+
+    def test_retry_on_dropped_connection(self):
+        self._get('/a')
+        for conn, last_used in self.pool._idle[self.key]:
+            conn.sock.close()
+        self.assertEqual((200, b'/b'), self._get('/b'))
+
+    def test_no_retry_after_sending(self):
+        conn = _DroppingConnection()
+        self.pool._release(self.key, conn)
+        req = urllib.request.Request(self.url + '/a', data=b'data')
+        self.assertRaises(http.client.RemoteDisconnected,
+                          self.pool.request, req)
+        self.assertEqual(['POST'], conn.methods)
+        self.assertEqual(0, len(self.server.client_ports))
+        # Idempotent requests are sent again on a fresh connection
+        self.pool._release(self.key, conn)
+        self.assertEqual((200, b'/b'), self._get('/b'))
+        self.assertEqual(['POST', 'GET'], conn.methods)
+
+    def test_http_client_retries_fetch_only(self):
+        self.server.RequestHandlerClass = _SmartHandler
+        client = HttpGitClient(self.url, pool=self.pool)
+        url = client._get_url('/repo')
+        conn = _DroppingConnection()
+        self.pool._release(self.key, conn)
+        resp = client._smart_request('git-upload-pack', url, b'0000')
+        self.assertEqual(b'0008NAK\n', resp.read())
+        resp.close()
+        self.pool._idle.clear()
+        self.pool._release(self.key, conn)
+        self.assertRaises(http.client.RemoteDisconnected,
+                          client._smart_request, 'git-receive-pack', url,
+                          b'0000')
+        self.assertEqual(['POST', 'POST'], conn.methods)
+
+    def test_http_client_uses_pool(self):
+        client = HttpGitClient(self.url, pool=self.pool)
+        resp = client._perform(urllib.request.Request(self.url + '/a'))
+        self.assertEqual(b'/a', resp.read())
+        resp.close()
+        self.assertEqual(1, self.pool.idle_count())
+
+    def test_http_client_discovery_reuses_connection(self):
+        self.server.RequestHandlerClass = _SmartHandler
+        client = HttpGitClient(self.url, pool=self.pool)
+        url = client._get_url('/repo')
+        refs, caps = client._discover_references('git-upload-pack', url)
+        self.assertEqual({b'refs/heads/master': b'1' * 40}, refs)
+        self.assertEqual(1, self.pool.idle_count(self.key))
+        resp = client._smart_request('git-upload-pack', url, b'0000')
+        self.assertEqual(b'0008NAK\n', resp.read())
+        resp.close()
+        self.assertEqual(1, self.pool.idle_count(self.key))
+        self.assertEqual(1, len(self.server.client_ports))
+
+    def test_http_client_discovery_error_releases_connection(self):
+        self.server.RequestHandlerClass = _NotFoundHandler
+        client = HttpGitClient(self.url, pool=self.pool)
+        self.assertRaises(NotGitRepository, client._discover_references,
+                          'git-upload-pack', client._get_url('/repo'))
+        self.assertEqual(1, self.pool.idle_count(self.key))
+
+    def test_http_client_request_error_releases_connection(self):
+        self.server.RequestHandlerClass = _NotFoundHandler
+        client = HttpGitClient(self.url, pool=self.pool)
+        self.assertRaises(NotGitRepository, client._smart_request,
+                          'git-upload-pack', client._get_url('/repo'),
+                          b'0000')
+        self.assertEqual(1, self.pool.idle_count(self.key))
+
+    def test_http_client_pool_keyword_only(self):
+        client = HttpGitClient(self.url, None, False)
+        self.assertEqual(None, client.pool)
+        self.assertFalse(b'thin-pack' in client._fetch_capabilities)
+
+
+class FetchMultipleTests(TestCase):
+
+    def test_fetch_multiple(self):
+        fetched = []
+
+        class RecordingClient(TraditionalGitClient):
+
+            def fetch(self, path, target, determine_wants=None,
+                      progress=None):
+                fetched.append((path, target))
+                return {b'HEAD': path}
+
+        client = RecordingClient()
+        self.assertEqual({'a': {b'HEAD': 'a'}, 'b': {b'HEAD': 'b'}},
+            client.fetch_multiple([('a', 1), ('b', 2)]))
+        self.assertEqual([('a', 1), ('b', 2)], fetched)
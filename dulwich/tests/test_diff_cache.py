@@ -0,0 +1,262 @@
+# test_diff_cache.py -- Tests for the persistent tree diff cache
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for the persistent tree diff cache."""
+
+import os
+import shutil
+import tempfile
+
+from dulwich.diff_cache import (
+    TreeDiffCache,
+    _pack_changes,
+    _unpack_changes,
+    )
+from dulwich.diff_tree import (
+    CHANGE_COPY,
+    CHANGE_MODIFY,
+    CHANGE_RENAME,
+    CHANGE_UNCHANGED,
+    RenameDetector,
+    TreeChange,
+    tree_changes,
+    )
+from dulwich.errors import FileFormatException
+from dulwich.object_store import MemoryObjectStore
+from dulwich.objects import Blob
+from dulwich.tests.test_diff_tree import DiffTestCase
+from dulwich.tests.utils import (
+    F,
+    make_object,
+    )
+
+
+class TreeDiffCacheTests(DiffTestCase):
+
+    def setUp(self):
+        super(TreeDiffCacheTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'diffs')
+        self.blob_a = make_object(Blob, data=b'a')
+        self.blob_b = make_object(Blob, data=b'b')
+        self.changes = [
+          TreeChange.add((b'a', F, self.blob_a.id)),
+          TreeChange.delete((b'b', F, self.blob_b.id)),
+          TreeChange(CHANGE_MODIFY, (b'c', F, self.blob_a.id),
+                     (b'c', 0o100755, self.blob_b.id)),
+          TreeChange(CHANGE_RENAME, (b'd', F, self.blob_a.id),
+                     (b'e/d', F, self.blob_a.id)),
+          TreeChange(CHANGE_COPY, (b'd', F, self.blob_a.id),
+                     (b'f', F, self.blob_a.id)),
+          TreeChange(CHANGE_UNCHANGED, (b'g', F, self.blob_b.id),
+                     (b'g', F, self.blob_b.id)),
+          ]
+        self.tree1 = self.commit_tree([('a', self.blob_a)])
+        self.tree2 = self.commit_tree([('a', self.blob_b),
+                                       ('x/b', self.blob_b)])
+
+    def open_cache(self, **kwargs):
+        cache = TreeDiffCache(self.path, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_pack_changes(self):
+        self.assertEqual(self.changes,
+                         _unpack_changes(_pack_changes(self.changes)))
+        self.assertEqual([], _unpack_changes(_pack_changes([])))
+
+    def test_get_missing(self):
+        cache = self.open_cache()
+        self.assertEqual(None, cache.get(self.tree1.id, self.tree2.id))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_add_get(self):
+        cache = self.open_cache()
+        cache.add(self.tree1.id, self.tree2.id, self.changes)
+        cache.add(None, self.tree1.id, self.changes[:1])
+        self.assertEqual(self.changes, cache.get(self.tree1.id, self.tree2.id))
+        self.assertEqual(self.changes[:1], cache.get(None, self.tree1.id))
+        self.assertEqual(None, cache.get(self.tree2.id, self.tree1.id))
+        self.assertEqual(None, cache.get(self.tree1.id, self.tree2.id,
+                                         variant=b'u'))
+        self.assertEqual(2, len(cache))
+
+    def test_persistent(self):
+        cache = self.open_cache()
+        cache.add(self.tree1.id, self.tree2.id, self.changes)
+        cache.add(self.tree1.id, self.tree2.id, self.changes[:1], b'u')
+        cache.close()
+        cache = self.open_cache()
+        self.assertEqual(self.changes, cache.get(self.tree1.id, self.tree2.id))
+        self.assertEqual(self.changes[:1], cache.get(self.tree1.id,
+                                                     self.tree2.id, b'u'))
+
+    def test_bounded(self):
+        cache = self.open_cache(max_entries=2)
+        trees = [self.empty_tree, self.tree1, self.tree2]
+        for tree in trees:
+            cache.add(tree.id, None, self.changes[:1])
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get(self.empty_tree.id, None))
+        # Using an entry keeps it in the cache.
+        self.assertEqual(self.changes[:1], cache.get(self.tree1.id, None))
+        cache.add(self.empty_tree.id, None, self.changes[1:2])
+        self.assertEqual(None, cache.get(self.tree2.id, None))
+        size = os.path.getsize(self.path)
+        cache.add(self.tree2.id, self.tree1.id, [])
+        # The file was compacted instead of growing further.
+        self.assertTrue(os.path.getsize(self.path) < size)
+        cache.add(self.tree1.id, self.tree2.id, [])
+        cache.close()
+
+        cache = self.open_cache(max_entries=2)
+        self.assertEqual(2, len(cache))
+        self.assertEqual([], cache.get(self.tree1.id, self.tree2.id))
+        self.assertEqual([], cache.get(self.tree2.id, self.tree1.id))
+
+    def test_truncated(self):
+        cache = self.open_cache()
+        cache.add(self.tree1.id, self.tree2.id, self.changes)
+        cache.add(self.tree2.id, self.tree1.id, self.changes)
+        cache.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 5)
+        size = os.path.getsize(self.path)
+        cache = self.open_cache()
+        self.assertEqual(1, len(cache))
+        # The record may still be being written by another process, so it
+        # is left alone.
+        self.assertEqual(size, os.path.getsize(self.path))
+        cache.add(self.tree2.id, self.tree1.id, self.changes[:2])
+        cache.close()
+        cache = self.open_cache()
+        self.assertEqual(self.changes, cache.get(self.tree1.id, self.tree2.id))
+        self.assertEqual(self.changes[:2],
+                         cache.get(self.tree2.id, self.tree1.id))
+
+    def test_corrupt_record(self):
+        cache = self.open_cache()
+        cache.add(self.tree1.id, self.tree2.id, self.changes)
+        cache.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as f:
+            # A record whose writer was interrupted
+            f.write(b'DTDR\0\0\0\xff\0\0\0\0garbage')
+        cache = self.open_cache()
+        cache.add(self.tree2.id, self.tree1.id, self.changes[:1])
+        cache.close()
+        with open(self.path, 'r+b') as f:
+            f.seek(size - 1)
+            # Corrupt the data of the first record
+            f.write(b'\xff')
+        cache = self.open_cache(max_entries=1)
+        self.assertEqual(None, cache.get(self.tree1.id, self.tree2.id))
+        self.assertEqual(self.changes[:1],
+                         cache.get(self.tree2.id, self.tree1.id))
+        # Compaction drops the unreadable records
+        self.assertTrue(cache._compact())
+        cache.close()
+        with open(self.path, 'rb') as f:
+            self.assertFalse(b'garbage' in f.read())
+        self.assertEqual(1, len(self.open_cache()))
+
+    def test_bad_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a cache')
+        self.assertRaises(FileFormatException, TreeDiffCache, self.path)
+
+    def test_tree_changes(self):
+        cache = self.open_cache()
+        expected = list(tree_changes(self.store, self.tree1.id,
+                                     self.tree2.id))
+        self.assertEqual(expected, list(tree_changes(
+          self.store, self.tree1.id, self.tree2.id, diff_cache=cache)))
+        self.assertEqual(1, len(cache))
+        # The second diff does not need the trees at all.
+        self.assertEqual(expected, list(tree_changes(
+          MemoryObjectStore(), self.tree1.id, self.tree2.id,
+          diff_cache=cache)))
+        self.assertEqual(None, cache.get(self.tree1.id, self.tree2.id,
+                                         variant=b'u'))
+
+    def test_rename_detector(self):
+        blob = make_object(Blob, data=b'a\nb\nc\nd\n')
+        tree1 = self.commit_tree([('a', blob)])
+        tree2 = self.commit_tree([('b', blob)])
+        cache = self.open_cache()
+        detector = RenameDetector(self.store, diff_cache=cache)
+        expected = [TreeChange(CHANGE_RENAME, (b'a', F, blob.id),
+                               (b'b', F, blob.id))]
+        self.assertEqual(expected,
+                         detector.changes_with_renames(tree1.id, tree2.id))
+        self.assertEqual(expected, RenameDetector(
+          MemoryObjectStore(), diff_cache=cache).changes_with_renames(
+            tree1.id, tree2.id))
+        # Different options are cached separately.
+        self.assertEqual(1, len(cache))
+        RenameDetector(self.store, rename_threshold=90, diff_cache=cache
+                       ).changes_with_renames(tree1.id, tree2.id)
+        self.assertEqual(2, len(cache))
+
+    def test_tree_changes_rename_detector(self):
+        blob = make_object(Blob, data=b'a\nb\nc\nd\n')
+        tree1 = self.commit_tree([('a', blob)])
+        tree2 = self.commit_tree([('b', blob)])
+        cache = self.open_cache()
+        expected = [TreeChange(CHANGE_RENAME, (b'a', F, blob.id),
+                               (b'b', F, blob.id))]
+        self.assertEqual(expected, list(tree_changes(
+          self.store, tree1.id, tree2.id,
+          rename_detector=RenameDetector(self.store), diff_cache=cache)))
+        self.assertEqual(1, len(cache))
+        store = MemoryObjectStore()
+        self.assertEqual(expected, list(tree_changes(
+          store, tree1.id, tree2.id, rename_detector=RenameDetector(store),
+          diff_cache=cache)))
+
+    def test_compact_keeps_other_writers(self):
+        cache1 = self.open_cache()
+        cache1.add(self.tree1.id, self.tree2.id, self.changes)
+        cache2 = self.open_cache()
+        cache2.add(self.tree2.id, self.tree1.id, self.changes[:1])
+        self.assertTrue(cache1._compact())
+        # cache2 appends to the new file, not the one that was replaced
+        cache2.add(self.tree1.id, None, self.changes[:2])
+        cache1.close()
+        cache2.close()
+        cache = self.open_cache()
+        self.assertEqual(3, len(cache))
+        self.assertEqual(self.changes, cache.get(self.tree1.id, self.tree2.id))
+        self.assertEqual(self.changes[:1],
+                         cache.get(self.tree2.id, self.tree1.id))
+        self.assertEqual(self.changes[:2], cache.get(self.tree1.id, None))
+
+    def test_compact_locked(self):
+        cache = self.open_cache(max_entries=1)
+        cache.add(self.tree1.id, None, self.changes[:1])
+        cache.add(self.tree2.id, None, self.changes[:1])
+        with open(self.path + '.lock', 'wb'):
+            pass
+        # Another process is compacting the file, so the entry is appended
+        size = os.path.getsize(self.path)
+        cache.add(self.tree1.id, self.tree2.id, self.changes)
+        self.assertTrue(os.path.getsize(self.path) > size)
+        os.remove(self.path + '.lock')
+        self.assertEqual(self.changes, cache.get(self.tree1.id, self.tree2.id))
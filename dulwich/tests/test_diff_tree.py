@@ -19,6 +19,10 @@
 """Tests for file and tree diff utilities."""
 
 from itertools import permutations
+import shutil
+import tempfile
+
+from dulwich import diff_tree
 from dulwich.diff_tree import (
     CHANGE_MODIFY,
     CHANGE_RENAME,
@@ -28,7 +32,9 @@ from dulwich.diff_tree import (
     _merge_entries,
     _merge_entries_py,
     tree_changes,
+    tree_changes_batch,
     tree_changes_for_merge,
+    walk_trees,
     _count_blocks,
     _count_blocks_py,
     _similarity_score,
@@ -41,6 +47,7 @@ from dulwich.index import (
     commit_tree,
     )
 from dulwich.object_store import (
+    DiskObjectStore,
     MemoryObjectStore,
     )
 from dulwich.objects import (
@@ -90,6 +97,53 @@ class TreeChangesTest(DiffTestCase):
         super(TreeChangesTest, self).setUp()
         self.detector = RenameDetector(self.store)
 
+    def _batch_trees(self):
+        blob_a1 = make_object(Blob, data=b'a1')
+        blob_a2 = make_object(Blob, data=b'a2')
+        blob_b = make_object(Blob, data=b'b')
+        trees = [self.empty_tree,
+                 self.commit_tree([('a', blob_a1)]),
+                 self.commit_tree([('a', blob_a2), ('x/b', blob_b)]),
+                 self.commit_tree([('x/b', blob_b)])]
+        return [(trees[i].id, trees[i + 1].id) for i in range(3)] * 5
+
+    def test_tree_changes_batch(self):
+        pairs = self._batch_trees()
+        expected = [list(tree_changes(self.store, t1, t2)) for t1, t2 in pairs]
+        self.assertEqual(expected,
+                         list(tree_changes_batch(self.store, pairs)))
+        self.assertEqual(expected, list(tree_changes_batch(
+          self.store, iter(pairs), workers=2, chunksize=2)))
+
+    def test_tree_changes_batch_disk_store(self):
+        pairs = self._batch_trees()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = DiskObjectStore.init(path)
+        self.addCleanup(store.close)
+        store.add_objects([(self.store[sha], None) for sha in self.store])
+        expected = [list(tree_changes(store, t1, t2, want_unchanged=True))
+                    for t1, t2 in pairs]
+        self.assertEqual(expected, list(tree_changes_batch(
+          store, pairs, want_unchanged=True, workers=2)))
+
+    def test_tree_changes_batch_open_packs(self):
+        # The workers must not share the pack files already opened here
+        blobs = [make_object(Blob, data=('blob %d' % i).encode('ascii') * 100)
+                 for i in range(50)]
+        trees = [self.commit_tree([('f%d' % j, blobs[(i + j) % 50])
+                                   for j in range(20)])
+                 for i in range(50)]
+        pairs = [(trees[i].id, trees[i + 1].id) for i in range(49)] * 4
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = DiskObjectStore.init(path)
+        self.addCleanup(store.close)
+        store.add_objects([(self.store[sha], None) for sha in self.store])
+        expected = [list(tree_changes(store, t1, t2)) for t1, t2 in pairs]
+        self.assertEqual(expected, list(tree_changes_batch(
+          store, pairs, workers=4, chunksize=1)))
+
     def assertMergeFails(self, merge_entries, name, mode, sha):
         t = Tree()
         try:
@@ -294,6 +348,49 @@ class TreeChangesTest(DiffTestCase):
                       (b'a', F, blob_a2.id))],
           tree1, tree2)
 
+    def test_tree_changes_paths(self):
+        blob_a1 = make_object(Blob, data=b'a1')
+        blob_a2 = make_object(Blob, data=b'a2')
+        blob_x1 = make_object(Blob, data=b'x1')
+        blob_x2 = make_object(Blob, data=b'x2')
+        tree1 = self.commit_tree([('a', blob_a1), ('b/x', blob_x1),
+                                  ('b/y/z', blob_x1), ('c/x', blob_x1)])
+        tree2 = self.commit_tree([('a', blob_a2), ('b/x', blob_x2),
+                                  ('b/y/z', blob_x2), ('c/x', blob_x2)])
+        # Remove the unrelated subtrees so lookups will fail unless they are
+        # skipped.
+        for tree in (tree1, tree2):
+            del self.store[tree[b'c'][1]]
+            del self.store[self.store[tree[b'b'][1]][b'y'][1]]
+
+        self.assertEqual(
+          [TreeChange(CHANGE_MODIFY, (b'a', F, blob_a1.id),
+                      (b'a', F, blob_a2.id)),
+           TreeChange(CHANGE_MODIFY, (b'b/x', F, blob_x1.id),
+                      (b'b/x', F, blob_x2.id))],
+          list(tree_changes(self.store, tree1.id, tree2.id,
+                            paths=set([b'a', b'b/x']))))
+        self.assertEqual(
+          [TreeChange.add((b'b/x', F, blob_x2.id))],
+          list(tree_changes(self.store, None, tree2.id,
+                            paths=set([b'b/x', b'b/missing']))))
+        self.assertEqual([], list(tree_changes(self.store, tree1.id, tree2.id,
+                                               paths=set([b'a/x', b'd']))))
+
+    def test_walk_trees_paths(self):
+        blob = make_object(Blob, data=b'a')
+        tree = self.commit_tree([('a', blob), ('b/x', blob), ('b/y/z', blob),
+                                 ('bb', blob)])
+        paths = [entry2.path for _, entry2 in walk_trees(
+          self.store, None, tree.id, paths=set([b'b']))]
+        self.assertEqual([b'b', b'b/x', b'b/y', b'b/y/z'], paths)
+        paths = [entry2.path for _, entry2 in walk_trees(
+          self.store, None, tree.id, paths=set([b'b/y', b'a']))]
+        self.assertEqual([b'a', b'b/y', b'b/y/z'], paths)
+        self.assertEqual(len(list(walk_trees(self.store, None, tree.id))),
+                         len(list(walk_trees(self.store, None, tree.id,
+                                             paths=set([b''])))))
+
     def test_tree_changes_rename_detector(self):
         blob_a1 = make_object(Blob, data=b'a\nb\nc\nd\n')
         blob_a2 = make_object(Blob, data=b'a\nb\nc\ne\n')
@@ -510,6 +607,19 @@ class RenameDetectionTest(DiffTestCase):
     test_count_blocks_long_lines_extension = ext_functest_builder(
       _do_test_count_blocks_long_lines, _count_blocks)
 
+    def _do_test_count_blocks_block_boundaries(self, count_blocks):
+        a = b'a' * 63
+        data = a + b'\n' + a + b'\r\n' + b'b' * 65
+        blob = make_object(Blob, data=data)
+        self.assertEqual({hash(a + b'\n'): 64, hash(a + b'\r'): 64,
+                          hash(b'\n'): 1, hash(b'b' * 64): 64, hash(b'b'): 1},
+                         count_blocks(blob))
+
+    test_count_blocks_block_boundaries = functest_builder(
+      _do_test_count_blocks_block_boundaries, _count_blocks_py)
+    test_count_blocks_block_boundaries_extension = ext_functest_builder(
+      _do_test_count_blocks_block_boundaries, _count_blocks)
+
     def assertSimilar(self, expected_score, blob1, blob2):
         self.assertEqual(expected_score, _similarity_score(blob1, blob2))
         self.assertEqual(expected_score, _similarity_score(blob2, blob1))
@@ -687,6 +797,83 @@ class RenameDetectionTest(DiffTestCase):
            TreeChange.add((b'd', F, blob4.id))],
           self.detect_renames(tree1, tree2, max_files=1))
 
+    def test_content_rename_size_prefilter(self):
+        blob1 = make_object(Blob, data=b'a\nb\nc\nd\n')
+        blob2 = make_object(Blob, data=b'a\nb\nc\ne\n')
+        blob3 = make_object(Blob, data=b'a\nb\nc\nd\n' * 10)
+        tree1 = self.commit_tree([('a', blob1)])
+        tree2 = self.commit_tree([('b', blob2), ('c', blob3)])
+        block_cache = {}
+        self.assertEqual(
+          [TreeChange(CHANGE_RENAME, (b'a', F, blob1.id), (b'b', F, blob2.id)),
+           TreeChange.add((b'c', F, blob3.id))],
+          self.detect_renames(tree1, tree2, block_cache=block_cache))
+        # blob3 is too large to be a rename of blob1, so it is never counted
+        self.assertEqual(set([blob1.id, blob2.id]), set(block_cache))
+
+    def test_content_rename_block_cache_reused(self):
+        blob1 = make_object(Blob, data=b'a\nb\nc\nd\n')
+        blob2 = make_object(Blob, data=b'a\nb\nc\ne\n')
+        tree1 = self.commit_tree([('a', blob1)])
+        tree2 = self.commit_tree([('b', blob2)])
+        detector = RenameDetector(self.store)
+        detector.changes_with_renames(tree1.id, tree2.id)
+        cached = detector._block_cache[blob1.id]
+        self.assertEqual(
+          [TreeChange(CHANGE_RENAME, (b'a', F, blob1.id), (b'b', F, blob2.id))],
+          detector.changes_with_renames(tree1.id, tree2.id))
+        self.assertTrue(cached is detector._block_cache[blob1.id])
+
+    def test_content_rename_no_max_files(self):
+        blob1 = make_object(Blob, data=b'a\nb\nc\nd')
+        blob2 = make_object(Blob, data=b'a\nb\nc\ne\n')
+        tree1 = self.commit_tree([('a', blob1)])
+        tree2 = self.commit_tree([('b', blob2)])
+        self.assertEqual(
+          [TreeChange(CHANGE_RENAME, (b'a', F, blob1.id), (b'b', F, blob2.id))],
+          self.detect_renames(tree1, tree2, max_files=None))
+
+    def test_content_rename_approximate(self):
+        blob1 = make_object(Blob, data=b'a\nb\nc\nd\ne\nf\ng\nh\ni\nj\n')
+        blob2 = make_object(Blob, data=b'a\nb\nc\nd\ne\nf\ng\nh\ni\nk\n')
+        blob3 = make_object(Blob, data=b'1\n2\n3\n4\n5\n6\n7\n8\n9\n0\n')
+        blob4 = make_object(Blob, data=b'1\n2\n3\n4\n5\n6\n7\n8\n9\nx\n')
+        tree1 = self.commit_tree([('a', blob1), ('b', blob3)])
+        tree2 = self.commit_tree([('c', blob2), ('d', blob4)])
+        expected = [
+          TreeChange(CHANGE_RENAME, (b'a', F, blob1.id), (b'c', F, blob2.id)),
+          TreeChange(CHANGE_RENAME, (b'b', F, blob3.id), (b'd', F, blob4.id))]
+        self.assertEqual(expected, self.detect_renames(tree1, tree2))
+        self.assertEqual(
+          [TreeChange.delete((b'a', F, blob1.id)),
+           TreeChange.delete((b'b', F, blob3.id)),
+           TreeChange.add((b'c', F, blob2.id)),
+           TreeChange.add((b'd', F, blob4.id))],
+          self.detect_renames(tree1, tree2, max_files=1))
+        self.assertEqual(expected, self.detect_renames(
+          tree1, tree2, max_files=1, approximate_renames=True))
+
+    def test_content_rename_approximate_bucket_cap(self):
+        blob1 = make_object(Blob, data=b'a\nb\nc\nd\ne\nf\ng\nh\ni\nj\n')
+        blob2 = make_object(Blob, data=b'a\nb\nc\nd\ne\nf\ng\nh\ni\nk\n')
+        tree1 = self.commit_tree([('a', blob1)])
+        tree2 = self.commit_tree([('b', blob2), ('c', blob2)])
+        self.assertEqual(
+          [TreeChange(CHANGE_RENAME, (b'a', F, blob1.id), (b'b', F, blob2.id)),
+           TreeChange(CHANGE_COPY, (b'a', F, blob1.id), (b'c', F, blob2.id))],
+          self.detect_renames(tree1, tree2, max_files=1,
+                              approximate_renames=True))
+        # Every bucket holds both adds, so none of them is compared
+        self.addCleanup(setattr, diff_tree, '_MINHASH_MAX_BUCKET_PAIRS',
+                        diff_tree._MINHASH_MAX_BUCKET_PAIRS)
+        diff_tree._MINHASH_MAX_BUCKET_PAIRS = 1
+        self.assertEqual(
+          [TreeChange.delete((b'a', F, blob1.id)),
+           TreeChange.add((b'b', F, blob2.id)),
+           TreeChange.add((b'c', F, blob2.id))],
+          self.detect_renames(tree1, tree2, max_files=1,
+                              approximate_renames=True))
+
     def test_content_rename_one_to_one(self):
         b11 = make_object(Blob, data=b'a\nb\nc\nd\n')
         b12 = make_object(Blob, data=b'a\nb\nc\ne\n')
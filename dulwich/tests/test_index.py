@@ -43,6 +43,7 @@ from dulwich.objects import (
     Blob,
     Sha1Sum,
     )
+from dulwich.pathspec import PathSpec
 from dulwich.tests import TestCase
 
 
@@ -126,6 +127,53 @@ class CommitTreeTests(TestCase):
                           set(self.store._data.keys()))
 
 
+class ChangesFromTreeTests(TestCase):
+
+    def setUp(self):
+        super(ChangesFromTreeTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.index = Index(os.path.join(os.path.dirname(__file__),
+                                        'data/indexes/notanindex'))
+        self.blob_a = Blob.from_string(b'a')
+        self.blob_b = Blob.from_string(b'b')
+        self.store.add_object(self.blob_a)
+        self.store.add_object(self.blob_b)
+        self.tree_id = commit_tree(self.store, [
+          ('a', self.blob_a.id, 0o100644),
+          ('d/a', self.blob_a.id, 0o100644),
+          ('d/b', self.blob_a.id, 0o100644),
+          ])
+        for name, blob in [(b'a', self.blob_b), (b'd/a', self.blob_a),
+                           (b'd/b', self.blob_b), (b'e', self.blob_a)]:
+            self.index[name] = ((0, 0), (0, 0), 0, 0, 0o100644, 0, 0, 0,
+                                blob.id, 0)
+
+    def test_changes_from_tree(self):
+        self.assertEqual([
+          ((b'a', b'a'), (0o100644, 0o100644),
+           (self.blob_a.id, self.blob_b.id)),
+          ((b'd/b', b'd/b'), (0o100644, 0o100644),
+           (self.blob_a.id, self.blob_b.id)),
+          ((None, b'e'), (None, 0o100644), (None, self.blob_a.id)),
+          ], list(self.index.changes_from_tree(self.store, self.tree_id)))
+
+    def test_changes_from_tree_paths(self):
+        self.assertEqual([
+          ((b'd/b', b'd/b'), (0o100644, 0o100644),
+           (self.blob_a.id, self.blob_b.id)),
+          ((None, b'e'), (None, 0o100644), (None, self.blob_a.id)),
+          ], list(self.index.changes_from_tree(self.store, self.tree_id,
+                                               paths=[b'd', b'e'])))
+        self.assertEqual([
+          ((b'd/b', b'd/b'), (0o100644, 0o100644),
+           (self.blob_a.id, self.blob_b.id)),
+          ], list(self.index.changes_from_tree(self.store, self.tree_id,
+                                               paths=PathSpec([b'*/b']))))
+        # Plain paths are matched literally
+        self.assertEqual([], list(self.index.changes_from_tree(
+          self.store, self.tree_id, paths=[b'*/b'])))
+
+
 class CleanupModeTests(TestCase):
 
     def test_file(self):
@@ -0,0 +1,176 @@
+# test_mirror.py -- Tests for the concurrent fetch driver
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for dulwich.mirror."""
+
+import threading
+import time
+
+from dulwich.client import (
+    HttpGitClient,
+    get_transport_and_path,
+    )
+from dulwich.mirror import (
+    MirrorDriver,
+    _host_key,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+
+
+class FakeClient(object):
+
+    def __init__(self, tracker, host):
+        self._tracker = tracker
+        self._host = host
+
+    def fetch(self, path, target, determine_wants=None, progress=None):
+        self._tracker.enter(self._host)
+        try:
+            time.sleep(0.01)
+            if path == '/broken':
+                raise IOError('broken')
+            return {b'HEAD': path}
+        finally:
+            self._tracker.leave(self._host)
+
+
+class ConcurrencyTracker(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+
+    def enter(self, host):
+        with self._lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.max_running[host] = max(self.max_running.get(host, 0),
+                                         self.running[host])
+
+    def leave(self, host):
+        with self._lock:
+            self.running[host] -= 1
+
+
+class MirrorDriverTests(TestCase):
+
+    def setUp(self):
+        super(MirrorDriverTests, self).setUp()
+        self.tracker = ConcurrencyTracker()
+
+    def get_client(self, url):
+        client, path = get_transport_and_path(url)
+        return FakeClient(self.tracker, _host_key(url)), path
+
+    def test_results_in_order(self):
+        driver = MirrorDriver(max_workers=4, get_client=self.get_client)
+        urls = ['git://a.com/%d' % i for i in range(10)]
+        results = driver.fetch([(url, None) for url in urls])
+        self.assertEqual(urls, [r.url for r in results])
+        self.assertEqual(['/%d' % i for i in range(10)],
+                         [r.refs[b'HEAD'] for r in results])
+        for result in results:
+            self.assertTrue(result.ok)
+            self.assertTrue(result.duration >= 0)
+
+    def test_per_host_limit(self):
+        driver = MirrorDriver(max_workers=8, max_per_host=2,
+                              get_client=self.get_client)
+        jobs = [('git://%s/%d' % (host, i), None)
+                for i in range(8) for host in ('a.com', 'b.com')]
+        driver.fetch(jobs)
+        self.assertEqual(2, self.tracker.max_running['a.com'])
+        self.assertEqual(2, self.tracker.max_running['b.com'])
+
+    def test_error_recorded(self):
+        driver = MirrorDriver(get_client=self.get_client)
+        reported = []
+        results = driver.fetch([('git://a.com/broken', None),
+                                ('git://a.com/ok', None)],
+                               report=reported.append)
+        self.assertFalse(results[0].ok)
+        self.assertTrue(isinstance(results[0].error, IOError))
+        self.assertEqual(None, results[0].refs)
+        self.assertTrue(results[1].ok)
+        self.assertEqual(set(results), set(reported))
+
+    def test_busy_host_does_not_starve_others(self):
+        other_done = threading.Event()
+        finished = []
+
+        class BlockingClient(object):
+
+            def fetch(self, path, target, determine_wants=None,
+                      progress=None):
+                if path.startswith('/a'):
+                    # Only returns early if b.com got a worker meanwhile
+                    other_done.wait(5)
+                else:
+                    other_done.set()
+                finished.append(path)
+                return {}
+
+        def get_client(url):
+            client, path = get_transport_and_path(url)
+            return BlockingClient(), path
+
+        driver = MirrorDriver(max_workers=2, max_per_host=1,
+                              get_client=get_client)
+        jobs = [('git://a.com/a%d' % i, None) for i in range(3)]
+        jobs.append(('git://b.com/b', None))
+        results = driver.fetch(jobs)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual('/b', finished[0])
+
+    def test_report_error_propagates(self):
+        driver = MirrorDriver(get_client=self.get_client)
+
+        def report(result):
+            raise RuntimeError('report failed')
+
+        self.assertRaisesRegex(RuntimeError, 'report failed', driver.fetch,
+                               [('git://a.com/x', None)], report=report)
+
+    def test_http_clients_share_pool(self):
+        clients = []
+
+        def get_http_client(url):
+            client, path = get_transport_and_path(url)
+            clients.append(client)
+            client.fetch = lambda *args, **kwargs: {}
+            return client, path
+
+        driver = MirrorDriver(get_client=get_http_client)
+        driver.fetch([('http://a.com/x', None), ('http://a.com/y', None)])
+        self.assertTrue(isinstance(clients[-1], HttpGitClient))
+        self.assertTrue(clients[-1].pool is driver.http_pool)
+        self.assertTrue(clients[-2].pool is driver.http_pool)
+
+
+class HostKeyTests(TestCase):
+
+    def test_host_key(self):
+        self.assertEqual('foo.com', _host_key('git://foo.com/bar'))
+        self.assertEqual('foo.com', _host_key('https://foo.com:8080/bar'))
+        self.assertEqual('foo.com', _host_key('git+ssh://me@foo.com/bar'))
+        self.assertEqual('foo.com', _host_key('me@foo.com:bar'))
+        self.assertEqual('foo', _host_key('foo:/bar'))
+        self.assertEqual(None, _host_key('/srv/git/bar'))
@@ -21,7 +21,9 @@
 
 from io import BytesIO
 import os
+import pickle
 import shutil
+import stat
 import tempfile
 
 from dulwich.index import (
@@ -41,6 +43,7 @@ from dulwich.objects import (
 from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
+    MissingObjectFinder,
     ObjectStoreGraphWalker,
     tree_lookup_path,
     )
@@ -48,10 +51,12 @@ from dulwich.pack import (
     REF_DELTA,
     write_pack_objects,
     )
+from dulwich.pathspec import PathSpec
 from dulwich.tests import (
     TestCase,
     )
 from dulwich.tests.utils import (
+    make_commit,
     make_object,
     build_pack,
     )
@@ -167,6 +172,34 @@ class ObjectStoreTests(object):
         actual = self.store.iter_tree_contents(tree_id, include_trees=True)
         self.assertEqual(expected, list(actual))
 
+    def test_iter_tree_contents_paths(self):
+        blob_a = make_object(Blob, data=b'a')
+        blob_b = make_object(Blob, data=b'b')
+        blob_c = make_object(Blob, data=b'c')
+        for blob in [blob_a, blob_b, blob_c]:
+            self.store.add_object(blob)
+
+        blobs = [
+          ('a', blob_a.id, 0o100644),
+          ('ad/b', blob_b.id, 0o100644),
+          ('ad/bd/c', blob_c.id, 0o100755),
+          ('ad/c', blob_c.id, 0o100644),
+          ('c', blob_c.id, 0o100644),
+          ]
+        tree_id = commit_tree(self.store, blobs)
+        self.assertEqual(
+          [TreeEntry(b'ad/bd/c', 0o100755, blob_c.id),
+           TreeEntry(b'c', 0o100644, blob_c.id)],
+          list(self.store.iter_tree_contents(tree_id,
+                                             paths=[b'ad/bd', b'c'])))
+        self.assertEqual(
+          [TreeEntry(b'ad/b', 0o100644, blob_b.id),
+           TreeEntry(b'ad/c', 0o100644, blob_c.id)],
+          list(self.store.iter_tree_contents(tree_id,
+                                             paths=PathSpec([b'*/?']))))
+        self.assertEqual([], list(self.store.iter_tree_contents(
+          tree_id, paths=[b'*/?'])))
+
     def make_tag(self, name, obj):
         tag = make_object(Tag, name=name, message='',
                           tag_time=12345, tag_timezone=0,
@@ -195,6 +228,13 @@ class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
         TestCase.setUp(self)
         self.store = MemoryObjectStore()
 
+    def test_pickle(self):
+        self.store.add_object(testobject)
+        testobject.id  # make sure the object holds its hash state
+        store = pickle.loads(pickle.dumps(self.store))
+        self.assertEqual([testobject.id], list(store))
+        self.assertEqual(testobject, store[testobject.id])
+
 
 class PackBasedObjectStoreTests(ObjectStoreTests):
 
@@ -280,6 +320,202 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
                     self.assertEqual((Blob.type_num, b'more yummy data'),
                                      o.get_raw(packed_blob_sha))
 
+    def test_rescan_keeps_packs(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        self.store.add_objects([(b1, None)])
+        packs = self.store.packs
+        self.assertEqual(1, len(packs))
+        with DiskObjectStore(self.store_dir) as other:
+            b2 = make_object(Blob, data=b"more yummy data")
+            other.add_objects([(b2, None)])
+        self.store._pack_cache_time = 0
+        new_packs = self.store.packs
+        self.assertEqual(2, len(new_packs))
+        self.assertTrue(any(p is packs[0] for p in new_packs))
+        self.assertEqual(b2, self.store[b2.id])
+        self.assertNotEqual(None, self.store.pack_rescan_time)
+
+    def test_rescan_removed_pack(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        pack = self.store.add_objects([(b1, None)])
+        self.assertEqual([pack], self.store.packs)
+        pack.index
+        for ext in ('.pack', '.idx'):
+            os.remove(pack._basename + ext)
+        self.store._pack_cache_time = 0
+        self.assertEqual([], self.store.packs)
+        self.assertEqual(None, pack._idx)
+        self.assertRaises(KeyError, self.store.__getitem__, b1.id)
+
+    def test_add_known_pack_twice(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        pack1 = self.store.add_objects([(b1, None)])
+        pack1.index
+        pack2 = self.store.add_objects([(b1, None)])
+        self.assertEqual(1, len(self.store.packs))
+        self.assertTrue(pack2 is self.store.packs[0])
+        self.assertTrue(pack1 is not pack2)
+        self.assertEqual(None, pack1._idx)
+        self.assertEqual(None, pack1._data)
+
+    def test_rescan_replaced_pack(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        pack = self.store.add_objects([(b1, None)])
+        self.assertEqual([pack], self.store.packs)
+        pack.index
+        # Rewrite the pack under the same name.
+        st = os.stat(pack._basename + '.pack')
+        os.utime(pack._basename + '.pack',
+                 ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.store._pack_cache_time = 0
+        new_packs = self.store.packs
+        self.assertEqual(1, len(new_packs))
+        self.assertTrue(new_packs[0] is not pack)
+        self.assertEqual(None, pack._idx)
+        self.assertEqual(b1, self.store[b1.id])
+
+
+    def test_loose_cache_sees_other_writers(self):
+        b = make_object(Blob, data=b"yummy data")
+        self.assertFalse(self.store.contains_loose(b.id))
+        with DiskObjectStore(self.store_dir) as other:
+            other.add_object(b)
+        self.assertTrue(self.store.contains_loose(b.id))
+        self.assertEqual(b, self.store[b.id])
+
+    def test_loose_cache_ttl(self):
+        b = make_object(Blob, data=b"yummy data")
+        self.store.loose_cache_ttl = 3600
+        self.assertFalse(self.store.contains_loose(b.id))
+        with DiskObjectStore(self.store_dir) as other:
+            other.add_object(b)
+        # The cached listing is trusted, so the new object is not seen
+        self.assertFalse(self.store.contains_loose(b.id))
+        self.store.add_object(b)
+        self.assertTrue(self.store.contains_loose(b.id))
+
+    def test_remove_loose_object(self):
+        b = make_object(Blob, data=b"yummy data")
+        self.store.add_object(b)
+        self.store._remove_loose_object(b.id)
+        self.assertFalse(self.store.contains_loose(b.id))
+        self.assertRaises(KeyError, self.store.__getitem__, b.id)
+
+    def test_add_objects_loose(self):
+        blobs = [make_object(Blob, data=("blob %d" % i).encode('ascii'))
+                 for i in range(20)]
+        self.store.add_object(blobs[0])
+        objects = [(b, None) for b in blobs]
+        self.assertEqual(19, self.store.add_objects_loose(
+            objects + objects[:3], fsync=True))
+        self.assertEqual(sorted(b.id for b in blobs),
+                         sorted(self.store._iter_loose_objects()))
+        with DiskObjectStore(self.store_dir) as other:
+            for b in blobs:
+                self.assertEqual(b, other[b.id])
+        for fanout in os.listdir(self.store_dir):
+            if len(fanout) == 2:
+                for name in os.listdir(os.path.join(self.store_dir, fanout)):
+                    self.assertEqual(38, len(name))
+
+    def test_add_objects_loose_mode(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        old_umask = os.umask(0o022)
+        try:
+            self.store.add_object(b1)
+            self.store.add_objects_loose([(b2, None)])
+        finally:
+            os.umask(old_umask)
+        mode1 = os.stat(self.store._get_shafile_path(b1.id)).st_mode
+        mode2 = os.stat(self.store._get_shafile_path(b2.id)).st_mode
+        self.assertEqual(0o644, stat.S_IMODE(mode2) & 0o666)
+        self.assertEqual(stat.S_IMODE(mode1), stat.S_IMODE(mode2))
+
+    def test_loose_cache_sees_concurrent_writers(self):
+        # Pick two blobs in the same fan-out directory
+        blobs = {}
+        i = 0
+        while True:
+            b = make_object(Blob, data=("blob %d" % i).encode('ascii'))
+            i += 1
+            other_blob = blobs.setdefault(b.id.string[:2], b)
+            if other_blob is not b:
+                break
+        self.store.loose_cache_ttl = 3600
+        self.assertFalse(self.store.contains_loose(b.id))
+        with DiskObjectStore(self.store_dir) as other:
+            other.add_object(other_blob)
+        # A local write to the directory must not hide the other write
+        self.store.add_objects_loose([(b, None)])
+        self.assertTrue(self.store.contains_loose(other_blob.id))
+        self.assertTrue(self.store.contains_loose(b.id))
+
+    def test_remove_loose_during_iteration(self):
+        # Pick two blobs in the same fan-out directory
+        blobs = {}
+        i = 0
+        while True:
+            b = make_object(Blob, data=("blob %d" % i).encode('ascii'))
+            i += 1
+            other_blob = blobs.setdefault(b.id.string[:2], b)
+            if other_blob is not b:
+                break
+        self.store.loose_cache_ttl = 60
+        self.store.add_objects_loose([(b, None), (other_blob, None)])
+        removed = []
+        for sha in self.store._iter_loose_objects():
+            self.store._remove_loose_object(sha)
+            removed.append(sha)
+        self.assertEqual(set([b.id, other_blob.id]), set(removed))
+        self.assertFalse(self.store.contains_loose(b.id))
+        self.assertEqual(None, self.store._get_loose_object(other_blob.id))
+
+    def test_staging(self):
+        self.store.start_staging()
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_object(b1)
+        self.assertEqual(None, self.store.add_objects([(b2, None)]))
+        self.assertEqual([], self.store.packs)
+        self.assertFalse(self.store.contains_loose(b1.id))
+        self.assertTrue(b1.id in self.store)
+        self.assertEqual(b2, self.store[b2.id])
+        self.assertEqual(sorted([b1.id, b2.id]), sorted(self.store))
+        pack = self.store.flush_staging()
+        self.assertEqual([pack], self.store.packs)
+        pack.check()
+        self.assertEqual(sorted([b1.id, b2.id]), sorted(pack))
+        with DiskObjectStore(self.store_dir) as other:
+            self.assertEqual(b1, other[b1.id])
+        self.assertEqual(None, self.store.flush_staging())
+
+    def test_staging_max_bytes(self):
+        self.store.start_staging(max_bytes=1)
+        b1 = make_object(Blob, data=b"yummy data")
+        self.store.add_object(b1)
+        self.assertEqual(1, len(self.store.packs))
+        self.assertEqual(b1, self.store[b1.id])
+
+    def test_staging_skips_present(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.start_staging()
+        self.store.add_object(b1)
+        self.assertEqual(None, self.store.flush_staging())
+
+    def test_stop_staging(self):
+        self.store.start_staging()
+        b1 = make_object(Blob, data=b"yummy data")
+        self.store.add_object(b1)
+        self.store.stop_staging()
+        self.assertFalse(self.store.staging)
+        self.assertEqual(1, len(self.store.packs))
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_object(b2)
+        self.assertTrue(self.store.contains_loose(b2.id))
+
+
 class TreeLookupPathTests(TestCase):
 
     def setUp(self):
@@ -321,7 +557,20 @@ class TreeLookupPathTests(TestCase):
     def test_lookup_not_tree(self):
         self.assertRaises(NotTreeError, tree_lookup_path, self.get_object, self.tree_id, 'ad/b/j')
 
-# TODO: MissingObjectFinderTests
+
+class MissingObjectFinderTests(TestCase):
+
+    def test_parse_commit(self):
+        parent = make_commit()
+        commit = make_commit(parents=[parent.id])
+        expected = set([(commit.tree, "", False), (parent.id, None, False)])
+        finder = MissingObjectFinder(MemoryObjectStore(), [], [])
+        finder.parse_commit(commit)
+        self.assertEqual(expected, finder.objects_to_send)
+        finder = MissingObjectFinder(MemoryObjectStore(), [], [])
+        finder.parse_commit_text(commit.as_raw_string())
+        self.assertEqual(expected, finder.objects_to_send)
+
 
 class ObjectStoreGraphWalkerTests(TestCase):
 
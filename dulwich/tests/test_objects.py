@@ -45,6 +45,8 @@ from dulwich.objects import (
     check_hexsha,
     check_identity,
     parse_timezone,
+    parse_commit_header,
+    _parse_commit_header_py,
     TreeEntry,
     parse_tree,
     _parse_tree_py,
@@ -419,6 +421,30 @@ class CommitParseTests(ShaFileCheckTests):
             else:
                 self.assertCheckFails(Commit, text)
 
+    def _do_test_parse_commit_header(self, parse_commit_header):
+        tree = Sha1Sum('d80c186a03f423a81b39df39dc87fd269736ca86')
+        parents = [Sha1Sum('ab64bbdcc51b170d21588e5c5d391ee5c0c96dfd'),
+                   Sha1Sum('4cffe90e0a41ad3f5190079d7c8f036bde29cbe6')]
+        self.assertEqual((tree, parents, 1174773719),
+                         parse_commit_header(self.make_commit_text()))
+        self.assertEqual((tree, [], 1174773719), parse_commit_header(
+          self.make_commit_text(parents=None, encoding='UTF-8')))
+        self.assertEqual((tree, parents, 1174773719), parse_commit_header(
+          self.make_commit_text(message=None)[:-1]))
+        self.assertRaises(ObjectFormatException, parse_commit_header,
+                          self.make_commit_text(tree=None))
+        self.assertRaises(ObjectFormatException, parse_commit_header,
+                          self.make_commit_text(committer=None))
+        self.assertRaises(ObjectFormatException, parse_commit_header,
+                          self.make_commit_text(committer='Jelmer <jelmer>'))
+        self.assertRaises(ObjectFormatException, parse_commit_header,
+                          self.make_commit_text(committer='Jelmer x +0000'))
+
+    test_parse_commit_header = functest_builder(
+      _do_test_parse_commit_header, _parse_commit_header_py)
+    test_parse_commit_header_extension = ext_functest_builder(
+      _do_test_parse_commit_header, parse_commit_header)
+
 
 _TREE_ITEMS = {
   b'a.c': (0o100755, Sha1Sum('d80c186a03f423a81b39df39dc87fd269736ca86')),
@@ -21,14 +21,18 @@
 
 
 from io import BytesIO
+import gc
 import os
 import shutil
 import tempfile
+import weakref
 import zlib
 import hashlib
 
 from dulwich.errors import (
+    ApplyDeltaError,
     ChecksumMismatch,
+    ObjectFormatException,
     )
 from dulwich.file import (
     GitFile,
@@ -50,12 +54,15 @@ from dulwich.pack import (
     MemoryPackIndex,
     Pack,
     PackData,
+    PackFileManager,
     apply_delta,
+    check_pack_objects,
     create_delta,
     deltify_pack_objects,
     load_pack_index,
     UnpackedObject,
     read_zlib_chunks,
+    write_pack_data,
     write_pack_header,
     write_pack_index_v1,
     write_pack_index_v2,
@@ -400,6 +407,198 @@ class TestPack(PackTests):
             self.assertTrue(isinstance(objs[tree_sha], Tree))
             self.assertTrue(isinstance(objs[commit_sha], Commit))
 
+class PackFileManagerTests(PackTests):
+
+    def copy_pack(self, name):
+        basename = os.path.join(self.tempdir, name)
+        src = os.path.join(self.datadir, 'pack-%s' % pack1_sha)
+        for ext in ('.pack', '.idx'):
+            shutil.copyfile(src + ext, basename + ext)
+        return basename
+
+    def get_packs(self, manager, count):
+        packs = [Pack(self.copy_pack('pack%d' % i), file_manager=manager)
+                 for i in range(count)]
+        for p in packs:
+            self.addCleanup(p.close)
+        return packs
+
+    def test_max_open_packs(self):
+        manager = PackFileManager(max_open_packs=2)
+        p1, p2, p3 = self.get_packs(manager, 3)
+        p1.data
+        p2.data
+        self.assertEqual(2, manager.open_packs())
+        p3.data
+        self.assertEqual(2, manager.open_packs())
+        self.assertEqual(None, p1._data)
+        self.assertNotEqual(None, p2._data)
+        self.assertNotEqual(None, p3._data)
+
+    def test_least_recently_opened(self):
+        manager = PackFileManager(max_open_packs=2)
+        p1, p2, p3 = self.get_packs(manager, 3)
+        p1.data
+        p2.data
+        p3.data
+        self.assertEqual(None, p1._data)
+        # Reopening p1 makes it the most recently opened pack.
+        p1.data
+        self.assertNotEqual(None, p1._data)
+        self.assertEqual(None, p2._data)
+
+    def test_evicted_files_closed(self):
+        manager = PackFileManager(max_open_packs=1)
+        p1, p2 = self.get_packs(manager, 2)
+        data = p1.data
+        index = p1.index
+        p2.data
+        self.assertEqual(None, data._file_obj)
+        self.assertEqual(None, p1._idx)
+        # The evicted index can still be used by those holding it.
+        self.assertEqual(3, len(list(index)))
+
+    def test_weak_references(self):
+        manager = PackFileManager()
+        p1 = Pack(self.copy_pack('pack0'), file_manager=manager)
+        p1.data
+        self.assertEqual(1, len(manager))
+        p1.close()
+        p2 = Pack(self.copy_pack('pack1'), file_manager=manager)
+        p2.index
+        self.assertEqual(1, len(manager))
+        # The manager does not keep p2 alive.
+        p2_ref = weakref.ref(p2)
+        index = p2._idx
+        del p2
+        gc.collect()
+        self.assertEqual(None, p2_ref())
+        self.assertEqual(0, len(manager))
+        index.close()
+
+    def test_max_mapped_bytes(self):
+        manager = PackFileManager(max_mapped_bytes=1)
+        p1, p2 = self.get_packs(manager, 2)
+        p1.index
+        p2.index
+        self.assertEqual(None, p1._idx)
+        self.assertNotEqual(None, p2._idx)
+        self.assertEqual(p2.index._size, manager.mapped_bytes())
+
+    def test_reopen(self):
+        manager = PackFileManager(max_open_packs=1)
+        p1, p2 = self.get_packs(manager, 2)
+        self.assertEqual(Tree, type(p1[tree_sha]))
+        self.assertEqual(Tree, type(p2[tree_sha]))
+        self.assertEqual(None, p1._data)
+        self.assertEqual(Tree, type(p1[tree_sha]))
+        self.assertEqual(1, manager.open_packs())
+
+    def test_evict_during_iteration(self):
+        manager = PackFileManager(max_open_packs=1)
+        p1, p2 = self.get_packs(manager, 2)
+        objects = p1.iterobjects()
+        next(objects)
+        p2.data
+        self.assertEqual(None, p1._data)
+        self.assertEqual(2, len(list(objects)))
+
+    def test_evict_index_during_iteration(self):
+        manager = PackFileManager(max_open_packs=1)
+        p1, p2, p3 = self.get_packs(manager, 3)
+        seen = []
+        for sha in p1:
+            self.assertEqual(sha, p2[sha].id)
+            self.assertEqual(sha, p3[sha].id)
+            seen.append(sha)
+        self.assertEqual(3, len(seen))
+
+    def test_close(self):
+        manager = PackFileManager()
+        p1, = self.get_packs(manager, 1)
+        p1.data
+        p1.index
+        self.assertEqual(1, len(manager))
+        p1.close()
+        self.assertEqual(0, len(manager))
+        self.assertEqual(None, p1._idx)
+
+
+class ParallelCheckTests(PackTests):
+
+    def write_pack(self, spec):
+        basename = os.path.join(self.tempdir, 'pack-check')
+        with open(basename + '.pack', 'wb') as f:
+            build_pack(f, spec)
+        with PackData(basename + '.pack') as data:
+            data.create_index(basename + '.idx')
+        p = Pack(basename)
+        self.addCleanup(p.close)
+        return p
+
+    def delta_pack(self):
+        spec = []
+        for i in range(20):
+            spec.append((Blob.type_num, ('blob %d' % i).encode('ascii') * 50))
+            spec.append((OFS_DELTA, (len(spec) - 1,
+                ('blob %d!' % i).encode('ascii') * 50)))
+            spec.append((REF_DELTA, (len(spec) - 1,
+                ('blob %d!!' % i).encode('ascii') * 50)))
+        return self.write_pack(spec)
+
+    def test_check(self):
+        p = self.delta_pack()
+        p.check()
+        progress = []
+        p.check(workers=4, progress=lambda i, n: progress.append((i, n)))
+        self.assertEqual((60, 60), progress[-1])
+
+    def test_check_serial_progress(self):
+        p = self.delta_pack()
+        progress = []
+        p.check(progress=lambda i, n: progress.append((i, n)))
+        self.assertEqual([(i, 60) for i in range(1, 61)], progress)
+
+    def test_check_corrupt_object(self):
+        p = self.write_pack([
+            (Blob.type_num, b'blob'),
+            (Commit.type_num, b'not a commit'),
+            ])
+        self.assertRaises(ObjectFormatException, p.check)
+        self.assertRaises(ObjectFormatException, p.check, workers=2)
+
+    def test_check_existing_pack(self):
+        with self.get_pack(pack1_sha) as p:
+            p.check(workers=2)
+
+    def swapped_index(self, p):
+        # Index that lists the SHAs of the two objects in the pack the
+        # wrong way round
+        (sha1, offset1, crc1), (sha2, offset2, crc2) = sorted(
+            p.index.iterentries())
+        return MemoryPackIndex(
+            [(sha1, offset2, crc2), (sha2, offset1, crc1)],
+            p.index.get_pack_checksum())
+
+    def test_check_index_mismatch(self):
+        p = self.write_pack([
+            (Blob.type_num, b'blob'),
+            (Blob.type_num, b'other blob'),
+            ])
+        self.assertRaises(ChecksumMismatch, check_pack_objects,
+                          self.swapped_index(p), p.data, 2)
+
+    def test_check_delta_cycle(self):
+        p = self.write_pack([
+            (Blob.type_num, b'blob' * 10),
+            (REF_DELTA, (0, b'blob!' * 10)),
+            ])
+        # According to the index the delta is based on itself
+        self.assertRaisesRegex(
+            ApplyDeltaError, 'does not lead to a full object',
+            check_pack_objects, self.swapped_index(p), p.data, 2)
+
+
 class WritePackTests(TestCase):
 
     def test_write_pack_header(self):
@@ -436,6 +635,40 @@ class WritePackTests(TestCase):
             sha_b.update(f.getvalue()[offset:])
             self.assertEqual(sha_a.digest(), sha_b.digest())
 
+    def test_write_pack_object_compression_level(self):
+        with BytesIO() as f:
+            write_pack_object(f, Blob.type_num, b'blob' * 100,
+                              compression_level=0)
+            stored = f.getvalue()
+        with BytesIO() as f:
+            write_pack_object(f, Blob.type_num, b'blob' * 100,
+                              compression_level=9)
+            self.assertTrue(len(f.getvalue()) < len(stored))
+
+    def _write_pack_data(self, **kwargs):
+        blobs = [make_object(Blob, data=("blob %d" % i).encode('ascii') * i)
+                 for i in range(100)]
+        records = [(b.type_num, b.id.bytes, None, b.as_raw_string())
+                   for b in blobs]
+        # A delta against an earlier object and one against a missing base
+        records.append((Blob.type_num, b'1' * 20, blobs[3].id.bytes,
+                        create_delta(blobs[3].as_raw_string(), b'blob 3!')))
+        records.append((Blob.type_num, b'2' * 20, b'3' * 20, b'delta'))
+        with BytesIO() as f:
+            entries, sha = write_pack_data(f, len(records), iter(records),
+                                           **kwargs)
+            return f.getvalue(), entries, sha
+
+    def test_write_pack_data_workers(self):
+        expected = self._write_pack_data()
+        self.assertEqual(expected, self._write_pack_data(workers=4))
+
+    def test_write_pack_data_compression_level(self):
+        data, entries, sha = self._write_pack_data(compression_level=0,
+                                                   workers=2)
+        self.assertTrue(len(data) > len(self._write_pack_data()[0]))
+        self.assertEqual(hashlib.sha1(data[:-20]).digest(), sha)
+
 
 pack_checksum = Sha1Sum('721980e866af9a5f93ad674144e1459b8ba3e7b7')
 
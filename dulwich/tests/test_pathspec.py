@@ -0,0 +1,125 @@
+# test_pathspec.py -- Tests for matching paths against path patterns
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for matching paths against path patterns."""
+
+from dulwich.pathspec import (
+    MATCH,
+    MATCH_LEADING,
+    MATCH_NONE,
+    PathSpec,
+    as_pathspec,
+    literal_prefix,
+    )
+from dulwich.tests import TestCase
+
+
+class PathSpecTests(TestCase):
+
+    def test_match(self):
+        spec = PathSpec([b'foo', b'bar/baz/', b'bar/quux'])
+        self.assertEqual(MATCH, spec.match(b'foo'))
+        self.assertEqual(MATCH, spec.match(b'foo/a/b'))
+        self.assertEqual(MATCH, spec.match(b'bar/baz'))
+        self.assertEqual(MATCH, spec.match(b'bar/quux/a'))
+        self.assertEqual(MATCH_LEADING, spec.match(b''))
+        self.assertEqual(MATCH_LEADING, spec.match(b'bar'))
+        self.assertEqual(MATCH_NONE, spec.match(b'fool'))
+        self.assertEqual(MATCH_NONE, spec.match(b'bar/ba'))
+        self.assertEqual(MATCH_NONE, spec.match(b'baz'))
+
+    def test_matches(self):
+        spec = PathSpec([b'foo'])
+        self.assertTrue(spec.matches(b'foo/bar'))
+        self.assertFalse(spec.matches(b'bar'))
+        self.assertFalse(spec.matches(None))
+        self.assertTrue(PathSpec([b'']).matches(b'bar'))
+        self.assertFalse(PathSpec().matches(b'bar'))
+
+    def test_glob(self):
+        spec = PathSpec([b'src/*.c', b'doc/[ab]?', b'*/Makefile'])
+        self.assertTrue(spec.matches(b'src/main.c'))
+        self.assertTrue(spec.matches(b'doc/a1/x'))
+        self.assertTrue(spec.matches(b'src/Makefile'))
+        self.assertTrue(spec.matches(b'lib/Makefile'))
+        self.assertFalse(spec.matches(b'src/main.h'))
+        self.assertFalse(spec.matches(b'src/sub/main.c'))
+        self.assertFalse(spec.matches(b'doc/c1'))
+        self.assertFalse(spec.matches(b'Makefile'))
+        self.assertEqual(MATCH_LEADING, spec.match(b'lib'))
+
+    def test_overlapping_globs(self):
+        spec = PathSpec([b'a*/x', b'ab/y'])
+        self.assertTrue(spec.matches(b'ab/x'))
+        self.assertTrue(spec.matches(b'ab/y'))
+        self.assertFalse(spec.matches(b'ac/y'))
+
+    def test_step(self):
+        spec = PathSpec([b'a/b', b'c'])
+        result, state = spec.start()
+        self.assertEqual(MATCH_LEADING, result)
+        self.assertEqual((MATCH, None), spec.step(state, b'c'))
+        self.assertEqual((MATCH_NONE, None), spec.step(state, b'b'))
+        result, a_state = spec.step(state, b'a')
+        self.assertEqual(MATCH_LEADING, result)
+        self.assertEqual((MATCH, None), spec.step(a_state, b'b'))
+
+    def test_add_remove(self):
+        spec = PathSpec([b'a/b'])
+        spec.add(b'a/b/c')
+        spec.add(b'x/*')
+        self.assertEqual(set([b'a/b', b'a/b/c', b'x/*']), set(spec))
+        self.assertEqual(3, len(spec))
+        self.assertTrue(b'x/*' in spec)
+        spec.remove(b'a/b')
+        self.assertFalse(spec.matches(b'a/b'))
+        self.assertTrue(spec.matches(b'a/b/c'))
+        spec.remove(b'x/*')
+        self.assertFalse(spec.matches(b'x/y'))
+        self.assertEqual(MATCH_NONE, spec.match(b'x'))
+        spec.remove(b'a/b/c')
+        self.assertEqual(MATCH_NONE, spec.match(b'a'))
+        self.assertRaises(KeyError, spec.remove, b'a/b')
+
+    def test_literal_prefix(self):
+        self.assertEqual(b'a/b', literal_prefix(b'a/b'))
+        self.assertEqual(b'a', literal_prefix(b'a/*.c/d'))
+        self.assertEqual(b'', literal_prefix(b'*/x'))
+        self.assertEqual(b'a', literal_prefix(b'a/'))
+        spec = PathSpec(globs=False)
+        self.assertEqual(b'a/*.c/d', spec.literal_prefix(b'a/*.c/d/'))
+
+    def test_no_globs(self):
+        spec = PathSpec([b'a/*.c', b'b?'], globs=False)
+        self.assertTrue(spec.matches(b'a/*.c'))
+        self.assertTrue(spec.matches(b'b?/x'))
+        self.assertFalse(spec.matches(b'a/x.c'))
+        self.assertFalse(spec.matches(b'bb'))
+        spec.remove(b'a/*.c')
+        self.assertFalse(spec.matches(b'a/*.c'))
+        copy = spec.copy()
+        self.assertFalse(copy.globs)
+        self.assertEqual([b'b?'], list(copy))
+
+    def test_as_pathspec(self):
+        spec = PathSpec([b'a*'])
+        self.assertTrue(as_pathspec(spec) is spec)
+        literal = as_pathspec([b'a*'])
+        self.assertTrue(literal.matches(b'a*'))
+        self.assertFalse(literal.matches(b'ab'))
@@ -0,0 +1,211 @@
+# test_refs_table.py -- Tests for the refs table storage
+# Copyright (C) 2012 Chris Eberle <eberle1080@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for dulwich.refs_table."""
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    FileFormatException,
+    )
+from dulwich.objects import Sha1Sum
+from dulwich.protocol import ZERO_SHA
+from dulwich.refs_table import (
+    REFS_TABLE_FILENAME,
+    RefsTable,
+    RefsTableContainer,
+    write_refs_table,
+    )
+from dulwich.repo import Repo
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.test_repository import (
+    RefsContainerTests,
+    _TEST_REFS,
+    )
+
+
+ONES = Sha1Sum('1' * 40)
+TWOS = Sha1Sum('2' * 40)
+
+
+def _table(entries, block_size=64):
+    f = BytesIO()
+    write_refs_table(f, entries, block_size)
+    contents = f.getvalue()
+    return RefsTable('table', contents=contents, size=len(contents))
+
+
+class RefsTableTests(TestCase):
+
+    def setUp(self):
+        super(RefsTableTests, self).setUp()
+        self.entries = [(('refs/heads/%04d' % i).encode('ascii'), ONES, None)
+                        for i in range(100)]
+        self.entries.insert(0, (b'HEAD', b'ref: refs/heads/0000', None))
+        self.entries.append((b'refs/tags/v1', ONES, TWOS))
+        self.table = _table(self.entries)
+
+    def test_empty(self):
+        table = _table([])
+        self.assertEqual(0, len(table))
+        self.assertEqual(None, table.get(b'HEAD'))
+        self.assertEqual([], list(table))
+        table.check()
+
+    def test_iter(self):
+        self.assertEqual(102, len(self.table))
+        self.assertEqual(self.entries, list(self.table))
+        self.assertTrue(len(self.table._block_offsets) > 1)
+
+    def test_get(self):
+        for entry in self.entries:
+            self.assertEqual(entry, self.table.get(entry[0]))
+        self.assertEqual(None, self.table.get(b'A'))
+        self.assertEqual(None, self.table.get(b'refs/heads/0050a'))
+        self.assertEqual(None, self.table.get(b'refs/tags/v2'))
+
+    def test_iter_prefix(self):
+        self.assertEqual(self.entries[11:21],
+                         list(self.table.iter_prefix(b'refs/heads/001')))
+        self.assertEqual([self.entries[-1]],
+                         list(self.table.iter_prefix(b'refs/tags/')))
+        self.assertEqual([], list(self.table.iter_prefix(b'refs/notes/')))
+        self.assertEqual([], list(self.table.iter_prefix(b'refs/zzz')))
+
+    def test_unsorted(self):
+        self.assertRaises(ValueError, _table,
+                          [(b'refs/b', ONES, None), (b'refs/a', ONES, None)])
+
+    def test_check(self):
+        self.table.check()
+        contents = bytearray(self.table._contents)
+        contents[20] ^= 0xff
+        table = RefsTable('table', contents=bytes(contents),
+                          size=len(contents))
+        self.assertRaises(ChecksumMismatch, table.check)
+
+    def test_invalid_signature(self):
+        contents = b'XXXX' + self.table._contents[4:]
+        self.assertRaises(FileFormatException, RefsTable, 'table',
+                          contents=contents, size=len(contents))
+
+
+class RefsTableContainerTests(RefsContainerTests, TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._path)
+        self._refs = RefsTableContainer.create(
+            self._path, dict(_TEST_REFS), block_size=64)
+
+    def test_missing_table(self):
+        refs = RefsTableContainer(os.path.join(self._path, 'nonexistent'))
+        self.assertEqual(set(), refs.allkeys())
+        self.assertEqual({}, refs.as_dict())
+        self.assertRaises(KeyError, refs.__getitem__, b'HEAD')
+
+    def test_subkeys(self):
+        self.assertEqual(set([b'master', b'packed']),
+                         self._refs.subkeys(b'refs/heads/'))
+        self.assertEqual(set(), self._refs.subkeys(b'refs/head'))
+
+    def test_as_dict_base(self):
+        self._refs.set_symbolic_ref(b'refs/heads/symbolic',
+                                    b'refs/heads/master')
+        self._refs.set_symbolic_ref(b'refs/heads/dangling',
+                                    b'refs/heads/missing')
+        self.assertEqual(
+            {b'master': _TEST_REFS[b'refs/heads/master'],
+             b'packed': _TEST_REFS[b'refs/heads/packed'],
+             b'symbolic': _TEST_REFS[b'refs/heads/master']},
+            self._refs.as_dict(b'refs/heads'))
+
+    def test_update_refs(self):
+        self.assertTrue(self._refs.update_refs({
+            b'refs/heads/master': (_TEST_REFS[b'refs/heads/master'], ONES),
+            b'refs/heads/new': (ZERO_SHA, TWOS),
+            b'refs/tags/refs-0.1': (None, ZERO_SHA),
+            }))
+        self.assertEqual(ONES, self._refs[b'refs/heads/master'])
+        self.assertEqual(TWOS, self._refs[b'refs/heads/new'])
+        self.assertFalse(b'refs/tags/refs-0.1' in self._refs)
+
+    def test_update_refs_atomic(self):
+        state = self._refs.get_state()
+        self.assertFalse(self._refs.update_refs({
+            b'refs/heads/new': (None, ONES),
+            b'refs/heads/master': (TWOS, ONES),
+            }))
+        self.assertFalse(self._refs.update_refs({
+            b'refs/heads/new': (None, ONES),
+            b'refs/heads/packed': (ZERO_SHA, ONES),
+            }))
+        self.assertFalse(b'refs/heads/new' in self._refs)
+        self.assertEqual(state, self._refs.get_state())
+        self.assertFalse(os.path.exists(
+            os.path.join(self._path, REFS_TABLE_FILENAME + '.lock')))
+
+    def test_get_peeled(self):
+        self.assertEqual(None, self._refs.get_peeled(b'refs/tags/refs-0.1'))
+        self._refs.update_refs({b'refs/tags/refs-0.1': (None, ONES)},
+                               peeled={b'refs/tags/refs-0.1': TWOS})
+        self.assertEqual(TWOS, self._refs.get_peeled(b'refs/tags/refs-0.1'))
+        # Peeled values are kept when other refs change
+        self._refs[b'refs/heads/master'] = ONES
+        self.assertEqual(TWOS, self._refs.get_peeled(b'refs/tags/refs-0.1'))
+        self._refs[b'refs/tags/refs-0.1'] = TWOS
+        self.assertEqual(None, self._refs.get_peeled(b'refs/tags/refs-0.1'))
+
+    def test_external_change(self):
+        state = self._refs.get_state()
+        other = RefsTableContainer(self._path)
+        other[b'refs/heads/other'] = ONES
+        self.assertNotEqual(state, self._refs.get_state())
+        self.assertEqual(ONES, self._refs[b'refs/heads/other'])
+
+
+class RefsTableRepoTests(TestCase):
+
+    def setUp(self):
+        super(RefsTableRepoTests, self).setUp()
+        self._path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._path)
+
+    def test_init_bare(self):
+        r = Repo.init_bare(self._path, refs_table=True)
+        self.assertTrue(isinstance(r.refs, RefsTableContainer))
+        self.assertEqual(b'ref: refs/heads/master',
+                         r.refs.read_ref(b'HEAD'))
+        self.assertFalse(os.path.exists(os.path.join(self._path, 'HEAD')))
+        # The table is found when the repository is opened again
+        self.assertTrue(isinstance(Repo(self._path).refs, RefsTableContainer))
+
+    def test_default(self):
+        r = Repo.init_bare(self._path)
+        self.assertFalse(isinstance(r.refs, RefsTableContainer))
+        self.assertFalse(isinstance(Repo(self._path).refs, RefsTableContainer))
+        self.assertTrue(isinstance(Repo(self._path, refs_table=True).refs,
+                                   RefsTableContainer))
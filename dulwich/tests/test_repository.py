@@ -38,6 +38,7 @@ from dulwich.repo import (
     DictRefsContainer,
     Repo,
     MemoryRepo,
+    PackedRefsFile,
     read_packed_refs,
     read_packed_refs_with_peeled,
     write_packed_refs,
@@ -53,6 +54,7 @@ from dulwich.tests.utils import (
 from dulwich.objects import (
     Sha1Sum,
 )
+from dulwich.protocol import ZERO_SHA
 
 missing_sha = Sha1Sum('b91fa4d900e17e99b433218e988c4eb4a3e9a097')
 
@@ -147,6 +149,37 @@ class RepositoryTests(TestCase):
             b'refs/tags/mytag-packed': Sha1Sum('b0931cadc54336e78a1d980420e3268903b57a50'),
             }, r.get_refs())
 
+    def test_get_refs_cached(self):
+        r = self._repo = open_repo('a.git')
+        calls = []
+        as_dict = r.refs.as_dict
+
+        def counting_as_dict(*args):
+            calls.append(args)
+            return as_dict(*args)
+
+        r.refs.as_dict = counting_as_dict
+        refs = r.get_refs()
+        self.assertEqual(refs, r.get_refs())
+        self.assertEqual(1, len(calls))
+
+        # Changes made through the refs container are noticed
+        sha = Sha1Sum('28237f4dc30d0d462658d6b937b08a0f0b6ef55a')
+        r.refs[b'refs/heads/new'] = sha
+        self.assertEqual(sha, r.get_refs()[b'refs/heads/new'])
+        self.assertEqual(2, len(calls))
+
+        # and so are changes made by others
+        other = Repo(r.path)
+        del other.refs[b'refs/heads/new']
+        self.assertFalse(b'refs/heads/new' in r.get_refs())
+        self.assertEqual(3, len(calls))
+
+    def test_get_refs_copy(self):
+        r = self._repo = open_repo('a.git')
+        r.get_refs()[b'refs/heads/bogus'] = b'bogus'
+        self.assertFalse(b'refs/heads/bogus' in r.get_refs())
+
     def test_head(self):
         r = self._repo = open_repo('a.git')
         self.assertEqual(r.head(), Sha1Sum('a90fa2d900a17e99b433217e988c4eb4a2e9a097'))
@@ -234,6 +267,36 @@ class RepositoryTests(TestCase):
 
         # TODO: add more corner cases to test repo
 
+    def test_get_peeled_cached(self):
+        r = self._repo = open_repo('a.git')
+        tag_sha = Sha1Sum('28237f4dc30d0d462658d6b937b08a0f0b6ef55a')
+        peeled = r.get_peeled(b'refs/tags/mytag')
+        self.assertEqual(peeled, r._peeled_cache[tag_sha])
+        r.refs[b'refs/tags/other'] = tag_sha
+        self.assertEqual(peeled, r.get_peeled(b'refs/tags/other'))
+
+    def test_get_peeled_stale_snapshot(self):
+        r = self._repo = open_repo('a.git')
+        tag_sha = Sha1Sum('28237f4dc30d0d462658d6b937b08a0f0b6ef55a')
+        r.get_refs()
+        # Another writer packs refs/tags/mytag, pointing at a different tag
+        os.remove(os.path.join(r.controldir(), 'refs', 'tags', 'mytag'))
+        with open(os.path.join(r.controldir(), 'packed-refs'), 'ab') as f:
+            f.write(b'b0931cadc54336e78a1d980420e3268903b57a50 '
+                    b'refs/tags/mytag\n'
+                    b'^2a72d929692c41d8554c07f6301757ba18a65d91\n')
+        self.assertEqual(r.head(), r.get_peeled(b'refs/tags/mytag'))
+        self.assertEqual(r.head(), r._peeled_cache[tag_sha])
+
+    def test_get_peeled_without_snapshot(self):
+        r = self._repo = open_repo('a.git')
+
+        def as_dict(*args):
+            self.fail('as_dict() should not be called')
+
+        r.refs.as_dict = as_dict
+        self.assertEqual(r.head(), r.get_peeled(b'refs/tags/mytag'))
+
     def test_get_peeled_not_tag(self):
         r = self._repo = open_repo('a.git')
         self.assertEqual(r.get_peeled(b'HEAD'), r.head())
@@ -606,7 +669,7 @@ class PackedRefsFileTests(TestCase):
                                   b'ref/2': TWOS.hex_bytes},
                               {b'ref/1': THREES.hex_bytes})
             self.assertEqual(
-              b'# pack-refs with: peeled\n' + ONES.hex_bytes + b' ref/1\n^' + 
+              b'# pack-refs with: peeled sorted \n' + ONES.hex_bytes + b' ref/1\n^' + 
               THREES.hex_bytes + b'\n' + TWOS.hex_bytes + b' ref/2\n',
               f.getvalue())
 
@@ -614,10 +677,55 @@ class PackedRefsFileTests(TestCase):
         with BytesIO() as f:
             write_packed_refs(f, {b'ref/1': ONES.hex_bytes,
                                   b'ref/2': TWOS.hex_bytes})
-            self.assertEqual(ONES.hex_bytes + b' ref/1\n' + TWOS.hex_bytes +
+            self.assertEqual(b'# pack-refs with: sorted \n' +
+                             ONES.hex_bytes + b' ref/1\n' + TWOS.hex_bytes +
                              b' ref/2\n', f.getvalue())
 
 
+class PackedRefsFileLookupTests(TestCase):
+
+    def _packed_refs_file(self, refs, peeled=None):
+        with BytesIO() as f:
+            write_packed_refs(f, refs, peeled)
+            contents = f.getvalue()
+        return PackedRefsFile(contents, len(contents))
+
+    def test_lookup(self):
+        refs = {}
+        peeled = {}
+        for i in range(50):
+            name = ('refs/tags/%03d' % (i * 2)).encode('ascii')
+            refs[name] = ONES.hex_bytes
+            if i % 3 == 0:
+                peeled[name] = TWOS.hex_bytes
+        packed_refs_file = self._packed_refs_file(refs, peeled)
+        self.assertTrue(packed_refs_file.sorted)
+        self.assertTrue(packed_refs_file.peeled)
+        for name in refs:
+            self.assertEqual((ONES.hex_bytes, peeled.get(name)),
+                             packed_refs_file.lookup(name))
+        for i in range(50):
+            name = ('refs/tags/%03d' % (i * 2 + 1)).encode('ascii')
+            self.assertEqual(None, packed_refs_file.lookup(name))
+        self.assertEqual(None, packed_refs_file.lookup(b'refs/heads/master'))
+        self.assertEqual(None, packed_refs_file.lookup(b'refs/tags/zzz'))
+
+    def test_lookup_empty(self):
+        packed_refs_file = self._packed_refs_file({})
+        self.assertTrue(packed_refs_file.sorted)
+        self.assertFalse(packed_refs_file.peeled)
+        self.assertEqual(None, packed_refs_file.lookup(b'refs/heads/master'))
+
+    def test_unsorted(self):
+        contents = b'# pack-refs with: peeled \n'
+        packed_refs_file = PackedRefsFile(contents, len(contents))
+        self.assertTrue(packed_refs_file.peeled)
+        self.assertFalse(packed_refs_file.sorted)
+        contents = ONES.hex_bytes + b' ref/1\n'
+        packed_refs_file = PackedRefsFile(contents, len(contents))
+        self.assertFalse(packed_refs_file.sorted)
+
+
 # Dict of refs that we expect all RefsContainerTests subclasses to define.
 _TEST_REFS = {
   b'HEAD': Sha1Sum('42d06bd4b77fed026b154d16493e5deab78f02ec'),
@@ -724,6 +832,52 @@ class RefsContainerTests(object):
         self.assertFalse(b'refs/tags/refs-0.2' in self._refs)
 
 
+    def test_get_state(self):
+        state = self._refs.get_state()
+        self.assertEqual(state, self._refs.get_state())
+        self._refs[b'refs/heads/master'] = Sha1Sum('9' * 40)
+        new_state = self._refs.get_state()
+        self.assertNotEqual(state, new_state)
+        del self._refs[b'refs/heads/master']
+        self.assertNotEqual(new_state, self._refs.get_state())
+
+    def test_transaction(self):
+        nines = Sha1Sum('9' * 40)
+        t = self._refs.transaction()
+        t.set(b'HEAD', nines, _TEST_REFS[b'HEAD'])
+        t.set(b'refs/heads/new', nines, ZERO_SHA)
+        t.remove(b'refs/tags/refs-0.1', _TEST_REFS[b'refs/tags/refs-0.1'])
+        t.remove(b'refs/heads/packed')
+        self.assertTrue(t.commit())
+        self.assertEqual(nines, self._refs[b'HEAD'])
+        self.assertEqual(nines, self._refs[b'refs/heads/new'])
+        self.assertFalse(b'refs/tags/refs-0.1' in self._refs)
+        self.assertFalse(b'refs/heads/packed' in self._refs)
+        self.assertEqual(_TEST_REFS[b'refs/tags/refs-0.2'],
+                         self._refs[b'refs/tags/refs-0.2'])
+
+    def test_transaction_mismatch(self):
+        nines = Sha1Sum('9' * 40)
+        t = self._refs.transaction()
+        t.set(b'refs/heads/new', nines)
+        t.remove(b'refs/tags/refs-0.1')
+        t.set(b'refs/heads/master', nines, nines)
+        self.assertFalse(t.commit())
+        t = self._refs.transaction()
+        t.set(b'refs/heads/new', nines)
+        t.set(b'refs/heads/packed', nines, ZERO_SHA)
+        self.assertFalse(t.commit())
+        self.assertFalse(b'refs/heads/new' in self._refs)
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+
+    def test_import_refs(self):
+        nines = Sha1Sum('9' * 40)
+        self._refs.import_refs(b'refs/remotes/origin',
+                               {b'master': nines, b'other': nines})
+        self.assertEqual({b'master': nines, b'other': nines},
+                         self._refs.as_dict(b'refs/remotes/origin'))
+
+
 class DictRefsContainerTests(RefsContainerTests, TestCase):
 
     def setUp(self):
@@ -750,6 +904,130 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
         tear_down_repo(self._repo)
         TestCase.tearDown(self)
 
+    def test_get_state_external_change(self):
+        state = self._refs.get_state()
+        other = Repo(self._repo.path).refs
+        other[b'refs/heads/other/branch'] = Sha1Sum('9' * 40)
+        state2 = self._refs.get_state()
+        self.assertNotEqual(state, state2)
+        # The new directory is watched as well
+        other[b'refs/heads/other/branch2'] = Sha1Sum('9' * 40)
+        self.assertNotEqual(state2, self._refs.get_state())
+
+    def test_get_state_packed_refs_change(self):
+        self.assertEqual(Sha1Sum('df6800012397fb85c56e7418dd4eb9405dee075c'),
+                         self._refs[b'refs/tags/refs-0.1'])
+        state = self._refs.get_state()
+        other = Repo(self._repo.path).refs
+        del other[b'refs/tags/refs-0.1']
+        self.assertNotEqual(state, self._refs.get_state())
+        self.assertFalse(b'refs/tags/refs-0.1' in self._refs)
+
+    def test_transaction_locked(self):
+        nines = Sha1Sum('9' * 40)
+        lock = os.path.join(self._refs.path, 'refs', 'heads', 'zzz.lock')
+        with open(lock, 'wb'):
+            pass
+        t = self._refs.transaction()
+        t.set(b'refs/heads/master', nines)
+        t.remove(b'refs/heads/packed')
+        t.set(b'refs/heads/zzz', nines)
+        self.assertRaises(OSError, t.commit)
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+        os.remove(lock)
+        for root, dirs, files in os.walk(self._refs.path):
+            self.assertEqual([], [f for f in files if f.endswith('.lock')])
+
+    def test_transaction_packed(self):
+        nines = Sha1Sum('9' * 40)
+        t = self._refs.transaction()
+        t.remove(b'refs/heads/packed')
+        t.remove(b'refs/tags/refs-0.1')
+        t.set(b'refs/tags/refs-0.2', nines)
+        self.assertTrue(t.commit())
+        with open(os.path.join(self._refs.path, 'packed-refs'), 'rb') as f:
+            packed = f.read()
+        self.assertFalse(b'refs/heads/packed' in packed)
+        self.assertFalse(b'refs/tags/refs-0.1' in packed)
+        refs = Repo(self._repo.path).refs
+        self.assertFalse(b'refs/heads/packed' in refs)
+        self.assertFalse(b'refs/tags/refs-0.1' in refs)
+        self.assertEqual(nines, refs[b'refs/tags/refs-0.2'])
+
+    def test_transaction_rollback_packed_removal(self):
+        nines = Sha1Sum('9' * 40)
+        rename = os.rename
+        zzz = self._refs.refpath(b'refs/heads/zzz')
+
+        def failing_rename(src, dst):
+            if dst == zzz:
+                raise OSError('disk full')
+            return rename(src, dst)
+
+        self.addCleanup(setattr, os, 'rename', rename)
+        os.rename = failing_rename
+        t = self._refs.transaction()
+        t.remove(b'refs/heads/packed')
+        t.set(b'refs/heads/zzz', nines)
+        # The original error is raised, rather than one from the rollback.
+        self.assertRaisesRegex(OSError, 'disk full', t.commit)
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+
+    def test_transaction_rollback_loose_removal(self):
+        nines = Sha1Sum('9' * 40)
+        rename = os.rename
+        zzz = self._refs.refpath(b'refs/heads/zzz')
+
+        def failing_rename(src, dst):
+            if dst == zzz:
+                raise OSError('disk full')
+            return rename(src, dst)
+
+        self.addCleanup(setattr, os, 'rename', rename)
+        os.rename = failing_rename
+        t = self._refs.transaction()
+        t.remove(b'refs/heads/master')
+        t.set(b'refs/heads/zzz', nines)
+        self.assertRaisesRegex(OSError, 'disk full', t.commit)
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+        self.assertEqual(_TEST_REFS[b'refs/heads/master'],
+                         self._refs.read_loose_ref(b'refs/heads/master'))
+
+    def test_transaction_remove_creates_no_dirs(self):
+        tags = os.path.join(self._refs.path, 'refs', 'tags')
+        shutil.rmtree(tags)
+        t = self._refs.transaction()
+        t.remove(b'refs/tags/refs-0.1')
+        self.assertTrue(t.commit())
+        self.assertFalse(os.path.exists(tags))
+        self.assertFalse(b'refs/tags/refs-0.1' in self._refs)
+
+    def test_packed_refs_replaced(self):
+        tag = Sha1Sum('df6800012397fb85c56e7418dd4eb9405dee075c')
+        self.assertEqual(tag, self._refs[b'refs/tags/refs-0.1'])
+        self.assertEqual(2, len(self._refs.get_packed_refs()))
+        with GitFile(os.path.join(self._refs.path, 'packed-refs'), 'wb') as f:
+            write_packed_refs(f, {b'refs/heads/packed': tag.hex_bytes,
+                                  b'refs/tags/other': tag.hex_bytes})
+        self.assertFalse(b'refs/tags/refs-0.1' in self._refs)
+        self.assertEqual(tag, self._refs[b'refs/heads/packed'])
+        self.assertEqual(tag, self._refs[b'refs/tags/other'])
+
+    def test_packed_refs_lookup_without_parsing(self):
+        tag = Sha1Sum('df6800012397fb85c56e7418dd4eb9405dee075c')
+        with GitFile(os.path.join(self._refs.path, 'packed-refs'), 'wb') as f:
+            write_packed_refs(f, {b'refs/heads/packed': tag.hex_bytes,
+                                  b'refs/tags/refs-0.1': tag.hex_bytes},
+                              {b'refs/tags/refs-0.1': ONES.hex_bytes})
+        self.assertEqual(tag, self._refs[b'refs/heads/packed'])
+        self.assertFalse(b'refs/heads/missing' in self._refs)
+        self.assertEqual(ONES.hex_bytes,
+                         self._refs.get_peeled(b'refs/tags/refs-0.1'))
+        self.assertEqual(tag, self._refs.get_peeled(b'refs/heads/packed'))
+        self.assertEqual(None, self._refs._packed_refs)
+        self.assertTrue(self._refs.add_if_new(b'refs/heads/new', tag))
+        self.assertFalse(self._refs.add_if_new(b'refs/heads/packed', tag))
+
     def test_get_packed_refs(self):
         self.assertEqual({
           b'refs/heads/packed': Sha1Sum('42d06bd4b77fed026b154d16493e5deab78f02ec'),
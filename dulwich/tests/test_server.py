@@ -42,9 +42,11 @@ from dulwich.server import (
     serve_command,
     ProtocolGraphWalker,
     ReceivePackHandler,
+    RepositoryPool,
     SingleAckGraphWalkerImpl,
     UploadPackHandler,
     )
+from dulwich.protocol import ZERO_SHA
 from dulwich.tests import TestCase
 from dulwich.tests.utils import (
     make_commit,
@@ -196,6 +198,111 @@ class UploadPackHandlerTestCase(TestCase):
         self.assertEqual({}, self._handler.get_tagged(refs, repo=self._repo))
 
 
+class ReceivePackHandlerTestCase(TestCase):
+
+    def setUp(self):
+        super(ReceivePackHandlerTestCase, self).setUp()
+        self._repo = MemoryRepo.init_bare([], {})
+        self._repo.refs._update({
+            b'refs/heads/master': ONE,
+            b'refs/heads/branch': TWO,
+            })
+        self._repo.object_store.add_thin_pack = lambda read, recv: None
+        backend = DictBackend({'/': self._repo})
+        proto = TestProto()
+        # the pack data is not read, see add_thin_pack above
+        proto.read = proto.recv = None
+        self._handler = ReceivePackHandler(
+          backend, ['/', 'host=lolcathost'], proto)
+        self._update_calls = []
+        update_refs = self._repo.refs.update_refs
+        def counting_update_refs(updates):
+            self._update_calls.append(updates)
+            return update_refs(updates)
+        self._repo.refs.update_refs = counting_update_refs
+
+    def _apply_pack(self, refs, caps=()):
+        self._handler.set_client_capabilities(
+            list(self._handler.required_capabilities()) + list(caps))
+        return self._handler._apply_pack(refs)
+
+    def test_apply_pack(self):
+        status = self._apply_pack([
+            (ONE, THREE, b'refs/heads/master'),
+            (TWO, ZERO_SHA, b'refs/heads/branch'),
+            (ZERO_SHA, FOUR, b'refs/heads/new'),
+            ])
+        self.assertEqual([
+            (b'unpack', b'ok'),
+            (b'refs/heads/master', b'ok'),
+            (b'refs/heads/branch', b'ok'),
+            (b'refs/heads/new', b'ok'),
+            ], status)
+        self.assertEqual({b'refs/heads/master': THREE,
+                          b'refs/heads/new': FOUR},
+                         self._repo.get_refs())
+        self.assertEqual(1, len(self._update_calls))
+
+    def test_apply_pack_stale(self):
+        status = self._apply_pack([
+            (ONE, THREE, b'refs/heads/master'),
+            (ONE, FOUR, b'refs/heads/branch'),
+            (ONE, FIVE, b'refs/heads/new'),
+            ])
+        self.assertEqual([
+            (b'unpack', b'ok'),
+            (b'refs/heads/master', b'ok'),
+            (b'refs/heads/branch', b'failed to lock'),
+            (b'refs/heads/new', b'failed to lock'),
+            ], status)
+        self.assertEqual({b'refs/heads/master': THREE,
+                          b'refs/heads/branch': TWO},
+                         self._repo.get_refs())
+
+    def test_apply_pack_atomic(self):
+        status = self._apply_pack([
+            (ONE, THREE, b'refs/heads/master'),
+            (ONE, FOUR, b'refs/heads/branch'),
+            ], caps=[b'atomic'])
+        self.assertEqual([
+            (b'unpack', b'ok'),
+            (b'refs/heads/master', b'atomic transaction failed'),
+            (b'refs/heads/branch', b'atomic transaction failed'),
+            ], status)
+        self.assertEqual({b'refs/heads/master': ONE,
+                          b'refs/heads/branch': TWO},
+                         self._repo.get_refs())
+
+    def test_apply_pack_atomic_bad_ref(self):
+        transaction = self._repo.refs.transaction
+
+        def failing_transaction():
+            t = transaction()
+            set_ref = t.set
+
+            def set(name, new_ref, old_ref=None):
+                if name == b'refs/heads/branch':
+                    raise KeyError(name)
+                set_ref(name, new_ref, old_ref)
+            t.set = set
+            return t
+
+        self._repo.refs.transaction = failing_transaction
+        status = self._apply_pack([
+            (ONE, THREE, b'refs/heads/master'),
+            (TWO, FOUR, b'refs/heads/branch'),
+            ], caps=[b'atomic'])
+        self.assertEqual([
+            (b'unpack', b'ok'),
+            (b'refs/heads/master', b'atomic transaction failed'),
+            (b'refs/heads/branch', b'atomic transaction failed'),
+            ], status)
+        self.assertEqual({b'refs/heads/master': ONE,
+                          b'refs/heads/branch': TWO},
+                         self._repo.get_refs())
+        self.assertEqual([], self._update_calls)
+
+
 class TestUploadPackHandler(UploadPackHandler):
     @classmethod
     def required_capabilities(self):
@@ -667,6 +774,96 @@ class FileSystemBackendTests(TestCase):
         self.assertRaises(NotGitRepository,
             self.backend.open_repository, os.path.join(self.path, "foo"))
 
+    def test_reuse(self):
+        repo = self.backend.open_repository(self.path)
+        self.backend.release_repository(repo)
+        self.assertTrue(repo is self.backend.open_repository(self.path))
+
+
+class FakeRepo(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RepositoryPoolTests(TestCase):
+
+    def setUp(self):
+        super(RepositoryPoolTests, self).setUp()
+        self.opened = []
+        self.pool = RepositoryPool(self._open, max_size=2)
+
+    def _open(self, path):
+        if path == 'missing':
+            raise NotGitRepository(path)
+        repo = FakeRepo(path)
+        self.opened.append(repo)
+        return repo
+
+    def test_reuse(self):
+        a = self.pool.acquire('a')
+        self.pool.release(a)
+        self.assertTrue(a is self.pool.acquire('a'))
+        self.assertEqual(1, len(self.opened))
+        self.assertFalse(a.closed)
+
+    def test_concurrent_users(self):
+        a1 = self.pool.acquire('a')
+        a2 = self.pool.acquire('a')
+        self.assertFalse(a1 is a2)
+        self.assertEqual(2, len(self.pool))
+        self.pool.release(a1)
+        self.assertTrue(a1 is self.pool.acquire('a'))
+        self.pool.release(a2)
+        self.pool.release(a1)
+        self.assertEqual(2, len(self.opened))
+        self.assertFalse(a1.closed or a2.closed)
+
+    def test_missing(self):
+        self.assertRaises(NotGitRepository, self.pool.acquire, 'missing')
+        self.assertEqual(0, len(self.pool))
+
+    def test_evict_least_recently_used(self):
+        a = self.pool.acquire('a')
+        b = self.pool.acquire('b')
+        self.pool.release(b)
+        self.pool.release(a)
+        self.pool.acquire('c')
+        self.assertFalse(a.closed)
+        self.assertTrue(b.closed)
+        self.assertEqual(2, len(self.pool))
+
+    def test_in_use_not_evicted(self):
+        a = self.pool.acquire('a')
+        b = self.pool.acquire('b')
+        c = self.pool.acquire('c')
+        self.assertEqual(3, len(self.pool))
+        self.assertFalse(a.closed or b.closed or c.closed)
+        self.pool.release(b)
+        self.assertTrue(b.closed)
+        self.assertEqual(2, len(self.pool))
+
+    def test_release_unknown(self):
+        repo = FakeRepo('x')
+        self.pool.release(repo)
+        self.assertTrue(repo.closed)
+
+    def test_close(self):
+        a = self.pool.acquire('a')
+        b = self.pool.acquire('b')
+        self.pool.release(b)
+        self.pool.close()
+        self.assertTrue(b.closed)
+        self.assertEqual(0, len(self.pool))
+        # Repositories in use are closed once they are handed back.
+        self.assertFalse(a.closed)
+        self.pool.release(a)
+        self.assertTrue(a.closed)
+
 
 class ServeCommandTests(TestCase):
     """Tests for serve_command."""
@@ -19,6 +19,13 @@
 """Tests for commit walking functionality."""
 
 from itertools import permutations
+import os
+import random
+import shutil
+import tempfile
+
+from dulwich.changed_paths import ChangedPathFilters
+from dulwich.diff_cache import TreeDiffCache
 from dulwich.diff_tree import (
     CHANGE_ADD,
     CHANGE_MODIFY,
@@ -37,12 +44,15 @@ from dulwich.objects import (
     Commit,
     Blob,
     )
+from dulwich import walk
 from dulwich.walk import (
     ORDER_TOPO,
     WalkEntry,
     Walker,
+    _TopoQueue,
     _topo_reorder
     )
+from dulwich.pathspec import PathSpec
 from dulwich.tests import TestCase
 from .utils import (
     F,
@@ -290,6 +300,80 @@ class WalkerTest(TestCase):
            TestWalkEntry(c1, [TreeChange.add(e(b'a'))])],
           [c6.id], paths=[b'c'], follow=True)
 
+    def test_diff_cache(self):
+        blob = make_object(Blob, data=b'blob')
+        names = ['a', 'a', 'b', 'b', 'c', 'c']
+        trees = dict((i + 1, [(n, blob, F)]) for i, n in enumerate(names))
+        c1, c2, c3, c4, c5, c6 = self.make_linear_commits(6, trees=trees)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        cache = TreeDiffCache(os.path.join(tempdir, 'diffs'))
+        self.addCleanup(cache.close)
+
+        e = lambda n: (n, F, blob.id)
+        expected = [
+          TestWalkEntry(c5, [TreeChange(CHANGE_RENAME, e(b'b'), e(b'c'))]),
+          TestWalkEntry(c3, [TreeChange(CHANGE_RENAME, e(b'a'), e(b'b'))]),
+          TestWalkEntry(c1, [TreeChange.add(e(b'a'))])]
+        for i in range(2):
+            self.assertWalkYields(expected, [c6.id], paths=[b'c'],
+                                  follow=True, diff_cache=cache)
+        # One diff with renames for each commit with a parent, and a plain
+        # one for the root commit.
+        self.assertEqual(6, len(cache))
+        # Diffs limited to paths are cached separately.
+        self.assertWalkYields([c5, c3, c1], [c6.id], paths=[b'a', b'b', b'c'],
+                              diff_cache=cache)
+        self.assertEqual(12, len(cache))
+
+    def test_path_matches_glob(self):
+        walker = Walker(None, [], paths=PathSpec([b'foo/*.py', b'b?r']))
+        self.assertTrue(walker._path_matches(b'foo/a.py'))
+        self.assertTrue(walker._path_matches(b'foo/a.py/b'))
+        self.assertTrue(walker._path_matches(b'bar/a'))
+        self.assertFalse(walker._path_matches(b'foo'))
+        self.assertFalse(walker._path_matches(b'foo/a.c'))
+        self.assertFalse(walker._path_matches(b'foo/x/a.py'))
+        self.assertFalse(walker._path_matches(b'baar'))
+
+    def test_path_matches_literal(self):
+        walker = Walker(None, [], paths=[b'foo/*.py', b'b?r'])
+        self.assertTrue(walker._path_matches(b'foo/*.py'))
+        self.assertTrue(walker._path_matches(b'b?r/a'))
+        self.assertFalse(walker._path_matches(b'foo/a.py'))
+        self.assertFalse(walker._path_matches(b'bar'))
+
+    def test_paths_pruned(self):
+        blob_a1 = make_object(Blob, data=b'a1')
+        blob_a2 = make_object(Blob, data=b'a2')
+        blob_b1 = make_object(Blob, data=b'b1')
+        blob_b2 = make_object(Blob, data=b'b2')
+        c1, c2, c3 = self.make_linear_commits(
+          3, trees={1: [('a', blob_a1), ('x/b', blob_b1)],
+                    2: [('a', blob_a2), ('x/b', blob_b1)],
+                    3: [('a', blob_a2), ('x/b', blob_b2)]})
+        # The subtrees of x are not needed to find the commits changing a.
+        for sha in set(self.store[c.tree][b'x'][1] for c in (c1, c2, c3)):
+            del self.store[sha]
+        self.assertWalkYields([c2, c1], [c3.id], paths=[b'a'])
+
+    def test_changed_paths(self):
+        blob_a1 = make_object(Blob, data=b'a1')
+        blob_b2 = make_object(Blob, data=b'b2')
+        blob_a3 = make_object(Blob, data=b'a3')
+        blob_b3 = make_object(Blob, data=b'b3')
+        c1, c2, c3 = self.make_linear_commits(
+          3, trees={1: [('a', blob_a1)],
+                    2: [('a', blob_a1), ('x/b', blob_b2)],
+                    3: [('a', blob_a3), ('x/b', blob_b3)]})
+        filters = ChangedPathFilters(self.store)
+        self.assertWalkYields([c3, c1], [c3.id], paths=[b'a'],
+                              changed_paths=filters)
+        self.assertWalkYields([c3, c2], [c3.id], paths=[b'x'],
+                              changed_paths=filters)
+        self.assertWalkYields([c3, c2, c1], [c3.id], changed_paths=filters)
+        self.assertEqual(3, len(filters))
+
     def test_follow_rename_remove_path(self):
         blob = make_object(Blob, data=b'blob')
         _, _, _, c4, c5, c6 = self.make_linear_commits(
@@ -396,6 +480,103 @@ class WalkerTest(TestCase):
         self.assertWalkYields([c5, c4, c3, c1, c2], [c5.id])
         self.assertWalkYields([c5, c4, c3, c2, c1], [c5.id], order=ORDER_TOPO)
 
+    def assertTopoOrder(self, entries):
+        positions = dict((e.commit.id, i) for i, e in enumerate(entries))
+        for i, entry in enumerate(entries):
+            for parent in entry.commit.parents:
+                if parent in positions:
+                    self.assertTrue(positions[parent] > i)
+
+    def test_topo_streaming(self):
+        # A history with merges and clock skew.
+        rand = random.Random(42)
+        spec = [[1]]
+        for i in range(2, 41):
+            parents = rand.sample(range(max(1, i - 5), i),
+                                  min(i - 1, rand.choice([1, 1, 2])))
+            spec.append([i] + parents)
+        times = [rand.randrange(100) for i in range(40)]
+        cs = self.make_commits(spec, times=times)
+        for include, exclude in [([cs[-1].id], []),
+                                 ([cs[-1].id, cs[-3].id, cs[10].id], []),
+                                 ([cs[-1].id], [cs[30].id, cs[20].id]),
+                                 ([cs[-1].id, cs[5].id], [cs[-2].id])]:
+            walker = Walker(self.store, include, exclude=exclude,
+                            order=ORDER_TOPO, queue_cls=_TopoQueue)
+            actual = list(walker)
+            self.assertTopoOrder(actual)
+            expected = list(Walker(self.store, include, exclude=exclude))
+            self.assertEqual(len(expected), len(actual))
+            self.assertEqual(set(e.commit.id for e in expected),
+                             set(e.commit.id for e in actual))
+
+    def test_topo_short_range(self):
+        fetched = []
+
+        class TrackingObjectStore(MemoryObjectStore):
+
+            def __getitem__(self, sha):
+                fetched.append(sha)
+                return super(TrackingObjectStore, self).__getitem__(sha)
+
+            def get_raw(self, sha):
+                fetched.append(sha)
+                obj = self._data[sha]
+                return obj.type_num, obj.as_raw_string()
+
+        self.store = TrackingObjectStore()
+        cs = self.make_linear_commits(100)
+        del fetched[:]
+        self.assertWalkYields([cs[99], cs[98]], [cs[99].id],
+                              exclude=[cs[97].id], order=ORDER_TOPO)
+        self.assertTrue(len(fetched) < 10)
+        del fetched[:]
+        self.assertWalkYields([cs[99], cs[98]], [cs[99].id], max_entries=2,
+                              order=ORDER_TOPO)
+        self.assertTrue(len(fetched) < 10)
+        del fetched[:]
+        self.assertWalkYields(cs[::-1], [cs[99].id], order=ORDER_TOPO)
+        # Each commit is read for its parents and once more for its entry
+        self.assertEqual(200, len(fetched))
+
+    def test_topo_include_ancestor(self):
+        c1, c2, c3 = self.make_linear_commits(3, times=[1, 3, 2])
+        self.assertWalkYields([c3, c2, c1], [c2.id, c3.id], order=ORDER_TOPO)
+        self.assertWalkYields([c3, c2], [c2.id, c3.id], exclude=[c1.id],
+                              order=ORDER_TOPO)
+        self.assertWalkYields([c3], [c1.id, c3.id], exclude=[c2.id],
+                              order=ORDER_TOPO)
+
+    def test_reverse_spilled(self):
+        self.addCleanup(setattr, walk, '_REVERSE_BUFFER_ENTRIES',
+                        walk._REVERSE_BUFFER_ENTRIES)
+        walk._REVERSE_BUFFER_ENTRIES = 2
+        cs = self.make_linear_commits(7)
+        self.assertWalkYields(cs, [cs[-1].id], reverse=True)
+        self.assertWalkYields(cs[2:], [cs[-1].id], reverse=True,
+                              max_entries=5)
+        self.assertWalkYields(cs, [cs[-1].id], reverse=True, order=ORDER_TOPO)
+
+    def test_commits_read_once(self):
+        fetched = []
+
+        class TrackingObjectStore(MemoryObjectStore):
+
+            def __getitem__(self, sha):
+                fetched.append(sha)
+                return super(TrackingObjectStore, self).__getitem__(sha)
+
+            def get_raw(self, sha):
+                fetched.append(sha)
+                obj = self._data[sha]
+                return obj.type_num, obj.as_raw_string()
+
+        self.store = TrackingObjectStore()
+        cs = self.make_linear_commits(5)
+        del fetched[:]
+        self.assertWalkYields([cs[4], cs[3]], [cs[4].id], exclude=[cs[2].id])
+        self.assertEqual(sorted(c.id for c in cs), sorted(fetched))
+
     def test_out_of_order_with_exclude(self):
         # Create the following graph:
         # c1-------x2---m6
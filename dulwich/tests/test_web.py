@@ -20,7 +20,11 @@
 
 from io import BytesIO
 import re
+import threading
 
+from dulwich.errors import (
+    HangupException,
+    )
 from dulwich.object_store import (
     MemoryObjectStore,
     )
@@ -41,8 +45,11 @@ from dulwich.tests import (
     )
 from dulwich.web import (
     HTTP_OK,
+    HTTP_PARTIAL_CONTENT,
+    HTTP_NOT_MODIFIED,
     HTTP_NOT_FOUND,
     HTTP_FORBIDDEN,
+    HTTP_RANGE_NOT_SATISFIABLE,
     HTTP_ERROR,
     send_file,
     get_text_file,
@@ -52,7 +59,10 @@ from dulwich.web import (
     get_info_refs,
     get_info_packs,
     handle_service_request,
+    ChunkReader,
     _LengthLimitedFile,
+    _parse_range,
+    _stream_output,
     HTTPGitRequest,
     HTTPGitApplication,
     )
@@ -161,6 +171,74 @@ class DumbHandlersTestCase(WebTestCase):
         self.assertTrue(f.closed)
         self.assertFalse(self._req.cached)
 
+    def test_send_file_content_length(self):
+        output = b''.join(send_file(self._req, BytesIO(b'foobar'), 'a/b'))
+        self.assertEqual(b'foobar', output)
+        self.assertTrue(('Content-Length', '6') in self._headers)
+        self.assertTrue(('Accept-Ranges', 'bytes') in self._headers)
+
+    def test_send_file_wrapper(self):
+        wrapped = []
+
+        def file_wrapper(f, blocksize):
+            wrapped.append((f, blocksize))
+            return iter([f.read()])
+
+        self._environ['wsgi.file_wrapper'] = file_wrapper
+        f = BytesIO(b'foobar')
+        self.assertEqual([b'foobar'],
+                         list(send_file(self._req, f, 'some/thing')))
+        self.assertEqual(f, wrapped[0][0])
+        self.assertEqual(HTTP_OK, self._status)
+
+    def test_send_file_range(self):
+        self._environ['HTTP_RANGE'] = 'bytes=2-3'
+        f = BytesIO(b'foobar')
+        output = b''.join(send_file(self._req, f, 'some/thing'))
+        self.assertEqual(b'ob', output)
+        self.assertEqual(HTTP_PARTIAL_CONTENT, self._status)
+        self.assertTrue(('Content-Range', 'bytes 2-3/6') in self._headers)
+        self.assertTrue(('Content-Length', '2') in self._headers)
+        self.assertTrue(f.closed)
+
+    def test_send_file_range_open_ended(self):
+        self._environ['HTTP_RANGE'] = 'bytes=3-'
+        bufsize = 10240
+        f = BytesIO(b'x' * (2 * bufsize + 3))
+        self.assertEqual([b'x' * bufsize, b'x' * bufsize],
+                         list(send_file(self._req, f, 'some/thing')))
+        self.assertEqual(HTTP_PARTIAL_CONTENT, self._status)
+
+    def test_send_file_range_not_satisfiable(self):
+        self._environ['HTTP_RANGE'] = 'bytes=10-'
+        f = BytesIO(b'foobar')
+        self.assertEqual(b'', b''.join(send_file(self._req, f, 'a/b')))
+        self.assertEqual(HTTP_RANGE_NOT_SATISFIABLE, self._status)
+        self.assertTrue(('Content-Range', 'bytes */6') in self._headers)
+        self.assertTrue(f.closed)
+
+    def test_send_file_if_range_mismatch(self):
+        self._environ['HTTP_RANGE'] = 'bytes=2-3'
+        self._environ['HTTP_IF_RANGE'] = '"old"'
+        output = b''.join(send_file(self._req, BytesIO(b'foobar'), 'a/b',
+                                    etag='"new"'))
+        self.assertEqual(b'foobar', output)
+        self.assertEqual(HTTP_OK, self._status)
+
+    def test_send_file_etag(self):
+        b''.join(send_file(self._req, BytesIO(b'foobar'), 'a/b',
+                           etag='"abc"'))
+        self.assertEqual(HTTP_OK, self._status)
+        self.assertTrue(('ETag', '"abc"') in self._headers)
+
+    def test_send_file_not_modified(self):
+        self._environ['HTTP_IF_NONE_MATCH'] = '"def", "abc"'
+        f = BytesIO(b'foobar')
+        output = b''.join(send_file(self._req, f, 'a/b', etag='"abc"'))
+        self.assertEqual(b'', output)
+        self.assertEqual(HTTP_NOT_MODIFIED, self._status)
+        self.assertTrue(f.closed)
+
     def test_get_text_file(self):
         backend = _test_backend([], named_files={'description': b'foo'})
         mat = re.search('.*', 'description')
@@ -207,6 +285,29 @@ class DumbHandlersTestCase(WebTestCase):
         self.assertContentTypeEquals('application/x-git-packed-objects')
         self.assertTrue(self._req.cached)
 
+    def test_get_pack_file_etag(self):
+        pack_name = 'objects/pack/pack-%s.pack' % ('1' * 40)
+        contents = b'pack contents' + b'\xab' * 20
+        backend = _test_backend([], named_files={pack_name: contents})
+        mat = re.search('.*', pack_name)
+        output = b''.join(get_pack_file(self._req, backend, mat))
+        self.assertEqual(contents, output)
+        self.assertTrue(('ETag', '"%s"' % ('ab' * 20)) in self._headers)
+
+        self._environ['HTTP_IF_NONE_MATCH'] = '"%s"' % ('ab' * 20)
+        output = b''.join(get_pack_file(self._req, backend, mat))
+        self.assertEqual(b'', output)
+        self.assertEqual(HTTP_NOT_MODIFIED, self._status)
+
+    def test_get_loose_object_not_modified(self):
+        blob = make_object(Blob, data=b'foo')
+        backend = _test_backend([blob])
+        self._environ['HTTP_IF_NONE_MATCH'] = '"%s"' % blob.id
+        mat = re.search('^(..)(.{38})$', str(blob.id))
+        output = b''.join(get_loose_object(self._req, backend, mat))
+        self.assertEqual(b'', output)
+        self.assertEqual(HTTP_NOT_MODIFIED, self._status)
+
     def test_get_idx_file(self):
         idx_name = 'objects/pack/pack-%s.idx' % ('1' * 40)
         backend = _test_backend([], named_files={idx_name: b'idx contents'})
@@ -323,17 +424,18 @@ class SmartHandlersTestCase(WebTestCase):
         self.assertEqual(HTTP_FORBIDDEN, self._status)
         self.assertFalse(self._req.cached)
 
-    def _run_handle_service_request(self, content_length=None):
-        self._environ['wsgi.input'] = BytesIO(b'foo')
+    def _run_handle_service_request(self, content_length=None,
+                                    body=b'foo'):
+        self._environ['wsgi.input'] = BytesIO(body)
         if content_length is not None:
             self._environ['CONTENT_LENGTH'] = content_length
         mat = re.search('.*', '/git-upload-pack')
-        handler_output = ''.join(
+        handler_output = b''.join(
           handle_service_request(self._req, 'backend', mat))
         write_output = self._output.getvalue()
-        # Ensure all output was written via the write callback.
-        self.assertEqual('', handler_output)
-        self.assertEqual(b'handled input: foo', write_output)
+        # Ensure all output was returned through the response iterator.
+        self.assertEqual(b'handled input: foo', handler_output)
+        self.assertEqual(b'', write_output)
         self.assertContentTypeEquals('application/x-git-upload-pack-result')
         self.assertFalse(self._handler.advertise_refs)
         self.assertTrue(self._handler.http_req)
@@ -348,6 +450,10 @@ class SmartHandlersTestCase(WebTestCase):
     def test_handle_service_request_empty_length(self):
         self._run_handle_service_request(content_length='')
 
+    def test_handle_service_request_chunked(self):
+        self._environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        self._run_handle_service_request(body=b'3\r\nfoo\r\n0\r\n\r\n')
+
     def test_get_info_refs_unknown(self):
         self._environ['QUERY_STRING'] = 'service=git-evil-handler'
         list(get_info_refs(self._req, 'backend', None))
@@ -389,6 +495,93 @@ class LengthLimitedFileTestCase(TestCase):
         self.assertEqual(b'', f.read())
 
 
+class ParseRangeTestCase(TestCase):
+
+    def test_none(self):
+        self.assertEqual(None, _parse_range(None, 10))
+        self.assertEqual(None, _parse_range('items=1-2', 10))
+        self.assertEqual(None, _parse_range('bytes=1-2,4-5', 10))
+        self.assertEqual(None, _parse_range('bytes=x-2', 10))
+        self.assertEqual(None, _parse_range('bytes=5-2', 10))
+
+    def test_range(self):
+        self.assertEqual((1, 2), _parse_range('bytes=1-2', 10))
+        self.assertEqual((1, 9), _parse_range('bytes=1-', 10))
+        self.assertEqual((1, 9), _parse_range('bytes=1-20', 10))
+
+    def test_suffix(self):
+        self.assertEqual((7, 9), _parse_range('bytes=-3', 10))
+        self.assertEqual((0, 9), _parse_range('bytes=-30', 10))
+        self.assertEqual((10, 9), _parse_range('bytes=-0', 10))
+
+
+class ChunkReaderTestCase(TestCase):
+
+    def test_read(self):
+        f = ChunkReader(BytesIO(b'3\r\nfoo\r\n3;ext=1\r\nbar\r\n0\r\n\r\n'))
+        self.assertEqual(b'fo', f.read(2))
+        self.assertEqual(b'o', f.read(2))
+        self.assertEqual(b'bar', f.read(10))
+        self.assertEqual(b'', f.read(10))
+
+    def test_read_all(self):
+        f = ChunkReader(BytesIO(
+            b'3\r\nfoo\r\na\r\n0123456789\r\n0\r\nX-Trailer: 1\r\n\r\n'))
+        self.assertEqual(b'foo0123456789', f.read())
+        self.assertEqual(b'', f.read())
+
+    def test_truncated(self):
+        f = ChunkReader(BytesIO(b'5\r\nfoo'))
+        self.assertRaises(HangupException, f.read, 5)
+
+
+class StreamOutputTestCase(TestCase):
+
+    def test_stream(self):
+        def run(write):
+            for i in range(100):
+                write(str(i).encode('ascii'))
+        self.assertEqual([str(i).encode('ascii') for i in range(100)],
+                         list(_stream_output(run)))
+
+    def test_first_chunk_before_done(self):
+        finish = threading.Event()
+
+        def run(write):
+            write(b'first')
+            finish.wait()
+            write(b'second')
+
+        output = _stream_output(run)
+        self.assertEqual(b'first', next(output))
+        finish.set()
+        self.assertEqual([b'second'], list(output))
+
+    def test_error(self):
+        def run(write):
+            write(b'data')
+            raise IOError('broken')
+        output = _stream_output(run)
+        self.assertEqual(b'data', next(output))
+        self.assertRaises(IOError, next, output)
+
+    def test_close_early(self):
+        hangups = []
+
+        def run(write):
+            try:
+                for i in range(1000):
+                    write(b'x')
+            except HangupException:
+                hangups.append(True)
+                raise
+
+        output = _stream_output(run)
+        next(output)
+        output.close()
+        self.assertEqual([True], hangups)
+
+
 class HTTPGitRequestTestCase(WebTestCase):
 
     # This class tests the contents of the actual cache headers
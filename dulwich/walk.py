@@ -24,6 +24,7 @@ from collections import defaultdict
 import collections
 import heapq
 import itertools
+import tempfile
 
 from dulwich.diff_tree import (
     RENAME_CHANGE_TYPES,
@@ -35,8 +36,12 @@ from dulwich.errors import (
     MissingCommitError,
     )
 from dulwich.objects import (
-    Sha1Sum
+    Commit,
+    Sha1Sum,
+    ShaFile,
+    parse_commit_header,
 )
+from dulwich.pathspec import as_pathspec
 
 ORDER_DATE = 'date'
 ORDER_TOPO = 'topo'
@@ -46,6 +51,9 @@ ALL_ORDERS = (ORDER_DATE, ORDER_TOPO)
 # Maximum number of commits to walk past a commit time boundary.
 _MAX_EXTRA_COMMITS = 5
 
+# Number of entries to keep in memory when reversing a walk.
+_REVERSE_BUFFER_ENTRIES = 10000
+
 
 class WalkEntry(object):
     """Object encapsulating a single result from a walk."""
@@ -55,6 +63,7 @@ class WalkEntry(object):
         self._store = walker.store
         self._changes = None
         self._rename_detector = walker.rename_detector
+        self._diff_cache = walker.diff_cache
 
     def changes(self):
         """Get the tree changes for this entry.
@@ -65,92 +74,134 @@ class WalkEntry(object):
             objects; see dulwich.diff.tree_changes_for_merge.
         """
         if self._changes is None:
-            commit = self.commit
-            if not commit.parents:
-                changes_func = tree_changes
-                parent = None
-            elif len(commit.parents) == 1:
-                changes_func = tree_changes
-                parent = self._store[commit.parents[0]].tree
-            else:
-                changes_func = tree_changes_for_merge
-                parent = [self._store[p].tree for p in commit.parents]
-            self._changes = list(changes_func(
-              self._store, parent, commit.tree,
-              rename_detector=self._rename_detector))
+            self._changes = self._get_changes()
         return self._changes
 
+    def _get_changes(self, paths=None):
+        commit = self.commit
+        if not commit.parents:
+            changes_func = tree_changes
+            parent = None
+        elif len(commit.parents) == 1:
+            changes_func = tree_changes
+            parent = self._store[commit.parents[0]].tree
+        else:
+            changes_func = tree_changes_for_merge
+            parent = [self._store[p].tree for p in commit.parents]
+        return list(changes_func(
+          self._store, parent, commit.tree,
+          rename_detector=self._rename_detector,
+          diff_cache=self._diff_cache, paths=paths))
+
+    def _changes_in_paths(self, paths):
+        """Get the tree changes for this entry that affect a set of paths.
+
+        Only the subtrees leading to the paths are compared, unless rename
+        detection is used or all changes are known already.
+
+        :param paths: Set of file or subtree paths.
+        :return: A list like the one returned by changes(), which includes
+            at least all changes that affect paths.
+        """
+        if self._changes is not None or self._rename_detector is not None:
+            return self.changes()
+        return self._get_changes(paths)
+
     def __repr__(self):
         return '<WalkEntry commit=%s, changes=%r>' % (
           self.commit.id, self.changes())
 
 
 class _CommitTimeQueue(object):
-    """Priority queue of WalkEntry objects by commit time."""
+    """Priority queue of WalkEntry objects by commit time.
+
+    Commits are only read as far as their parents and commit time while
+    walking. The queue holds (time, index) pairs into tables of those, and
+    the full commit is only parsed for entries that are returned. The raw
+    text of a commit is kept while it is queued, so that it need not be
+    read again.
+    """
 
     def __init__(self, walker):
         self._walker = walker
         self._store = walker.store
         self._excluded = walker.excluded
+        # Tables of the commits found so far, by index.
+        self._shas = []
+        self._parents = []
+        self._times = []
+        self._indexes = {}
+        self._texts = {}
         self._pq = []
         self._pq_set = set()
-        self._seen = set()
         self._done = set()
         self._min_time = walker.since
-        self._last = None
+        self._last_time = None
         self._extra_commits_left = _MAX_EXTRA_COMMITS
         self._is_finished = False
 
         for commit_id in itertools.chain(walker.include, walker.excluded):
             self._push(commit_id)
 
-    def _push(self, commit_id):
+    def _load(self, commit_id):
         try:
-            commit = self._store[commit_id]
+            type_num, text = self._store.get_raw(commit_id)
         except KeyError:
             raise MissingCommitError(commit_id)
-        if commit_id not in self._pq_set and commit_id not in self._done:
-            heapq.heappush(self._pq, (-commit.commit_time, commit))
-            self._pq_set.add(commit_id)
-            self._seen.add(commit_id)
+        if type_num != Commit.type_num:
+            raise MissingCommitError(commit_id)
+        _, parents, commit_time = parse_commit_header(text)
+        index = len(self._shas)
+        self._shas.append(commit_id)
+        self._parents.append(parents)
+        self._times.append(commit_time)
+        self._indexes[commit_id] = index
+        self._texts[index] = text
+        return index
 
-    def _exclude_parents(self, commit):
+    def _push(self, commit_id):
+        index = self._indexes.get(commit_id)
+        if index is None:
+            index = self._load(commit_id)
+        if index not in self._pq_set and index not in self._done:
+            heapq.heappush(self._pq, (-self._times[index], index))
+            self._pq_set.add(index)
+
+    def _exclude_parents(self, index):
         excluded = self._excluded
-        seen = self._seen
-        todo = [commit]
+        indexes = self._indexes
+        todo = [index]
         while todo:
-            commit = todo.pop()
-            for parent in commit.parents:
-                if parent not in excluded and parent in seen:
-                    # TODO: This is inefficient unless the object store does
-                    # some caching (which DiskObjectStore currently does not).
-                    # We could either add caching in this class or pass around
-                    # parsed queue entry objects instead of commits.
-                    todo.append(self._store[parent])
+            index = todo.pop()
+            for parent in self._parents[index]:
+                if parent not in excluded and parent in indexes:
+                    todo.append(indexes[parent])
                 excluded.add(parent)
 
     def __next__(self):
         if self._is_finished:
             return None
         while self._pq:
-            _, commit = heapq.heappop(self._pq)
-            sha = commit.id
-            self._pq_set.remove(sha)
-            if sha in self._done:
+            _, index = heapq.heappop(self._pq)
+            self._pq_set.remove(index)
+            text = self._texts.pop(index)
+            if index in self._done:
                 continue
-            self._done.add(commit.id)
+            self._done.add(index)
 
-            for parent_id in commit.parents:
+            for parent_id in self._parents[index]:
                 self._push(parent_id)
 
+            sha = self._shas[index]
+            commit_time = self._times[index]
             reset_extra_commits = True
             is_excluded = sha in self._excluded
             if is_excluded:
-                self._exclude_parents(commit)
-                if self._pq and all(c.id in self._excluded
-                                    for _, c in self._pq):
-                    _, n = self._pq[0]
-                    if n.commit_time >= self._last.commit_time:
+                self._exclude_parents(index)
+                if self._pq and all(self._shas[i] in self._excluded
+                                    for _, i in self._pq):
+                    if (self._last_time is not None and
+                        -self._pq[0][0] >= self._last_time):
                         # If the next commit is newer than the last one, we need
                         # to keep walking in case its parents (which we may not
                         # have seen yet) are excluded. This gives the excluded
@@ -161,7 +212,7 @@ class _CommitTimeQueue(object):
                         reset_extra_commits = False
 
             if (self._min_time is not None and
-                commit.commit_time < self._min_time):
+                commit_time < self._min_time):
                 # We want to stop walking at min_time, but commits at the
                 # boundary may be out of order with respect to their parents. So
                 # we walk _MAX_EXTRA_COMMITS more commits once we hit this
@@ -177,12 +228,181 @@ class _CommitTimeQueue(object):
                     break
 
             if not is_excluded:
-                self._last = commit
+                self._last_time = commit_time
+                commit = ShaFile.from_raw_string(Commit.type_num, text)
                 return WalkEntry(self._walker, commit)
         self._is_finished = True
         return None
 
 
+class _TopoQueue(object):
+    """Queue of WalkEntry objects in topological order.
+
+    Commits are returned as soon as all of their children in the walk have
+    been returned, newest first. Rather than reading the whole walk up
+    front, the queue uses generation numbers (one more than the highest
+    generation of the parents) to find out when that is: a commit can only
+    have children with a higher generation, so once all commits down to its
+    generation have been counted, its number of children is known.
+
+    Only the generation numbers of the commits are kept for the whole walk;
+    commits themselves are kept for the frontier of the walk only.
+    """
+
+    def __init__(self, walker):
+        self._walker = walker
+        self._store = walker.store
+        self._excluded = walker.excluded
+        self._generations = {}
+        # Binary SHA -> joined binary SHAs of the parents, for commits whose
+        # parents were read for their generation but not used otherwise yet.
+        self._parent_cache = {}
+        # Number of children not yet returned, plus one, for commits found
+        # by the walk that counts children.
+        self._indegree = {}
+        self._indegree_pq = []
+        self._exclude_pq = []
+        self._ready = []
+        self._counter = itertools.count()
+
+        for commit_id in walker.excluded:
+            self._push_excluded(commit_id)
+        for commit_id in walker.include:
+            if commit_id in self._indegree:
+                continue
+            try:
+                commit = self._store[commit_id]
+            except KeyError:
+                raise MissingCommitError(commit_id)
+            self._indegree[commit_id] = 1
+            self._push_indegree(commit_id)
+            self._make_ready(commit)
+
+    def _parents(self, commit_id, keep=False):
+        """Get the parents of a commit, or None if it is missing.
+
+        :param commit_id: SHA of the commit
+        :param keep: If True, keep the parents cached for a later call;
+            otherwise they are dropped from the cache
+        """
+        key = commit_id.bytes
+        if keep:
+            data = self._parent_cache.get(key)
+        else:
+            data = self._parent_cache.pop(key, None)
+        if data is not None:
+            return [Sha1Sum(data[i:i + 20]) for i in range(0, len(data), 20)]
+        try:
+            type_num, text = self._store.get_raw(commit_id)
+        except KeyError:
+            return None
+        if type_num != Commit.type_num:
+            return None
+        parents = parse_commit_header(text)[1]
+        if keep:
+            self._parent_cache[key] = b''.join(p.bytes for p in parents)
+        return parents
+
+    def _generation(self, commit_id):
+        """Get the generation number of a commit, or 0 if it is missing."""
+        # Keyed by binary SHA, which takes far less memory than a Sha1Sum.
+        generations = self._generations
+        todo = [commit_id]
+        while todo:
+            sha = todo[-1]
+            key = sha.bytes
+            if key in generations:
+                todo.pop()
+                continue
+            parents = self._parents(sha, keep=True)
+            if parents is None:
+                generations[key] = 0
+                todo.pop()
+                continue
+            unknown = [p for p in parents if p.bytes not in generations]
+            if unknown:
+                todo.extend(unknown)
+                continue
+            generations[key] = 1 + max(
+                [generations[p.bytes] for p in parents] or [0])
+            todo.pop()
+        return generations[commit_id.bytes]
+
+    def _push_excluded(self, commit_id):
+        self._excluded.add(commit_id)
+        heapq.heappush(self._exclude_pq,
+                       (-self._generation(commit_id), commit_id))
+
+    def _exclude_down_to(self, generation):
+        """Find all excluded commits with at least the given generation."""
+        pq = self._exclude_pq
+        while pq and -pq[0][0] >= generation:
+            _, commit_id = heapq.heappop(pq)
+            for parent_id in self._parents(commit_id) or []:
+                if parent_id not in self._excluded:
+                    self._push_excluded(parent_id)
+
+    def _push_indegree(self, commit_id):
+        heapq.heappush(self._indegree_pq,
+                       (-self._generation(commit_id), commit_id))
+
+    def _count_down_to(self, generation):
+        """Count the children of all commits down to the given generation."""
+        pq = self._indegree_pq
+        indegree = self._indegree
+        while pq and -pq[0][0] >= generation:
+            commit_gen, commit_id = heapq.heappop(pq)
+            self._exclude_down_to(-commit_gen)
+            if commit_id in self._excluded:
+                # The parents of excluded commits are excluded too.
+                continue
+            for parent_id in self._parents(commit_id) or []:
+                if parent_id in indegree:
+                    indegree[parent_id] += 1
+                else:
+                    indegree[parent_id] = 2
+                    self._push_indegree(parent_id)
+
+    def _make_ready(self, commit):
+        heapq.heappush(self._ready, (-commit.commit_time,
+                                     next(self._counter), commit))
+
+    def __next__(self):
+        indegree = self._indegree
+        while self._ready:
+            _, _, commit = heapq.heappop(self._ready)
+            commit_id = commit.id
+            if commit_id not in indegree:
+                # Already returned; one of the included commits that was
+                # also reached through one of its children.
+                continue
+            generation = self._generation(commit_id)
+            self._count_down_to(generation)
+            self._exclude_down_to(generation)
+            if commit_id in self._excluded:
+                del indegree[commit_id]
+                continue
+            if indegree[commit_id] > 1:
+                # An included commit whose children have not all been
+                # returned yet; it is made ready again once they have.
+                continue
+            del indegree[commit_id]
+            for parent_id in commit.parents:
+                generation = self._generation(parent_id)
+                if not generation:
+                    # Missing from the store.
+                    continue
+                self._count_down_to(generation)
+                if parent_id not in indegree:
+                    # Excluded, and dropped already.
+                    continue
+                indegree[parent_id] -= 1
+                if indegree[parent_id] == 1:
+                    self._make_ready(self._store[parent_id])
+            return WalkEntry(self._walker, commit)
+        return None
+
+
 class Walker(object):
     """Object for performing a walk of commits in a store.
 
@@ -193,7 +413,8 @@ class Walker(object):
     def __init__(self, store, include, exclude=None, order=ORDER_DATE,
                  reverse=False, max_entries=None, paths=None,
                  rename_detector=None, follow=False, since=None, until=None,
-                 queue_cls=_CommitTimeQueue):
+                 queue_cls=_CommitTimeQueue, diff_cache=None,
+                 changed_paths=None):
         """Constructor.
 
         :param store: ObjectStore instance for looking up objects.
@@ -201,13 +422,18 @@ class Walker(object):
             ancestors.
         :param exclude: Iterable of SHAs of commits to exclude along with their
             ancestors, overriding includes.
-        :param order: ORDER_* constant specifying the order of results. Anything
-            other than ORDER_DATE may result in O(n) memory usage.
-        :param reverse: If True, reverse the order of output, requiring O(n)
-            memory.
+        :param order: ORDER_* constant specifying the order of results.
+            When the whole history of include is walked, ORDER_TOPO returns
+            entries as the walk goes and keeps a generation number for every
+            commit; with exclude, max_entries or since, the walked commits
+            are reordered instead.
+        :param reverse: If True, reverse the order of output. Long walks are
+            buffered in a temporary file.
         :param max_entries: The maximum number of entries to yield, or None for
             no limit.
         :param paths: Iterable of file or subtree paths to show entries for.
+            Path components may contain shell wildcards if paths is a
+            pathspec.PathSpec; other iterables are matched literally.
         :param rename_detector: diff.RenameDetector object for detecting
             renames.
         :param follow: If True, follow path across renames/copies. Forces a
@@ -217,6 +443,12 @@ class Walker(object):
         :param queue_cls: A class to use for a queue of commits, supporting the
             iterator protocol. The constructor takes a single argument, the
             Walker.
+        :param diff_cache: Optional diff_cache.TreeDiffCache for the changes
+            of each commit. It is also used by the default rename_detector
+            created for follow.
+        :param changed_paths: Optional changed_paths.ChangedPathFilters, used
+            to skip commits that did not change any of paths without
+            comparing their trees.
         """
         # Note: when adding arguments to this method, please also update
         # dulwich.repo.BaseRepo.get_walker
@@ -228,28 +460,28 @@ class Walker(object):
         self.order = order
         self.reverse = reverse
         self.max_entries = max_entries
-        self.paths = paths and set(paths) or None
+        # Copied, since follow changes the paths as the walk goes.
+        self.paths = paths and as_pathspec(paths).copy() or None
         if follow and not rename_detector:
-            rename_detector = RenameDetector(store)
+            rename_detector = RenameDetector(store, diff_cache=diff_cache)
         self.rename_detector = rename_detector
         self.follow = follow
         self.since = since
         self.until = until
-
+        self.diff_cache = diff_cache
+        self.changed_paths = changed_paths
+
+        # _TopoQueue numbers the generations of all ancestors of include,
+        # so it only pays off if they are all walked anyway.
+        if (order == ORDER_TOPO and queue_cls is _CommitTimeQueue and
+                not self.excluded and max_entries is None and since is None):
+            queue_cls = _TopoQueue
         self._num_entries = 0
         self._queue = queue_cls(self)
         self._out_queue = collections.deque()
 
     def _path_matches(self, changed_path):
-        if changed_path is None:
-            return False
-        for followed_path in self.paths:
-            if changed_path == followed_path:
-                return True
-            if (changed_path.startswith(followed_path) and
-                changed_path[len(followed_path)] == b'/'[0]):
-                return True
-        return False
+        return self.paths.matches(changed_path)
 
     def _change_matches(self, change):
         old_path = change.old.path
@@ -281,8 +513,13 @@ class Walker(object):
         if self.paths is None:
             return True
 
+        if (self.changed_paths is not None and
+            not self.changed_paths.may_have_changed(commit, self.paths)):
+            return None
+
+        changes = entry._changes_in_paths(self.paths)
         if len(commit.parents) > 1:
-            for path_changes in entry.changes():
+            for path_changes in changes:
                 # For merge commits, only include changes with conflicts for
                 # this path. Since a rename conflict may include different
                 # old.paths, we have to check all of them.
@@ -290,7 +527,7 @@ class Walker(object):
                     if self._change_matches(change):
                         return True
         else:
-            for change in entry.changes():
+            for change in changes:
                 if self._change_matches(change):
                     return True
         return None
@@ -318,16 +555,56 @@ class Walker(object):
         :return: An iterator or list of WalkEntry objects, in the order required
             by the Walker.
         """
-        if self.order == ORDER_TOPO:
+        if self.order == ORDER_TOPO and not isinstance(self._queue,
+                                                        _TopoQueue):
             results = _topo_reorder(results)
         if self.reverse:
-            results = reversed(list(results))
+            results = _reverse_entries(self, results)
         return results
 
     def __iter__(self):
         return iter(self._reorder(iter(self._next, None)))
 
 
+def _reverse_entries(walker, entries):
+    """Reverse an iterable of entries.
+
+    Up to _REVERSE_BUFFER_ENTRIES entries are kept in memory. For longer
+    walks, the SHAs of the earlier entries are written to a temporary file,
+    and their entries are recreated while reading it backwards.
+
+    :param walker: The Walker the entries came from.
+    :param entries: An iterable of WalkEntry objects.
+    :yield: The WalkEntry objects from entries, last first.
+    """
+    buf = []
+    spool = None
+    try:
+        for entry in entries:
+            buf.append(entry)
+            if len(buf) >= _REVERSE_BUFFER_ENTRIES:
+                if spool is None:
+                    spool = tempfile.TemporaryFile()
+                spool.write(b''.join(e.commit.id.bytes for e in buf))
+                buf = []
+        for entry in reversed(buf):
+            yield entry
+        if spool is None:
+            return
+        end = spool.tell()
+        while end:
+            start = max(0, end - _REVERSE_BUFFER_ENTRIES * 20)
+            spool.seek(start)
+            data = spool.read(end - start)
+            for i in range(len(data) - 20, -1, -20):
+                commit = walker.store[Sha1Sum(data[i:i + 20])]
+                yield WalkEntry(walker, commit)
+            end = start
+    finally:
+        if spool is not None:
+            spool.close()
+
+
 def _topo_reorder(entries):
     """Reorder an iterable of entries topologically.
 
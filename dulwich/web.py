@@ -18,14 +18,20 @@
 
 """HTTP server for dulwich that implements the git smart HTTP protocol."""
 
+import binascii
 from io import BytesIO
 import os
+import queue
 import re
 import sys
+import threading
 import time
 
 from urllib.parse import parse_qs
 from dulwich import log_utils
+from dulwich.errors import (
+    HangupException,
+    )
 from dulwich.protocol import (
     ReceivableProtocol,
     )
@@ -49,10 +55,16 @@ logger = log_utils.getLogger(__name__)
 
 # HTTP error strings
 HTTP_OK = '200 OK'
+HTTP_PARTIAL_CONTENT = '206 Partial Content'
+HTTP_NOT_MODIFIED = '304 Not Modified'
 HTTP_NOT_FOUND = '404 Not Found'
 HTTP_FORBIDDEN = '403 Forbidden'
+HTTP_RANGE_NOT_SATISFIABLE = '416 Requested Range Not Satisfiable'
 HTTP_ERROR = '500 Internal Server Error'
 
+# Size of the blocks in which files are sent.
+SEND_FILE_BLOCKSIZE = 10240
+
 
 def date_time_string(timestamp=None):
     # From BaseHTTPRequestHandler.date_time_string in BaseHTTPServer.py in the
@@ -84,25 +96,114 @@ def url_prefix(mat):
 
 
 def get_repo(backend, mat):
-    """Get a Repo instance for the given backend and URL regex match."""
+    """Get a Repo instance for the given backend and URL regex match.
+
+    The repository should be handed back with backend.release_repository().
+    """
     return backend.open_repository(url_prefix(mat))
 
 
-def send_file(req, f, content_type):
-    """Send a file-like object to the request output.
+def _get_named_file(backend, mat, path):
+    repo = get_repo(backend, mat)
+    try:
+        return repo.get_named_file(path)
+    finally:
+        backend.release_repository(repo)
 
-    :param req: The HTTPGitRequest object to send output to.
-    :param f: An open file-like object to send; will be closed.
-    :param content_type: The MIME type for the file.
-    :return: Iterator over the contents of the file, as chunks.
+
+def _file_size(f):
+    """Determine the size of a file-like object.
+
+    :return: The size in bytes, or None if f is not seekable.
     """
-    if f is None:
-        yield req.not_found(b'File not found')
-        return
     try:
-        req.respond(HTTP_OK, content_type)
-        while True:
-            data = f.read(10240)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(0)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return size
+
+
+def _checksum_etag(f):
+    """Determine an entity tag for a file that ends in a SHA-1 checksum.
+
+    Pack and pack index files end in a checksum over their contents, which
+    makes for a cheap and strong entity tag.
+
+    :return: A quoted entity tag, or None if it could not be determined.
+    """
+    size = _file_size(f)
+    if size is None or size < 20:
+        return None
+    f.seek(size - 20)
+    checksum = f.read(20)
+    f.seek(0)
+    return '"%s"' % binascii.hexlify(checksum).decode('ascii')
+
+
+def _etag_matches(header, etag):
+    """Check whether an If-None-Match header matches an entity tag."""
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+
+def _parse_range(header, size):
+    """Parse a HTTP Range header.
+
+    Only single byte ranges are supported.
+
+    :param header: Value of the Range header, or None
+    :param size: Size of the file the range applies to
+    :return: Tuple with the first and last (inclusive) byte of the range,
+        or None if the whole file should be sent. The first byte is beyond
+        the end of the file if the range can not be satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec:
+        return None
+    first, sep, last = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # Suffix range: the last N bytes.
+            length = int(last)
+            if length == 0:
+                return (size, size - 1)
+            return (max(size - length, 0), size - 1)
+        first = int(first)
+        if last:
+            last = int(last)
+        else:
+            last = size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        return (size, size - 1)
+    if last < first:
+        return None
+    return (first, min(last, size - 1))
+
+
+def _iter_file(req, f, length=None):
+    """Iterate over the contents of a file, closing it when done.
+
+    :param req: The HTTPGitRequest object, used to report read errors.
+    :param f: An open file-like object to read; will be closed.
+    :param length: Number of bytes to read, or None to read until EOF.
+    """
+    try:
+        while length is None or length > 0:
+            if length is None:
+                data = f.read(SEND_FILE_BLOCKSIZE)
+            else:
+                data = f.read(min(SEND_FILE_BLOCKSIZE, length))
+                length -= len(data)
             if not data:
                 break
             yield data
@@ -115,6 +216,70 @@ def send_file(req, f, content_type):
         raise
 
 
+def send_file(req, f, content_type, etag=None):
+    """Send a file-like object to the request output.
+
+    Single byte ranges are supported for seekable files, and a response
+    without a body is sent if the client already has the given entity tag.
+    When the WSGI server provides wsgi.file_wrapper, complete files are
+    handed to it so that the server can send them efficiently, e.g. using
+    sendfile().
+
+    :param req: The HTTPGitRequest object to send output to.
+    :param f: An open file-like object to send; will be closed.
+    :param content_type: The MIME type for the file.
+    :param etag: Optional quoted entity tag for the file.
+    :return: Iterable over the contents of the file, as chunks.
+    """
+    if f is None:
+        return [req.not_found(b'File not found')]
+    if etag is not None:
+        req.add_header('ETag', etag)
+        if _etag_matches(req.environ.get('HTTP_IF_NONE_MATCH'), etag):
+            f.close()
+            req.respond(HTTP_NOT_MODIFIED)
+            return []
+    size = _file_size(f)
+    if size is None:
+        req.respond(HTTP_OK, content_type)
+        return _iter_file(req, f)
+
+    req.add_header('Accept-Ranges', 'bytes')
+    byte_range = _parse_range(req.environ.get('HTTP_RANGE'), size)
+    if_range = req.environ.get('HTTP_IF_RANGE')
+    if byte_range is not None and if_range and if_range != etag:
+        # The client's copy is out of date, so it needs the whole file.
+        byte_range = None
+    if byte_range is not None:
+        first, last = byte_range
+        if first >= size:
+            f.close()
+            req.respond(HTTP_RANGE_NOT_SATISFIABLE, 'text/plain',
+                        [('Content-Range', 'bytes */%d' % size)])
+            return []
+        req.respond(HTTP_PARTIAL_CONTENT, content_type, [
+          ('Content-Range', 'bytes %d-%d/%d' % (first, last, size)),
+          ('Content-Length', str(last - first + 1)),
+          ])
+        f.seek(first)
+        return _iter_file(req, f, last - first + 1)
+
+    req.respond(HTTP_OK, content_type, [('Content-Length', str(size))])
+    file_wrapper = req.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(f, SEND_FILE_BLOCKSIZE)
+    return _iter_file(req, f)
+
+
+def _send_checksummed_file(req, f, content_type):
+    """Send a pack or pack index file, using its checksum as entity tag."""
+    if f is None:
+        etag = None
+    else:
+        etag = _checksum_etag(f)
+    return send_file(req, f, content_type, etag=etag)
+
+
 def _url_to_path(url):
     return url.replace('/', os.path.sep)
 
@@ -123,22 +288,32 @@ def get_text_file(req, backend, mat):
     req.nocache()
     path = _url_to_path(mat.group())
     logger.info('Sending plain text file %s', path)
-    return send_file(req, get_repo(backend, mat).get_named_file(path),
-                     'text/plain')
+    return send_file(req, _get_named_file(backend, mat, path), 'text/plain')
 
 
 def get_loose_object(req, backend, mat):
     sha = Sha1Sum(mat.group(1) + mat.group(2))
     logger.info('Sending loose object %s', sha)
-    object_store = get_repo(backend, mat).object_store
-    if not object_store.contains_loose(sha):
-        yield req.not_found(b'Object not found')
-        return
+    repo = get_repo(backend, mat)
     try:
-        data = object_store[sha].as_legacy_object()
-    except IOError:
-        yield req.error(b'Error reading object')
-        return
+        object_store = repo.object_store
+        if not object_store.contains_loose(sha):
+            yield req.not_found(b'Object not found')
+            return
+        # Loose objects are named after their contents.
+        etag = '"%s"' % sha
+        req.add_header('ETag', etag)
+        if _etag_matches(req.environ.get('HTTP_IF_NONE_MATCH'), etag):
+            req.cache_forever()
+            req.respond(HTTP_NOT_MODIFIED)
+            return
+        try:
+            data = object_store[sha].as_legacy_object()
+        except IOError:
+            yield req.error(b'Error reading object')
+            return
+    finally:
+        backend.release_repository(repo)
     req.cache_forever()
     req.respond(HTTP_OK, 'application/x-git-loose-object')
     yield data
@@ -148,16 +323,18 @@ def get_pack_file(req, backend, mat):
     req.cache_forever()
     path = _url_to_path(mat.group())
     logger.info('Sending pack file %s', path)
-    return send_file(req, get_repo(backend, mat).get_named_file(path),
-                     'application/x-git-packed-objects')
+    return _send_checksummed_file(
+        req, _get_named_file(backend, mat, path),
+        'application/x-git-packed-objects')
 
 
 def get_idx_file(req, backend, mat):
     req.cache_forever()
     path = _url_to_path(mat.group())
     logger.info('Sending pack file %s', path)
-    return send_file(req, get_repo(backend, mat).get_named_file(path),
-                     'application/x-git-packed-objects-toc')
+    return _send_checksummed_file(
+        req, _get_named_file(backend, mat, path),
+        'application/x-git-packed-objects-toc')
 
 
 def get_info_refs(req, backend, mat):
@@ -183,31 +360,38 @@ def get_info_refs(req, backend, mat):
         req.respond(HTTP_OK, 'text/plain')
         logger.info('Emulating dumb info/refs')
         repo = get_repo(backend, mat)
-        refs = repo.get_refs()
-        for name in sorted(refs.keys()):
-            # get_refs() includes HEAD as a special case, but we don't want to
-            # advertise it
-            if name == b'HEAD':
-                continue
-            sha = refs[name]
-            o = repo[sha]
-            if not o:
-                continue
-
-            yield sha.hex_bytes + b'\t' + name + b'\n'
-            peeled_sha = repo.get_peeled(name)
-            if peeled_sha != sha:
-                yield peeled_sha.hex_bytes + b'\t' + name + b'^{}\n'
+        try:
+            refs = repo.get_refs()
+            for name in sorted(refs.keys()):
+                # get_refs() includes HEAD as a special case, but we don't
+                # want to advertise it
+                if name == b'HEAD':
+                    continue
+                sha = refs[name]
+                o = repo[sha]
+                if not o:
+                    continue
+
+                yield sha.hex_bytes + b'\t' + name + b'\n'
+                peeled_sha = repo.get_peeled(name)
+                if peeled_sha != sha:
+                    yield peeled_sha.hex_bytes + b'\t' + name + b'^{}\n'
+        finally:
+            backend.release_repository(repo)
 
 
 def get_info_packs(req, backend, mat):
     req.nocache()
     req.respond(HTTP_OK, 'text/plain')
     logger.info('Emulating dumb info/packs')
-    for pack in get_repo(backend, mat).object_store.packs:
-        if not isinstance(pack.name(), Sha1Sum):
-            raise TypeError("pack.name() needs to be a Sha1Sum")
-        yield b'P pack-' + pack.name().hex_bytes + b'.pack\n'
+    repo = get_repo(backend, mat)
+    try:
+        for pack in repo.object_store.packs:
+            if not isinstance(pack.name(), Sha1Sum):
+                raise TypeError("pack.name() needs to be a Sha1Sum")
+            yield b'P pack-' + pack.name().hex_bytes + b'.pack\n'
+    finally:
+        backend.release_repository(repo)
 
 class _LengthLimitedFile(object):
     """Wrapper class to limit the length of reads from a file-like object.
@@ -235,6 +419,119 @@ class _LengthLimitedFile(object):
     # TODO: support more methods as necessary
 
 
+class ChunkReader(object):
+    """Reader for a request body sent with chunked transfer-encoding.
+
+    Conforming WSGI servers are not required to decode chunked request
+    bodies, and wsgiref does not.
+    """
+
+    def __init__(self, f):
+        self._input = f
+        self._buf = b''
+        self._eof = False
+
+    def _read_chunk(self):
+        line = self._input.readline()
+        if not line:
+            raise HangupException()
+        # Ignore any chunk extensions.
+        size = int(line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            # Skip the trailer, which ends with an empty line.
+            while self._input.readline().strip():
+                pass
+            self._eof = True
+            return b''
+        data = self._input.read(size)
+        if len(data) != size:
+            raise HangupException()
+        self._input.readline()
+        return data
+
+    def read(self, size=-1):
+        """Read at most size bytes, blocking until at least one is available.
+
+        :param size: Maximum number of bytes to read, or -1 to read until the
+            end of the body.
+        """
+        while not self._buf and not self._eof:
+            self._buf = self._read_chunk()
+        if size == -1:
+            chunks = [self._buf]
+            while not self._eof:
+                chunks.append(self._read_chunk())
+            self._buf = b''
+            return b''.join(chunks)
+        ret, self._buf = self._buf[:size], self._buf[size:]
+        return ret
+
+    def close(self):
+        pass
+
+
+# Maximum number of output chunks buffered between a handler thread and the
+# response iterator.
+_STREAM_QUEUE_SIZE = 16
+
+
+def _stream_output(run):
+    """Run a function in a separate thread and yield the data it writes.
+
+    This allows handlers that write their output through a callback to be
+    served through the WSGI response iterator, so that the output is sent
+    while it is being generated rather than through the (deprecated) write
+    callable. The handler blocks when the client does not keep up.
+
+    :param run: Function to call with a write callback.
+    :return: Iterator over the data passed to the write callback.
+    """
+    chunks = queue.Queue(_STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+    done = object()
+    failure = []
+
+    def write(data):
+        while not cancelled.is_set():
+            try:
+                chunks.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise HangupException()
+
+    def target():
+        try:
+            run(write)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            while not cancelled.is_set():
+                try:
+                    chunks.put(done, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            data = chunks.get()
+            if data is done:
+                break
+            if data:
+                yield data
+    finally:
+        # The response may be closed early if the client went away; make
+        # sure the handler thread does not block forever.
+        cancelled.set()
+        thread.join()
+    if failure:
+        raise failure[0]
+
+
 def handle_service_request(req, backend, mat):
     service = mat.group().lstrip('/')
     logger.info('Handling service request for %s', service)
@@ -243,19 +540,26 @@ def handle_service_request(req, backend, mat):
         yield req.forbidden('Unsupported service %s' % service)
         return
     req.nocache()
-    write = req.respond(HTTP_OK, 'application/x-%s-result' % service)
+    req.respond(HTTP_OK, 'application/x-%s-result' % service)
 
     input = req.environ['wsgi.input']
-    # This is not necessary if this app is run from a conforming WSGI server.
-    # Unfortunately, there's no way to tell that at this point.
-    # TODO: git may used HTTP/1.1 chunked encoding instead of specifying
-    # content-length
-    content_length = req.environ.get('CONTENT_LENGTH', '')
-    if content_length:
-        input = _LengthLimitedFile(input, int(content_length))
-    with ReceivableProtocol(input.read, write, None) as proto:
-        with handler_cls(backend, [url_prefix(mat)], proto, http_req=req) as handler:
-            handler.handle()
+    if req.environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+        input = ChunkReader(input)
+    else:
+        # This is not necessary if this app is run from a conforming WSGI
+        # server. Unfortunately, there's no way to tell that at this point.
+        content_length = req.environ.get('CONTENT_LENGTH', '')
+        if content_length:
+            input = _LengthLimitedFile(input, int(content_length))
+
+    def run(write):
+        with ReceivableProtocol(input.read, write, None) as proto:
+            with handler_cls(backend, [url_prefix(mat)], proto,
+                             http_req=req) as handler:
+                handler.handle()
+
+    for data in _stream_output(run):
+        yield data
 
 
 class HTTPGitRequest(object):